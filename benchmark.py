@@ -0,0 +1,434 @@
+"""
+Prueba de carga de punta a punta del servidor de tickets.
+
+Levanta main.py (uvicorn, en un proceso aparte y con una base de datos temporal)
+contra dos servidores simulados que corren en este mismo script:
+  - el puente de WhatsApp (POST /enviar-mensaje), que recibe las respuestas del bot
+  - la API de DeepSeek (POST /chat/completions, con y sin streaming)
+ambos con latencia y tasa de errores configurables.
+
+Cada usuario simulado recorre la conversación completa
+(INICIO → NOMBRE → DEPTO → EQUIPO → ACTIVO → FALLA → DIAGNOSTICO), opcionalmente
+con una foto junto a la falla, y se mide cuánto tarda cada respuesta en llegar
+al puente desde que se envió el mensaje al webhook.
+
+Al final se reporta el throughput, latencias p50/p95/p99 por paso y el retraso
+del event loop del servidor (leído de /health durante la prueba).
+
+Uso:
+    python benchmark.py [--usuarios 500] [--concurrencia 100] [--imagenes 0.2]
+                        [--latencia-ia 0.8] [--error-ia 0.0]
+                        [--latencia-puente 0.02] [--error-puente 0.0]
+                        [--json resultado.json] [--max-p95 5.0]
+
+Con --max-p95 el script termina con código 1 si el p95 de punta a punta supera
+ese valor (en segundos), para usarlo como control antes de desplegar.
+"""
+
+import argparse
+import asyncio
+import json
+import os
+import random
+import socket
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+from urllib.parse import quote
+
+import aiohttp
+from aiohttp import web
+
+TOKEN = "benchmark"
+DIRECTORIO = os.path.dirname(os.path.abspath(__file__))
+
+EQUIPOS = ["Laptop", "Desktop", "Impresora", "Otro"]
+FALLAS = [
+    "La pantalla parpadea y se pone negra",
+    "No prende aunque la batería está cargada",
+    "Está muy lenta desde ayer, creo que tiene virus",
+    "No tiene conexión a internet por wifi",
+    "Se atasca el papel en cada impresión",
+    "No imprime y marca error de cartucho",
+]
+
+
+def puerto_libre() -> int:
+    with socket.socket() as s:
+        s.bind(("127.0.0.1", 0))
+        return s.getsockname()[1]
+
+
+def percentil(valores: list, p: float) -> float:
+    if not valores:
+        return 0.0
+    ordenados = sorted(valores)
+    return ordenados[min(len(ordenados) - 1, int(p * len(ordenados)))]
+
+
+def es_respuesta_final(texto: str) -> bool:
+    """El paso FALLA envía un acuse y/o los pasos antes de la respuesta final"""
+    if texto.startswith("🔎"):
+        return False
+    if texto.startswith("📋") and "ticket #" not in texto and "Intenta estos pasos" not in texto:
+        return False
+    return True
+
+
+# --- SERVIDORES SIMULADOS ---
+class Simuladores:
+    """Puente de WhatsApp y API de DeepSeek falsos, en el loop del benchmark"""
+
+    def __init__(self, args):
+        self.args = args
+        self.buzones = {}  # numero -> asyncio.Queue con las respuestas del bot
+        self.stats = {"puente_mensajes": 0, "puente_errores": 0, "ia_llamadas": 0, "ia_errores": 0}
+        self._runners = []
+
+    def buzon(self, numero: str) -> asyncio.Queue:
+        return self.buzones.setdefault(numero, asyncio.Queue())
+
+    def _latencia(self, media: float) -> float:
+        return random.uniform(0.5, 1.5) * media if media > 0 else 0
+
+    async def enviar_mensaje(self, request: web.Request) -> web.Response:
+        datos = await request.json()
+        await asyncio.sleep(self._latencia(self.args.latencia_puente))
+        if random.random() < self.args.error_puente:
+            self.stats["puente_errores"] += 1
+            return web.json_response({"error": "WhatsApp reconectando"}, status=503)
+        self.stats["puente_mensajes"] += 1
+        self.buzon(datos["numero"]).put_nowait((time.monotonic(), datos["texto"]))
+        return web.json_response({"status": "enviado"})
+
+    async def chat_completions(self, request: web.Request) -> web.StreamResponse:
+        datos = await request.json()
+        self.stats["ia_llamadas"] += 1
+        latencia = self._latencia(self.args.latencia_ia)
+        if random.random() < self.args.error_ia:
+            await asyncio.sleep(latencia)
+            self.stats["ia_errores"] += 1
+            return web.json_response({"error": "simulado"}, status=500)
+
+        contenido = json.dumps({
+            "pasos": ["Reinicia el equipo", "Revisa los cables", "Prueba con otro usuario"],
+            "requiere_tecnico": random.random() >= self.args.sin_tecnico,
+            "urgencia": "media"
+        }, ensure_ascii=False)
+
+        if not datos.get("stream"):
+            await asyncio.sleep(latencia)
+            return web.json_response({"choices": [{"message": {"content": contenido}}]})
+
+        # Streaming: el primer fragmento llega al 30% de la latencia y el resto repartido
+        respuesta = web.StreamResponse(headers={"Content-Type": "text/event-stream"})
+        await respuesta.prepare(request)
+        await asyncio.sleep(latencia * 0.3)
+        trozos = [contenido[i:i + 24] for i in range(0, len(contenido), 24)]
+        for trozo in trozos:
+            evento = {"choices": [{"delta": {"content": trozo}}]}
+            await respuesta.write(f"data: {json.dumps(evento, ensure_ascii=False)}\n\n".encode())
+            await asyncio.sleep(latencia * 0.7 / len(trozos))
+        await respuesta.write(b"data: [DONE]\n\n")
+        await respuesta.write_eof()
+        return respuesta
+
+    async def iniciar(self) -> tuple:
+        puertos = []
+        for rutas in (
+            [web.post("/enviar-mensaje", self.enviar_mensaje)],
+            [web.post("/chat/completions", self.chat_completions)],
+        ):
+            aplicacion = web.Application(client_max_size=1024 ** 2)
+            aplicacion.add_routes(rutas)
+            runner = web.AppRunner(aplicacion, access_log=None)
+            await runner.setup()
+            puerto = puerto_libre()
+            await web.TCPSite(runner, "127.0.0.1", puerto).start()
+            self._runners.append(runner)
+            puertos.append(puerto)
+        return tuple(puertos)
+
+    async def detener(self):
+        for runner in self._runners:
+            await runner.cleanup()
+
+
+# --- SERVIDOR BAJO PRUEBA ---
+def iniciar_servidor(args, puerto: int, puerto_puente: int, puerto_ia: int, carpeta: str) -> subprocess.Popen:
+    entorno = {
+        **os.environ,
+        "API_TOKEN": TOKEN,
+        "IP_LAPTOP": "127.0.0.1",
+        "PUERTO_LAPTOP": str(puerto_puente),
+        "DEEPSEEK_API_KEY": "benchmark",
+        "DEEPSEEK_BASE_URL": f"http://127.0.0.1:{puerto_ia}",
+        "DB_PATH": os.path.join(carpeta, "tickets.db"),
+        "CARPETA_FOTOS": os.path.join(carpeta, "fotos"),
+        "CARPETA_LOGS": os.path.join(carpeta, "logs"),
+        "SESSION_BACKEND": "sqlite",
+        # Cada usuario describe su falla distinto, pero la caché de diagnósticos se
+        # desactiva para que todas las fallas pasen por la IA simulada
+        "DIAGNOSTICO_CACHE_MAX": "0" if not args.con_cache else os.environ.get("DIAGNOSTICO_CACHE_MAX", "1000"),
+    }
+    return subprocess.Popen(
+        [sys.executable, "-m", "uvicorn", "main:app", "--app-dir", DIRECTORIO,
+         "--host", "127.0.0.1", "--port", str(puerto), "--log-level", "warning"],
+        cwd=carpeta, env=entorno,
+        stdout=None if args.verbose else subprocess.DEVNULL,
+        stderr=None if args.verbose else subprocess.DEVNULL
+    )
+
+
+async def esperar_servidor(http: aiohttp.ClientSession, url: str, proceso: subprocess.Popen):
+    for _ in range(150):
+        if proceso.poll() is not None:
+            raise RuntimeError("El servidor terminó al iniciar (usa --verbose para ver el error)")
+        try:
+            async with http.get(f"{url}/health") as resp:
+                if resp.status == 200:
+                    return
+        except aiohttp.ClientError:
+            pass
+        await asyncio.sleep(0.2)
+    raise RuntimeError("El servidor no respondió a /health")
+
+
+# --- USUARIOS SIMULADOS ---
+class Resultados:
+    def __init__(self):
+        self.latencias = {}  # paso -> [segundos hasta la respuesta final]
+        self.aceptacion = []  # segundos que tarda el webhook en aceptar el mensaje
+        self.conversaciones = 0
+        self.errores = 0
+        self.timeouts = 0
+        self.reintentos_429 = 0
+        self.retraso_loop_ms = []
+
+    def registrar(self, paso: str, segundos: float):
+        self.latencias.setdefault(paso, []).append(segundos)
+
+
+async def enviar(http: aiohttp.ClientSession, url: str, resultados: Resultados,
+                 numero: str, texto: str, imagen: bytes = None):
+    """Envía un mensaje al webhook; reintenta los 429 respetando Retry-After"""
+    cabeceras = {"Authorization": f"Bearer {TOKEN}"}
+    while True:
+        inicio = time.monotonic()
+        if imagen:
+            peticion = http.post(f"{url}/webhook/imagen", data=imagen, headers={
+                **cabeceras, "X-Remitente": numero, "X-Contenido": quote(texto),
+                "Content-Type": "application/octet-stream"
+            })
+        else:
+            peticion = http.post(f"{url}/webhook", json={"remitente": numero, "contenido": texto},
+                                 headers=cabeceras)
+        async with peticion as resp:
+            await resp.read()
+            if resp.status == 429:
+                resultados.reintentos_429 += 1
+                await asyncio.sleep(float(resp.headers.get("Retry-After", "1")))
+                continue
+            if resp.status >= 400:
+                raise RuntimeError(f"webhook respondió {resp.status}")
+        resultados.aceptacion.append(time.monotonic() - inicio)
+        return
+
+
+async def simular_usuario(indice: int, http: aiohttp.ClientSession, url: str, simuladores: Simuladores,
+                          resultados: Resultados, args):
+    numero = f"5210000{indice:06d}"
+    buzon = simuladores.buzon(numero)
+    equipo = random.choice(EQUIPOS)
+    imagen = None
+    if random.random() < args.imagenes:
+        # Bytes distintos por usuario: las fotos se guardan por hash de contenido
+        imagen = b"\xff\xd8\xff\xe0" + os.urandom(args.tamano_imagen * 1024)
+
+    pasos = [
+        ("inicio", "Hola", None),
+        ("nombre", f"Usuario {indice}", None),
+        ("depto", "Sistemas", None),
+        ("equipo", equipo, None),
+        ("activo", f"ACT-{indice}", None),
+        ("falla", f"{random.choice(FALLAS)} (caso {indice})", imagen),
+    ]
+    try:
+        for paso, texto, adjunto in pasos:
+            ultima = await conversar(http, url, resultados, buzon, numero, paso, texto, adjunto, args)
+            if ultima is None:
+                return
+            if args.pausa:
+                await asyncio.sleep(args.pausa)
+        if "Intenta estos pasos" in ultima:
+            if await conversar(http, url, resultados, buzon, numero, "diagnostico",
+                               random.choice(["Sí, ya funciona", "No, sigue igual"]), None, args) is None:
+                return
+        resultados.conversaciones += 1
+    except (aiohttp.ClientError, RuntimeError) as e:
+        resultados.errores += 1
+        if args.verbose:
+            print(f"⚠️ Usuario {indice}: {e}")
+    finally:
+        simuladores.buzones.pop(numero, None)
+
+
+async def conversar(http, url, resultados: Resultados, buzon: asyncio.Queue, numero: str,
+                    paso: str, texto: str, imagen: bytes, args):
+    """Envía un mensaje y espera la respuesta final del bot; retorna su texto o None"""
+    inicio = time.monotonic()
+    await enviar(http, url, resultados, numero, texto, imagen)
+    limite = inicio + args.timeout
+    while True:
+        try:
+            llegada, respuesta = await asyncio.wait_for(buzon.get(), timeout=max(0.01, limite - time.monotonic()))
+        except asyncio.TimeoutError:
+            resultados.timeouts += 1
+            return None
+        if es_respuesta_final(respuesta):
+            break
+    resultados.registrar(paso + ("+foto" if imagen else ""), llegada - inicio)
+    if respuesta.startswith("Disculpa, ocurrió un error"):
+        resultados.errores += 1
+        return None
+    return respuesta
+
+
+async def muestrear_loop(http: aiohttp.ClientSession, url: str, resultados: Resultados, fin: asyncio.Event):
+    """Lee el retraso del event loop del servidor desde /health cada segundo"""
+    while not fin.is_set():
+        try:
+            async with http.get(f"{url}/health") as resp:
+                datos = await resp.json()
+            resultados.retraso_loop_ms.append(datos["event_loop"]["retraso_ms_max"])
+        except (aiohttp.ClientError, KeyError, ValueError):
+            pass
+        try:
+            await asyncio.wait_for(fin.wait(), timeout=1)
+        except asyncio.TimeoutError:
+            pass
+
+
+# --- REPORTE ---
+def resumen(resultados: Resultados, duracion: float, simuladores: Simuladores, salud: dict) -> dict:
+    todas = [s for valores in resultados.latencias.values() for s in valores]
+    def fila(valores: list) -> dict:
+        return {
+            "n": len(valores),
+            "p50_ms": round(percentil(valores, 0.50) * 1000, 1),
+            "p95_ms": round(percentil(valores, 0.95) * 1000, 1),
+            "p99_ms": round(percentil(valores, 0.99) * 1000, 1),
+            "max_ms": round(max(valores) * 1000, 1) if valores else 0.0,
+        }
+    return {
+        "duracion_s": round(duracion, 2),
+        "conversaciones": resultados.conversaciones,
+        "conversaciones_por_s": round(resultados.conversaciones / duracion, 2) if duracion else 0,
+        "mensajes_por_s": round(len(todas) / duracion, 2) if duracion else 0,
+        "errores": resultados.errores,
+        "timeouts": resultados.timeouts,
+        "reintentos_429": resultados.reintentos_429,
+        "webhook": fila(resultados.aceptacion),
+        "punta_a_punta": fila(todas),
+        "por_paso": {paso: fila(valores) for paso, valores in resultados.latencias.items()},
+        "event_loop_ms": {
+            "max": max(resultados.retraso_loop_ms, default=0.0),
+            "mediana_muestras": statistics.median(resultados.retraso_loop_ms) if resultados.retraso_loop_ms else 0.0,
+            "servidor": salud.get("event_loop"),
+        },
+        "simuladores": simuladores.stats,
+        "servidor": {clave: salud.get(clave) for clave in ("escritor", "entrantes", "deepseek")},
+    }
+
+
+def imprimir(reporte: dict):
+    print(f"\n📊 {reporte['conversaciones']} conversaciones en {reporte['duracion_s']}s "
+          f"({reporte['conversaciones_por_s']}/s, {reporte['mensajes_por_s']} mensajes/s)")
+    print(f"   errores: {reporte['errores']}  timeouts: {reporte['timeouts']}  "
+          f"reintentos 429: {reporte['reintentos_429']}\n")
+    print(f"   {'paso':<18}{'n':>7}{'p50 ms':>10}{'p95 ms':>10}{'p99 ms':>10}{'max ms':>10}")
+    filas = [("webhook (acepta)", reporte["webhook"]), ("punta a punta", reporte["punta_a_punta"])]
+    filas += sorted(reporte["por_paso"].items())
+    for nombre, f in filas:
+        print(f"   {nombre:<18}{f['n']:>7}{f['p50_ms']:>10}{f['p95_ms']:>10}{f['p99_ms']:>10}{f['max_ms']:>10}")
+    loop = reporte["event_loop_ms"]
+    print(f"\n   event loop del servidor: retraso máximo {loop['max']} ms "
+          f"(actual p99 {(loop['servidor'] or {}).get('retraso_ms_p99', 0)} ms)")
+
+
+async def ejecutar(args) -> dict:
+    random.seed(args.semilla)
+    simuladores = Simuladores(args)
+    puerto_puente, puerto_ia = await simuladores.iniciar()
+    puerto = puerto_libre()
+    url = f"http://127.0.0.1:{puerto}"
+
+    with tempfile.TemporaryDirectory(prefix="benchmark_tickets_") as carpeta:
+        proceso = iniciar_servidor(args, puerto, puerto_puente, puerto_ia, carpeta)
+        conector = aiohttp.TCPConnector(limit=args.concurrencia + 10)
+        async with aiohttp.ClientSession(connector=conector, timeout=aiohttp.ClientTimeout(total=args.timeout)) as http:
+            try:
+                await esperar_servidor(http, url, proceso)
+                print(f"🚀 {args.usuarios} usuarios, {args.concurrencia} simultáneos, "
+                      f"{int(args.imagenes * 100)}% con foto, IA {args.latencia_ia}s/{int(args.error_ia * 100)}% error")
+
+                resultados = Resultados()
+                fin = asyncio.Event()
+                muestreo = asyncio.create_task(muestrear_loop(http, url, resultados, fin))
+                semaforo = asyncio.Semaphore(args.concurrencia)
+
+                async def con_cupo(indice: int):
+                    async with semaforo:
+                        await simular_usuario(indice, http, url, simuladores, resultados, args)
+
+                inicio = time.monotonic()
+                await asyncio.gather(*(con_cupo(i) for i in range(args.usuarios)))
+                duracion = time.monotonic() - inicio
+                fin.set()
+                await muestreo
+
+                async with http.get(f"{url}/health") as resp:
+                    salud = await resp.json()
+                return resumen(resultados, duracion, simuladores, salud)
+            finally:
+                proceso.terminate()
+                try:
+                    proceso.wait(timeout=15)
+                except subprocess.TimeoutExpired:
+                    proceso.kill()
+                await simuladores.detener()
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Prueba de carga del servidor de tickets")
+    parser.add_argument("--usuarios", type=int, default=500, help="conversaciones a simular")
+    parser.add_argument("--concurrencia", type=int, default=100, help="usuarios conversando a la vez")
+    parser.add_argument("--imagenes", type=float, default=0.2, help="fracción de usuarios que envían foto")
+    parser.add_argument("--tamano-imagen", type=int, default=200, help="tamaño de la foto en KB")
+    parser.add_argument("--pausa", type=float, default=0.0, help="segundos entre mensajes de un usuario")
+    parser.add_argument("--latencia-ia", type=float, default=0.8, help="latencia media de DeepSeek (s)")
+    parser.add_argument("--error-ia", type=float, default=0.0, help="fracción de llamadas a DeepSeek que fallan")
+    parser.add_argument("--sin-tecnico", type=float, default=0.5,
+                        help="fracción de diagnósticos que no requieren técnico (agrega el paso DIAGNOSTICO)")
+    parser.add_argument("--latencia-puente", type=float, default=0.02, help="latencia media del puente (s)")
+    parser.add_argument("--error-puente", type=float, default=0.0, help="fracción de envíos al puente que fallan")
+    parser.add_argument("--con-cache", action="store_true", help="mantener la caché de diagnósticos")
+    parser.add_argument("--timeout", type=float, default=60, help="espera máxima por respuesta (s)")
+    parser.add_argument("--semilla", type=int, default=1)
+    parser.add_argument("--json", help="guardar el reporte en este archivo")
+    parser.add_argument("--max-p95", type=float, help="falla (código 1) si el p95 punta a punta supera estos segundos")
+    parser.add_argument("--verbose", action="store_true", help="mostrar la salida del servidor")
+    args = parser.parse_args()
+
+    reporte = asyncio.run(ejecutar(args))
+    imprimir(reporte)
+    if args.json:
+        with open(args.json, "w", encoding="utf-8") as f:
+            json.dump(reporte, f, ensure_ascii=False, indent=2)
+        print(f"\n💾 Reporte guardado en {args.json}")
+
+    if args.max_p95 is not None and reporte["punta_a_punta"]["p95_ms"] > args.max_p95 * 1000:
+        print(f"\n❌ p95 {reporte['punta_a_punta']['p95_ms']} ms supera el límite de {args.max_p95 * 1000:.0f} ms")
+        sys.exit(1)
@@ -1,20 +1,49 @@
-from fastapi import FastAPI, BackgroundTasks, HTTPException, Header
+from fastapi import FastAPI, HTTPException, Header, Query, Request
 from fastapi.middleware.cors import CORSMiddleware
-from fastapi.responses import FileResponse, JSONResponse
-from fastapi.staticfiles import StaticFiles
+from fastapi.responses import FileResponse, JSONResponse, ORJSONResponse, Response, StreamingResponse
 from pydantic import BaseModel
 import sqlite3
 import datetime
-import requests
 import os
 import base64
+import contextvars
+import bisect
+import codecs
+import csv
+import io
 import logging
 import json
 import asyncio
 import aiohttp
-from typing import Optional
+import functools
+import gzip
+import heapq
+import html
+import hashlib
+import queue
+import re
+import sys
+import threading
+import time
+import unicodedata
+import zlib
+from collections import OrderedDict, deque
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import asynccontextmanager, contextmanager
+from typing import Callable, Optional
+from urllib.parse import unquote
 from dotenv import load_dotenv
 
+try:
+    import fcntl  # locks entre procesos (no existe en Windows, donde se corre un solo worker)
+except ImportError:
+    fcntl = None
+
+try:
+    import orjson  # opcional: serializa JSON varias veces más rápido que json
+except ImportError:
+    orjson = None
+
 load_dotenv()
 
 # --- CONFIGURACIÓN DE LOGGING ---
@@ -24,7 +53,10 @@ logging.basicConfig(
 )
 logger = logging.getLogger(__name__)
 
-app = FastAPI(title="Sistema de Tickets WhatsApp")
+# Respuestas JSON compactas; con orjson además se serializan mucho más rápido
+RespuestaJSON = ORJSONResponse if orjson else JSONResponse
+
+app = FastAPI(title="Sistema de Tickets WhatsApp", default_response_class=RespuestaJSON)
 
 # --- CONFIGURACIÓN DESDE VARIABLES DE ENTORNO ---
 IP_LAPTOP = os.getenv("IP_LAPTOP", "172.16.12.100")
@@ -32,11 +64,53 @@ PUERTO_LAPTOP = os.getenv("PUERTO_LAPTOP", "9000")
 API_TOKEN = os.getenv("API_TOKEN", "cambiar-en-produccion")
 CARPETA_FOTOS = os.getenv("CARPETA_FOTOS", "fotos_evidencia")
 CARPETA_LOGS = os.getenv("CARPETA_LOGS", "logs_conversaciones")
+LOGS_MODO = os.getenv("LOGS_MODO", "archivos")  # archivos (AAAA/MM/DD) o segmentos (gzip diario)
+LOGS_RETENCION_DIAS = int(os.getenv("LOGS_RETENCION_DIAS", "0"))  # 0 = conservar siempre
+LOGS_COMPACTAR_DIAS = int(os.getenv("LOGS_COMPACTAR_DIAS", "0"))  # 0 = no compactar
 MAX_IMAGE_SIZE = int(os.getenv("MAX_IMAGE_SIZE", "16000000"))  # 16MB por defecto
 DEEPSEEK_API_KEY = os.getenv("DEEPSEEK_API_KEY", "")
 DEEPSEEK_MODEL = os.getenv("DEEPSEEK_MODEL", "deepseek-chat")
+DEEPSEEK_BASE_URL = os.getenv("DEEPSEEK_BASE_URL", "https://api.deepseek.com/v1")
 DEEPSEEK_MAX_TOKENS = int(os.getenv("DEEPSEEK_MAX_TOKENS", "2000"))
+DEEPSEEK_MAX_CONCURRENCIA = int(os.getenv("DEEPSEEK_MAX_CONCURRENCIA", "4"))
+DEEPSEEK_TIMEOUT_SECONDS = float(os.getenv("DEEPSEEK_TIMEOUT_SECONDS", "10"))
+DEEPSEEK_LENTO_SECONDS = float(os.getenv("DEEPSEEK_LENTO_SECONDS", "8"))
+DEEPSEEK_CIRCUITO_FALLOS = int(os.getenv("DEEPSEEK_CIRCUITO_FALLOS", "5"))
+DEEPSEEK_CIRCUITO_APERTURA_SECONDS = float(os.getenv("DEEPSEEK_CIRCUITO_APERTURA_SECONDS", "30"))
+DIAGNOSTICO_ACUSE_SECONDS = float(os.getenv("DIAGNOSTICO_ACUSE_SECONDS", "1.5"))  # espera antes de enviar "analizando..."
+DIAGNOSTICO_CACHE_MAX = int(os.getenv("DIAGNOSTICO_CACHE_MAX", "1000"))  # 0 desactiva la caché
+DIAGNOSTICO_CACHE_TTL_SECONDS = int(os.getenv("DIAGNOSTICO_CACHE_TTL_SECONDS", "86400"))
+DIAGNOSTICO_CACHE_PERSISTENTE = os.getenv("DIAGNOSTICO_CACHE_PERSISTENTE", "true").lower() in ("1", "true", "si", "sí")
 SESSION_TIMEOUT_MINUTES = int(os.getenv("SESSION_TIMEOUT_MINUTES", "15"))
+SESSION_BACKEND = os.getenv("SESSION_BACKEND", "sqlite")  # sqlite, redis o memoria
+REDIS_URL = os.getenv("REDIS_URL", "redis://localhost:6379/0")
+SESSION_AVISO_EXPIRACION = os.getenv("SESSION_AVISO_EXPIRACION", "true").lower() in ("1", "true", "si", "sí")
+DB_PATH = os.getenv("DB_PATH", "tickets.db")
+DB_POOL_SIZE = int(os.getenv("DB_POOL_SIZE", "4"))
+ESCRITURA_VENTANA_MS = float(os.getenv("ESCRITURA_VENTANA_MS", "2"))
+ESCRITURA_MAX_LOTE = int(os.getenv("ESCRITURA_MAX_LOTE", "200"))
+TRAZAS_LENTA_MS = float(os.getenv("TRAZAS_LENTA_MS", "3000"))  # mensajes más lentos se registran con su desglose
+TRAZAS_MAX = int(os.getenv("TRAZAS_MAX", "200"))  # trazas recientes consultables en /debug/trazas
+SQL_LENTA_MS = float(os.getenv("SQL_LENTA_MS", "200"))
+PERFILADOR_HABILITADO = os.getenv("PERFILADOR_HABILITADO", "false").lower() in ("1", "true", "si", "sí")
+TICKETS_MAX_LIMIT = int(os.getenv("TICKETS_MAX_LIMIT", "500"))
+IMPORTACION_LOTE = int(os.getenv("IMPORTACION_LOTE", "2000"))  # tickets por transacción en /import
+COMPRESION_MIN_BYTES = int(os.getenv("COMPRESION_MIN_BYTES", "1024"))  # 0 desactiva la compresión de textos
+COMPACTACION_AL_INICIAR = os.getenv("COMPACTACION_AL_INICIAR", "false").lower() in ("1", "true", "si", "sí")
+SSE_HEARTBEAT_SECONDS = int(os.getenv("SSE_HEARTBEAT_SECONDS", "15"))
+BRIDGE_TIMEOUT_SECONDS = int(os.getenv("BRIDGE_TIMEOUT_SECONDS", "5"))
+BRIDGE_MAX_CONEXIONES = int(os.getenv("BRIDGE_MAX_CONEXIONES", "10"))
+SALIENTES_CONCURRENCIA = int(os.getenv("SALIENTES_CONCURRENCIA", "4"))
+SALIENTES_MAX_INTENTOS = int(os.getenv("SALIENTES_MAX_INTENTOS", "8"))
+SALIENTES_BACKOFF_BASE = float(os.getenv("SALIENTES_BACKOFF_BASE", "2"))
+SALIENTES_BACKOFF_MAX = float(os.getenv("SALIENTES_BACKOFF_MAX", "300"))
+ENTRANTES_CONCURRENCIA = int(os.getenv("ENTRANTES_CONCURRENCIA", "16"))
+ENTRANTES_MAX_PENDIENTES = int(os.getenv("ENTRANTES_MAX_PENDIENTES", "1000"))
+ENTRANTES_MAX_POR_REMITENTE = int(os.getenv("ENTRANTES_MAX_POR_REMITENTE", "20"))
+ENTRANTES_RESERVA_SECONDS = float(os.getenv("ENTRANTES_RESERVA_SECONDS", "60"))
+ENTRANTES_RETENCION_HORAS = float(os.getenv("ENTRANTES_RETENCION_HORAS", "72"))
+MINIATURAS_MAX_MB = float(os.getenv("MINIATURAS_MAX_MB", "500"))  # espacio para variantes; las menos usadas se borran
+MINIATURAS_HILOS = int(os.getenv("MINIATURAS_HILOS", "2"))
 
 if not os.path.exists(CARPETA_FOTOS):
     os.makedirs(CARPETA_FOTOS)
@@ -53,8 +127,6 @@ app.add_middleware(
     allow_headers=["*"]
 )
 
-app.mount("/fotos", StaticFiles(directory=CARPETA_FOTOS), name="fotos")
-
 # --- UTILIDADES ---
 def limpiar_numero_telefono(numero: str) -> str:
     """
@@ -75,656 +147,4665 @@ def limpiar_numero_telefono(numero: str) -> str:
     
     return numero
 
-# --- BASE DE DATOS ---
-def init_db():
-    conn = sqlite3.connect('tickets.db')
-    cursor = conn.cursor()
-    cursor.execute('''
-        CREATE TABLE IF NOT EXISTS tickets (
-            id INTEGER PRIMARY KEY AUTOINCREMENT,
-            cliente TEXT,
-            descripcion TEXT,
-            estado TEXT,
-            categoria TEXT,
-            fecha TEXT,
-            foto_path TEXT,
-            nombre_usuario TEXT,
-            departamento TEXT,
-            tipo_equipo TEXT,
-            numero_activo TEXT,
-            falla_detallada TEXT,
-            diagnostico_ia TEXT,
-            requiere_tecnico INTEGER,
-            estado_conversacion TEXT,
-            historial_conversacion TEXT,
-            log_file_path TEXT
-        )
-    ''')
-
-    # Agregar columnas nuevas si no existen (migración para BD existentes)
-    cursor.execute("PRAGMA table_info(tickets)")
-    columnas_existentes = [col[1] for col in cursor.fetchall()]
-
-    columnas_nuevas = {
-        'nombre_usuario': 'TEXT',
-        'departamento': 'TEXT',
-        'tipo_equipo': 'TEXT',
-        'numero_activo': 'TEXT',
-        'falla_detallada': 'TEXT',
-        'diagnostico_ia': 'TEXT',
-        'requiere_tecnico': 'INTEGER',
-        'estado_conversacion': 'TEXT',
-        'historial_conversacion': 'TEXT',
-        'log_file_path': 'TEXT'
-    }
-
-    for columna, tipo in columnas_nuevas.items():
-        if columna not in columnas_existentes:
-            try:
-                cursor.execute(f'ALTER TABLE tickets ADD COLUMN {columna} {tipo}')
-                logger.info(f"Columna {columna} agregada a la tabla tickets")
-            except sqlite3.OperationalError as e:
-                logger.warning(f"Columna {columna} ya existe: {e}")
+# --- MÉTRICAS ---
+BUCKETS_LATENCIA = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30)
 
-    conn.commit()
-    conn.close()
 
-init_db()
+def _etiquetas_prometheus(nombres: tuple, valores: tuple) -> str:
+    if not nombres:
+        return ""
+    pares = []
+    for nombre, valor in zip(nombres, valores):
+        valor = str(valor).replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")
+        pares.append(f'{nombre}="{valor}"')
+    return "{" + ",".join(pares) + "}"
 
-class MensajeWA(BaseModel):
-    remitente: str
-    contenido: str
-    imagen: Optional[str] = None
 
-class MensajeTecnico(BaseModel):
-    mensaje: str
+class Contador:
+    """Contador monótono con etiquetas (formato de texto de Prometheus)"""
+    tipo = "counter"
 
-# --- CLASES DE CONVERSACIÓN ---
-class ConversationSession:
-    ESTADOS = ["INICIO", "NOMBRE", "DEPTO", "EQUIPO", "ACTIVO", "FALLA", "DIAGNOSTICO", "FINALIZADO"]
+    def __init__(self, nombre: str, ayuda: str, etiquetas: tuple = ()):
+        self.nombre = nombre
+        self.ayuda = ayuda
+        self.etiquetas = etiquetas
+        self._valores = {}
+        self._lock = threading.Lock()
 
-    def __init__(self, remitente: str):
-        self.remitente = remitente
-        self.estado = "INICIO"
-        self.datos = {}
-        self.historial = []
-        self.ultimo_mensaje = datetime.datetime.now()
-        self.ticket_id = None
+    def inc(self, cantidad: float = 1, **etiquetas):
+        clave = tuple(etiquetas.get(e, "") for e in self.etiquetas)
+        with self._lock:
+            self._valores[clave] = self._valores.get(clave, 0) + cantidad
 
-    def esta_expirada(self, timeout_minutes: int = 15) -> bool:
-        delta = datetime.datetime.now() - self.ultimo_mensaje
-        return delta.total_seconds() > (timeout_minutes * 60)
+    def exponer(self) -> list:
+        with self._lock:
+            valores = list(self._valores.items())
+        return [f"{self.nombre}{_etiquetas_prometheus(self.etiquetas, clave)} {valor}" for clave, valor in valores]
 
 
-class ConversationManager:
+class Histograma:
+    """
+    Histograma acumulativo con buckets fijos. Se puede observar desde los hilos
+    del pool de SQLite, por eso cada observación toma un lock (es O(buckets)).
+    """
+    tipo = "histogram"
+
+    def __init__(self, nombre: str, ayuda: str, etiquetas: tuple = (), buckets: tuple = BUCKETS_LATENCIA):
+        self.nombre = nombre
+        self.ayuda = ayuda
+        self.etiquetas = etiquetas
+        self.buckets = buckets
+        self._series = {}  # etiquetas -> [conteos por bucket..., +Inf, suma]
+        self._lock = threading.Lock()
+
+    def observar(self, valor: float, **etiquetas):
+        clave = tuple(etiquetas.get(e, "") for e in self.etiquetas)
+        indice = bisect.bisect_left(self.buckets, valor)
+        with self._lock:
+            serie = self._series.get(clave)
+            if serie is None:
+                serie = self._series[clave] = [0] * (len(self.buckets) + 2)
+            serie[indice] += 1
+            serie[-1] += valor
+
+    @contextmanager
+    def medir(self, **etiquetas):
+        inicio = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observar(time.perf_counter() - inicio, **etiquetas)
+
+    def exponer(self) -> list:
+        with self._lock:
+            series = [(clave, list(serie)) for clave, serie in self._series.items()]
+        lineas = []
+        nombres = self.etiquetas + ("le",)
+        for clave, serie in series:
+            acumulado = 0
+            for limite, conteo in zip(self.buckets + ("+Inf",), serie[:-1]):
+                acumulado += conteo
+                lineas.append(f"{self.nombre}_bucket{_etiquetas_prometheus(nombres, clave + (limite,))} {acumulado}")
+            etiquetas = _etiquetas_prometheus(self.etiquetas, clave)
+            lineas.append(f"{self.nombre}_sum{etiquetas} {serie[-1]}")
+            lineas.append(f"{self.nombre}_count{etiquetas} {acumulado}")
+        return lineas
+
+
+class RegistroMetricas:
+    """
+    Métricas del proceso para /metrics. Contadores e histogramas se actualizan
+    en el camino de cada petición; los valores que ya llevan los componentes
+    (colas, sesiones, stats) se leen con recolectores solo al exponer.
+    """
+
     def __init__(self):
-        self.sesiones = {}
+        self._metricas = []
+        self._recolectores = []
 
-    def get_session(self, remitente: str) -> Optional[ConversationSession]:
-        if remitente in self.sesiones:
-            sesion = self.sesiones[remitente]
-            if sesion.esta_expirada(SESSION_TIMEOUT_MINUTES):
-                logger.info(f"Sesión expirada para {remitente}")
-                del self.sesiones[remitente]
-                return None
-            return sesion
-        return None
+    def contador(self, nombre: str, ayuda: str, etiquetas: tuple = ()) -> Contador:
+        metrica = Contador(nombre, ayuda, etiquetas)
+        self._metricas.append(metrica)
+        return metrica
 
-    def create_session(self, remitente: str) -> ConversationSession:
-        sesion = ConversationSession(remitente)
-        self.sesiones[remitente] = sesion
-        logger.info(f"Nueva sesión creada para {remitente}")
-        return sesion
+    def histograma(self, nombre: str, ayuda: str, etiquetas: tuple = (),
+                   buckets: tuple = BUCKETS_LATENCIA) -> Histograma:
+        metrica = Histograma(nombre, ayuda, etiquetas, buckets)
+        self._metricas.append(metrica)
+        return metrica
 
-    def end_session(self, remitente: str):
-        if remitente in self.sesiones:
-            del self.sesiones[remitente]
-            logger.info(f"Sesión finalizada para {remitente}")
+    def recolector(self, fn: Callable):
+        """fn() -> [(nombre, tipo, ayuda, [(dict de etiquetas, valor)])]"""
+        self._recolectores.append(fn)
+        return fn
 
-    def cleanup_expired_sessions(self, timeout_minutes: int = 15):
-        remitentes_expirados = []
-        for remitente, sesion in self.sesiones.items():
-            if sesion.esta_expirada(timeout_minutes):
-                remitentes_expirados.append(remitente)
+    def exponer(self) -> str:
+        lineas = []
+        for metrica in self._metricas:
+            lineas.append(f"# HELP {metrica.nombre} {metrica.ayuda}")
+            lineas.append(f"# TYPE {metrica.nombre} {metrica.tipo}")
+            lineas.extend(metrica.exponer())
+        for recolector in self._recolectores:
+            try:
+                familias = recolector()
+            except Exception as e:
+                logger.warning(f"Error en recolector de métricas {recolector.__name__}: {e}")
+                continue
+            for nombre, tipo, ayuda, muestras in familias:
+                lineas.append(f"# HELP {nombre} {ayuda}")
+                lineas.append(f"# TYPE {nombre} {tipo}")
+                for etiquetas, valor in muestras:
+                    nombres = tuple(etiquetas)
+                    lineas.append(
+                        f"{nombre}{_etiquetas_prometheus(nombres, tuple(etiquetas[n] for n in nombres))} {valor}"
+                    )
+        return "\n".join(lineas) + "\n"
 
-        for remitente in remitentes_expirados:
-            logger.warning(f"Sesión expirada y limpiada: {remitente}")
-            del self.sesiones[remitente]
 
+metricas = RegistroMetricas()
+METRICA_HTTP = metricas.histograma(
+    "tickets_http_request_seconds", "Tiempo de respuesta HTTP por ruta", ("metodo", "ruta", "codigo"))
+METRICA_SQLITE = metricas.histograma(
+    "tickets_sqlite_query_seconds", "Tiempo de cada operación en SQLite (con la conexión tomada)", ("operacion",))
+METRICA_SQLITE_ESPERA = metricas.histograma(
+    "tickets_sqlite_pool_wait_seconds", "Espera por una conexión libre del pool")
+METRICA_LOTE_ESCRITURA = metricas.histograma(
+    "tickets_escritor_lote_tamano", "Escrituras aplicadas por commit agrupado",
+    buckets=(1, 2, 5, 10, 20, 50, 100, 200, 500))
+METRICA_IMAGEN = metricas.histograma(
+    "tickets_imagen_seconds", "Decodificación, escritura a disco y variantes de imágenes recibidas", ("etapa",))
+METRICA_DEEPSEEK = metricas.histograma(
+    "tickets_deepseek_request_seconds", "Latencia de las llamadas a DeepSeek por resultado", ("resultado",))
+METRICA_PUENTE = metricas.histograma(
+    "tickets_bridge_send_seconds", "Latencia de los envíos al puente de WhatsApp por resultado", ("resultado",))
 
-# --- CLIENTE DEEPSEEK ---
-class DeepSeekClient:
-    def __init__(self, api_key: str, model: str = "deepseek-chat"):
-        self.api_key = api_key
-        self.model = model
-        self.base_url = "https://api.deepseek.com/v1"
 
-    async def diagnosticar_problema(self, tipo_equipo: str, falla_desc: str, historial: list) -> dict:
-        """Analiza el problema y sugiere soluciones usando DeepSeek"""
-        if not self.api_key:
-            logger.warning("API Key de DeepSeek no configurada")
-            return {
-                "analisis": "No se pudo realizar análisis (API no configurada)",
-                "sugerencias": "Por favor, contacta al soporte técnico.",
-                "requiere_tecnico": True
-            }
+@functools.lru_cache(maxsize=512)
+def etiqueta_sql(sql: str) -> str:
+    """Etiqueta corta de una consulta para métricas: "select tickets", "update sesiones"..."""
+    verbo = re.match(r"\s*(\w+)", sql)
+    tabla = re.search(r"\b(?:FROM|INTO|UPDATE)\s+(\w+)", sql, re.IGNORECASE)
+    return " ".join(p.group(1).lower() for p in (verbo, tabla) if p) or "sql"
 
-        sistema_prompt = f"""Eres un asistente de soporte técnico experto. Un usuario reporta un problema en su equipo.
 
-EQUIPAMIENTO: {tipo_equipo}
-DESCRIPCIÓN DE LA FALLA: {falla_desc}
+def _operacion_sqlite(fn: Callable) -> str:
+    etiqueta = getattr(fn, "operacion", None)
+    if etiqueta:
+        return etiqueta
+    return getattr(fn, "__qualname__", "sql").replace(".<locals>", "")
 
-Analiza el problema y:
-1. Proporciona 2-3 pasos de diagnóstico que el usuario puede seguir
-2. Determina si es probable que requiera intervención técnica presencial
-3. Sé conciso pero profesional
 
-Responde en formato JSON con estructura:
-{{"pasos": ["paso 1", "paso 2", "paso 3"], "requiere_tecnico": true/false, "urgencia": "alta"/"media"/"baja"}}"""
+# --- TRAZAS ---
+_traza_actual: contextvars.ContextVar = contextvars.ContextVar("traza_actual", default=None)
 
-        try:
-            async with aiohttp.ClientSession() as session:
-                async with session.post(
-                    f"{self.base_url}/chat/completions",
-                    headers={
-                        "Authorization": f"Bearer {self.api_key}",
-                        "Content-Type": "application/json"
-                    },
-                    json={
-                        "model": self.model,
-                        "messages": [
-                            {"role": "system", "content": sistema_prompt},
-                            {"role": "user", "content": "Analiza el problema"}
-                        ],
-                        "max_tokens": DEEPSEEK_MAX_TOKENS,
-                        "temperature": 0.7
-                    },
-                    timeout=aiohttp.ClientTimeout(total=10)
-                ) as resp:
-                    if resp.status != 200:
-                        logger.error(f"Error DeepSeek: {resp.status}")
-                        return {
-                            "analisis": "Error al conectar con el servicio de IA",
-                            "sugerencias": "Por favor, intenta nuevamente",
-                            "requiere_tecnico": True
-                        }
-
-                    data = await resp.json()
-                    respuesta = data['choices'][0]['message']['content']
 
-                    try:
-                        resultado = json.loads(respuesta)
-                        pasos = "\n".join([f"• {paso}" for paso in resultado.get("pasos", [])])
-                        requiere_tecnico = resultado.get("requiere_tecnico", True)
-
-                        return {
-                            "analisis": f"Pasos de diagnóstico:\n{pasos}",
-                            "sugerencias": f"Pasos de diagnóstico:\n{pasos}",
-                            "requiere_tecnico": requiere_tecnico
-                        }
-                    except json.JSONDecodeError:
-                        # Si no es JSON válido, parsear la respuesta como texto
-                        return {
-                            "analisis": respuesta,
-                            "sugerencias": respuesta,
-                            "requiere_tecnico": True
-                        }
+class Traza:
+    """Recorrido de un mensaje entrante: tramos cronometrados desde el webhook hasta la respuesta"""
+    __slots__ = ("id", "remitente", "fecha", "inicio", "encolado", "tramos", "duracion")
 
-        except Exception as e:
-            logger.error(f"Error en DeepSeek: {str(e)}")
-            return {
-                "analisis": f"Error: {str(e)}",
-                "sugerencias": "Por favor, contacta al soporte técnico.",
-                "requiere_tecnico": True
-            }
+    def __init__(self, remitente: str):
+        self.id = os.urandom(8).hex()
+        self.remitente = remitente
+        self.fecha = time.time()
+        self.inicio = time.perf_counter()
+        self.encolado: Optional[float] = None
+        self.tramos = []  # (nombre, desde el inicio en s, duración en s)
+        self.duracion: Optional[float] = None
 
+    def a_dict(self) -> dict:
+        return {
+            "id": self.id,
+            "remitente": self.remitente,
+            "fecha": datetime.datetime.fromtimestamp(self.fecha).isoformat(timespec="milliseconds"),
+            "duracion_ms": round(self.duracion * 1000, 1) if self.duracion is not None else None,
+            "tramos": [
+                {"nombre": nombre, "inicio_ms": round(desde * 1000, 1), "duracion_ms": round(duracion * 1000, 1)}
+                for nombre, desde, duracion in self.tramos
+            ]
+        }
 
-def verificar_token(authorization: str = Header(...)):
-    """Middleware para verificar el token de autenticación"""
-    token = authorization.replace("Bearer ", "")
-    if token != API_TOKEN:
-        logger.warning(f"Intento de acceso no autorizado con token inválido")
-        raise HTTPException(status_code=401, detail="No autorizado")
-    return True
 
-# --- INSTANCIAS GLOBALES ---
-conversation_manager = ConversationManager()
-deepseek_client = DeepSeekClient(DEEPSEEK_API_KEY) if DEEPSEEK_API_KEY else None
+class Tracer:
+    """
+    Trazas por mensaje entrante en una contextvar: el webhook la crea, viaja con
+    el mensaje a la cola del remitente y cada etapa (sesión, SQLite, DeepSeek,
+    puente, logs) agrega un tramo. Sin traza activa un tramo no cuesta más que
+    leer la contextvar. Las trazas que superan `umbral_lento` se registran en el
+    log con su desglose y las últimas `max_trazas` quedan en /debug/trazas.
+    """
 
-# --- FUNCIONES AUXILIARES ---
-def guardar_log_conversacion(ticket_id: int, sesion: ConversationSession) -> str:
-    """Guarda el historial de conversación en un archivo .log"""
-    os.makedirs(CARPETA_LOGS, exist_ok=True)
+    def __init__(self, umbral_lento: float = 2.0, umbral_sql: float = 0.2, max_trazas: int = 200):
+        self.umbral_lento = umbral_lento
+        self.umbral_sql = umbral_sql
+        self._recientes = deque(maxlen=max_trazas)
+        self._lentas = deque(maxlen=max_trazas)
 
-    filename = f"ticket_{ticket_id:03d}_{datetime.datetime.now().strftime('%Y%m%d_%H%M%S')}.log"
-    filepath = os.path.join(CARPETA_LOGS, filename)
+    @staticmethod
+    def actual() -> Optional[Traza]:
+        return _traza_actual.get()
 
-    with open(filepath, 'w', encoding='utf-8') as f:
-        for msg in sesion.historial:
-            role = "USUARIO" if msg['role'] == 'user' else "SISTEMA"
-            timestamp = msg.get('timestamp', datetime.datetime.now().isoformat())
-            f.write(f"[{timestamp}] {role}: {msg['content']}\n")
-
-    logger.info(f"Log guardado: {filepath}")
-    return filename
-
-
-def guardar_ticket(sesion: ConversationSession) -> int:
-    """Guarda el ticket completo en la BD"""
-    conn = sqlite3.connect('tickets.db')
-    cursor = conn.cursor()
-
-    historial_json = json.dumps(sesion.historial, ensure_ascii=False, indent=2)
-
-    cursor.execute('''
-        INSERT INTO tickets (
-            cliente, nombre_usuario, departamento, tipo_equipo, numero_activo,
-            descripcion, falla_detallada, estado, categoria, fecha, estado_conversacion,
-            diagnostico_ia, requiere_tecnico, historial_conversacion
-        ) VALUES (?,?,?,?,?,?,?,?,?,?,?,?,?,?)
-    ''', (
-        limpiar_numero_telefono(sesion.remitente),
-        sesion.datos.get('nombre', ''),
-        sesion.datos.get('departamento', ''),
-        sesion.datos.get('tipo_equipo', ''),
-        sesion.datos.get('numero_activo', ''),
-        sesion.datos.get('falla', '')[:500],  # Resumen en descripcion
-        sesion.datos.get('falla', ''),
-        'Pendiente',
-        sesion.datos.get('categoria', 'Soporte General'),
-        datetime.datetime.now().strftime("%Y-%m-%d %H:%M"),
-        'completo',
-        sesion.datos.get('diagnostico', ''),
-        1 if sesion.datos.get('requiere_tecnico', False) else 0,
-        historial_json
-    ))
+    def iniciar(self, remitente: str) -> Traza:
+        """Crea una traza y la deja activa en el contexto actual"""
+        traza = Traza(remitente)
+        _traza_actual.set(traza)
+        return traza
+
+    @contextmanager
+    def continuar(self, traza: Traza):
+        token = _traza_actual.set(traza)
+        try:
+            yield traza
+        finally:
+            _traza_actual.reset(token)
 
-    ticket_id = cursor.lastrowid
-    conn.commit()
-    conn.close()
+    @contextmanager
+    def tramo(self, nombre: str):
+        traza = _traza_actual.get()
+        if traza is None:
+            yield
+            return
+        inicio = time.perf_counter()
+        try:
+            yield
+        finally:
+            traza.tramos.append((nombre, inicio - traza.inicio, time.perf_counter() - inicio))
+
+    def registrar(self, nombre: str, inicio: float, duracion: float):
+        """Agrega un tramo ya medido (inicio en perf_counter)"""
+        traza = _traza_actual.get()
+        if traza is not None:
+            traza.tramos.append((nombre, inicio - traza.inicio, duracion))
 
-    return ticket_id
+    def finalizar(self, traza: Traza):
+        traza.duracion = time.perf_counter() - traza.inicio
+        self._recientes.append(traza)
+        if traza.duracion >= self.umbral_lento:
+            self._lentas.append(traza)
+            desglose = ", ".join(
+                f"{nombre} {duracion * 1000:.0f}ms"
+                for nombre, _, duracion in sorted(traza.tramos, key=lambda t: -t[2])[:8]
+            )
+            logger.warning(
+                f"Mensaje lento de {traza.remitente} [traza {traza.id}]: "
+                f"{traza.duracion * 1000:.0f}ms ({desglose})"
+            )
 
+    def sql_lento(self, operacion: str, segundos: float):
+        if segundos >= self.umbral_sql:
+            traza = _traza_actual.get()
+            sufijo = f" [traza {traza.id}]" if traza else ""
+            logger.warning(f"SQL lento: {operacion} {segundos * 1000:.0f}ms{sufijo}")
 
-def categorizar_falla(tipo_equipo: str, falla: str) -> str:
-    """Categoriza la falla según tipo de equipo y descripción"""
-    falla_lower = falla.lower()
+    def buscar(self, remitente: Optional[str] = None, solo_lentas: bool = False, limite: int = 50) -> list:
+        trazas = self._lentas if solo_lentas else self._recientes
+        return [
+            t.a_dict() for t in reversed(trazas)
+            if remitente is None or t.remitente == remitente
+        ][:limite]
 
-    if tipo_equipo.lower() in ['desktop', 'laptop']:
-        if any(x in falla_lower for x in ['pantalla', 'roto', 'monitor']):
-            return "Hardware - Pantalla"
-        elif any(x in falla_lower for x in ['prende', 'bateria', 'poder']):
-            return "Hardware - Energía"
-        elif any(x in falla_lower for x in ['lenta', 'lento', 'virus', 'malware']):
-            return "Software"
-        elif any(x in falla_lower for x in ['internet', 'conexion', 'wifi']):
-            return "Conectividad"
-    elif tipo_equipo.lower() == 'impresora':
-        if any(x in falla_lower for x in ['papel', 'atasco', 'atasca']):
-            return "Hardware - Papel"
-        elif any(x in falla_lower for x in ['no imprime', 'tinta', 'cartucho']):
-            return "Hardware - Consumibles"
 
-    return "Soporte General"
+tracer = Tracer(
+    umbral_lento=TRAZAS_LENTA_MS / 1000,
+    umbral_sql=SQL_LENTA_MS / 1000,
+    max_trazas=TRAZAS_MAX
+)
 
 
-async def enviar_respuesta_whatsapp(numero: str, texto: str):
-    """Envía una respuesta al usuario vía WhatsApp"""
-    try:
-        response = requests.post(
-            f"http://{IP_LAPTOP}:{PUERTO_LAPTOP}/enviar-mensaje",
-            json={"numero": numero, "texto": texto},
-            headers={"Authorization": f"Bearer {API_TOKEN}"},
-            timeout=5
+# --- BASE DE DATOS ---
+class SQLitePool:
+    """
+    Pool acotado de conexiones SQLite.
+    Las consultas se ejecutan en un ThreadPoolExecutor dedicado para no bloquear
+    el event loop; cada conexión usa WAL y cachea sentencias preparadas.
+    """
+
+    def __init__(self, path: str, size: int = 4):
+        self.path = path
+        self.size = size
+        self._libres = queue.LifoQueue(maxsize=size)
+        self._creadas = 0
+        self._lock = threading.Lock()
+        self._executor = ThreadPoolExecutor(max_workers=size, thread_name_prefix="sqlite")
+
+    def _nueva_conexion(self) -> sqlite3.Connection:
+        # isolation_level=None: las transacciones se abren explícitamente con transaccion()
+        conn = sqlite3.connect(
+            self.path,
+            timeout=30,
+            isolation_level=None,
+            check_same_thread=False,
+            cached_statements=256
         )
-        response.raise_for_status()
-        logger.info(f"Respuesta enviada a {numero}")
-    except requests.exceptions.HTTPError as e:
-        if e.response.status_code == 503:
-            logger.warning(f"WhatsApp desconectado, no se pudo enviar mensaje a {numero}")
-        else:
-            logger.error(f"Error HTTP enviando respuesta a {numero}: {e.response.status_code} - {e.response.text}")
-    except Exception as e:
-        logger.error(f"Error enviando respuesta a {numero}: {str(e)}")
+        conn.execute("PRAGMA journal_mode=WAL")
+        conn.execute("PRAGMA synchronous=NORMAL")
+        conn.execute("PRAGMA busy_timeout=5000")
+        conn.execute("PRAGMA temp_store=MEMORY")
+        conn.execute("PRAGMA cache_size=-16000")  # ~16MB por conexión
+        conn.execute("PRAGMA mmap_size=134217728")
+        conn.execute("PRAGMA foreign_keys=ON")
+        return conn
 
+    @contextmanager
+    def conexion(self):
+        """Toma una conexión del pool (o crea una si no se ha alcanzado el límite)"""
+        conn = None
+        try:
+            conn = self._libres.get_nowait()
+        except queue.Empty:
+            with self._lock:
+                if self._creadas < self.size:
+                    self._creadas += 1
+                    crear = True
+                else:
+                    crear = False
+            if crear:
+                try:
+                    conn = self._nueva_conexion()
+                except Exception:
+                    with self._lock:
+                        self._creadas -= 1
+                    raise
+            else:
+                conn = self._libres.get()
+        try:
+            yield conn
+        finally:
+            if conn.in_transaction:
+                conn.rollback()
+            self._libres.put(conn)
 
-# Limpieza periódica de sesiones expiradas
-async def limpiar_sesiones_expiradas():
-    """Ejecutar limpieza cada 5 minutos"""
-    while True:
-        await asyncio.sleep(300)
-        conversation_manager.cleanup_expired_sessions(SESSION_TIMEOUT_MINUTES)
+    def ejecutar_sync(self, fn: Callable, *args):
+        """Ejecuta fn(conn, *args) con una conexión del pool en el hilo actual"""
+        inicio = time.perf_counter()
+        with self.conexion() as conn:
+            obtenida = time.perf_counter()
+            METRICA_SQLITE_ESPERA.observar(obtenida - inicio)
+            try:
+                return fn(conn, *args)
+            finally:
+                duracion = time.perf_counter() - obtenida
+                operacion = _operacion_sqlite(fn)
+                METRICA_SQLITE.observar(duracion, operacion=operacion)
+                tracer.sql_lento(operacion, duracion)
 
+    async def ejecutar(self, fn: Callable, *args):
+        """Ejecuta fn(conn, *args) en el pool de hilos sin bloquear el event loop"""
+        loop = asyncio.get_running_loop()
+        # Copiar el contexto lleva la traza activa al hilo (para el log de SQL lento)
+        llamada = functools.partial(contextvars.copy_context().run, self.ejecutar_sync, fn, *args)
+        if tracer.actual() is None:
+            return await loop.run_in_executor(self._executor, llamada)
+        with tracer.tramo(f"sqlite {_operacion_sqlite(fn)}"):
+            return await loop.run_in_executor(self._executor, llamada)
 
-@app.on_event("startup")
-async def startup_event():
-    asyncio.create_task(limpiar_sesiones_expiradas())
+    async def fetchone(self, sql: str, params: tuple = ()):
+        def consulta(conn):
+            return conn.execute(sql, params).fetchone()
+        consulta.operacion = etiqueta_sql(sql)
+        return await self.ejecutar(consulta)
 
-@app.get("/health")
-async def health():
-    """Endpoint de health check para monitoreo"""
-    try:
-        conn = sqlite3.connect('tickets.db')
-        cursor = conn.cursor()
-        cursor.execute('SELECT COUNT(*) FROM tickets')
-        total_tickets = cursor.fetchone()[0]
-        conn.close()
-        
-        return JSONResponse({
-            "status": "ok",
-            "total_tickets": total_tickets,
-            "laptop_url": f"http://{IP_LAPTOP}:{PUERTO_LAPTOP}",
-            "timestamp": datetime.datetime.now().isoformat()
-        })
-    except Exception as e:
-        logger.error(f"Error en health check: {str(e)}")
-        return JSONResponse(
-            status_code=503,
-            content={"status": "error", "message": str(e)}
-        )
+    async def fetchall(self, sql: str, params: tuple = ()):
+        def consulta(conn):
+            return conn.execute(sql, params).fetchall()
+        consulta.operacion = etiqueta_sql(sql)
+        return await self.ejecutar(consulta)
+
+    def cerrar(self):
+        self._executor.shutdown(wait=True)
+        while True:
+            try:
+                conn = self._libres.get_nowait()
+            except queue.Empty:
+                break
+            # Volcar el WAL al archivo principal para que tickets.db quede completo
+            try:
+                conn.execute("PRAGMA wal_checkpoint(TRUNCATE)")
+            except sqlite3.Error as e:
+                logger.warning(f"No se pudo hacer checkpoint del WAL: {e}")
+            conn.close()
+        with self._lock:
+            self._creadas = 0
 
-@app.post("/webhook")
-async def recibir(data: MensajeWA, bg: BackgroundTasks, authorization: str = Header(None)):
-    # Verificar autenticación
-    if not authorization:
-        logger.warning("Intento de acceso sin token")
-        raise HTTPException(status_code=401, detail="No autorizado - Token faltante")
 
+@contextmanager
+def transaccion(conn: sqlite3.Connection):
+    """Abre una transacción de escritura (BEGIN IMMEDIATE) y hace commit/rollback"""
+    conn.execute("BEGIN IMMEDIATE")
     try:
-        verificar_token(authorization)
-    except HTTPException:
+        yield conn
+    except BaseException:
+        conn.rollback()
         raise
-    except Exception as e:
-        logger.error(f"Error validando token: {str(e)}")
-        raise HTTPException(status_code=401, detail="No autorizado")
+    else:
+        conn.commit()
 
-    # Validar tamaño de imagen
-    if data.imagen:
-        try:
-            img_size = len(base64.b64decode(data.imagen))
-            if img_size > MAX_IMAGE_SIZE:
-                logger.warning(f"Imagen muy grande recibida: {img_size} bytes")
-                raise HTTPException(status_code=413, detail=f"Imagen muy grande. Máximo {MAX_IMAGE_SIZE/1_000_000}MB")
-        except Exception as e:
-            if isinstance(e, HTTPException):
-                raise
-            logger.error(f"Error decodificando imagen: {str(e)}")
-            raise HTTPException(status_code=400, detail="Imagen inválida")
 
-    async def procesar_conversacion():
-        """Maneja la lógica de conversación interactiva"""
-        try:
-            # Verificar si existe sesión activa
-            sesion = conversation_manager.get_session(data.remitente)
+class GroupCommitWriter:
+    """
+    Escritor único con commit agrupado: las escrituras que llegan mientras se
+    aplica el lote anterior (o dentro de `ventana` segundos) se aplican juntas en
+    una sola transacción. Cada una corre en su propio SAVEPOINT, así el fallo de
+    una no deshace las demás. Las funciones reciben `conn` y no abren transacción.
+    """
 
-            respuesta = ""
-            imagen_guardada = None
+    def __init__(self, pool: SQLitePool, ventana: float = 0.002, max_lote: int = 200):
+        self.pool = pool
+        self.ventana = ventana
+        self.max_lote = max_lote
+        self._cola: asyncio.Queue = asyncio.Queue()
+        self._tarea: Optional[asyncio.Task] = None
+        self.stats = {"lotes": 0, "escrituras": 0, "lote_max": 0}
 
-            # Guardar imagen si viene
-            if data.imagen:
+    async def iniciar(self):
+        self._tarea = asyncio.create_task(self._bucle())
+
+    async def detener(self):
+        """Aplica lo que quede en la cola y detiene el escritor"""
+        if self._tarea:
+            self._cola.put_nowait(None)
+            await self._tarea
+            self._tarea = None
+
+    async def ejecutar(self, fn: Callable, *args):
+        """Encola fn(conn, *args) y espera a que su lote haga commit"""
+        if self._tarea is None:
+            # Sin escritor activo (arranque/apagado): transacción propia
+            return await self.pool.ejecutar(self._aplicar_una, fn, args)
+        futuro = asyncio.get_running_loop().create_future()
+        self._cola.put_nowait((fn, args, futuro))
+        if tracer.actual() is None:
+            return await futuro
+        with tracer.tramo(f"escritura {_operacion_sqlite(fn)}"):
+            return await futuro
+
+    @staticmethod
+    def _aplicar_una(conn: sqlite3.Connection, fn: Callable, args: tuple):
+        with transaccion(conn):
+            return fn(conn, *args)
+
+    @staticmethod
+    def _aplicar_lote(conn: sqlite3.Connection, lote: list) -> list:
+        resultados = []
+        with transaccion(conn):
+            for fn, args in lote:
+                conn.execute("SAVEPOINT escritura")
+                inicio = time.perf_counter()
                 try:
-                    nombre = f"img_{datetime.datetime.now().strftime('%Y%m%d_%H%M%S')}.jpg"
-                    path_final = os.path.join(CARPETA_FOTOS, nombre)
-                    with open(path_final, "wb") as f:
-                        f.write(base64.b64decode(data.imagen))
-                    imagen_guardada = nombre
-                    logger.info(f"Imagen guardada: {path_final}")
+                    resultados.append((True, fn(conn, *args)))
                 except Exception as e:
-                    logger.error(f"Error guardando imagen: {str(e)}")
-
-            if not sesion:
-                # NUEVA SESIÓN - INICIO
-                sesion = conversation_manager.create_session(data.remitente)
-                respuesta = "¡Hola! 👋 Soy el asistente de soporte técnico.\n\n¿Cuál es tu nombre completo por favor?"
-                sesion.estado = "NOMBRE"
-
-            elif sesion.estado == "NOMBRE":
-                # Guardar nombre y pedir departamento
-                sesion.datos['nombre'] = data.contenido.strip()
-                respuesta = f"Gracias {sesion.datos['nombre']}. ¿A qué departamento perteneces?"
-                sesion.estado = "DEPTO"
-
-            elif sesion.estado == "DEPTO":
-                # Guardar departamento y pedir tipo de equipo
-                sesion.datos['departamento'] = data.contenido.strip()
-                respuesta = "¿Qué tipo de equipo tiene el problema?\n(Desktop / Laptop / Impresora / Otro)"
-                sesion.estado = "EQUIPO"
-
-            elif sesion.estado == "EQUIPO":
-                # Guardar tipo de equipo y pedir activo
-                sesion.datos['tipo_equipo'] = data.contenido.strip()
-                respuesta = "¿Cuál es el número de activo del equipo? (Suele estar en una etiqueta)"
-                sesion.estado = "ACTIVO"
-
-            elif sesion.estado == "ACTIVO":
-                # Guardar activo y pedir descripción de falla
-                sesion.datos['numero_activo'] = data.contenido.strip()
-                respuesta = "Perfecto. Ahora, describe detalladamente el problema que estás experimentando."
-                sesion.estado = "FALLA"
-
-            elif sesion.estado == "FALLA":
-                # Guardar falla, diagnosticar con IA y crear ticket
-                sesion.datos['falla'] = data.contenido.strip()
-                sesion.datos['categoria'] = categorizar_falla(
-                    sesion.datos.get('tipo_equipo', ''),
-                    sesion.datos['falla']
-                )
+                    conn.execute("ROLLBACK TO escritura")
+                    resultados.append((False, e))
+                finally:
+                    conn.execute("RELEASE escritura")
+                    duracion = time.perf_counter() - inicio
+                    METRICA_SQLITE.observar(duracion, operacion=_operacion_sqlite(fn))
+                    tracer.sql_lento(_operacion_sqlite(fn), duracion)
+        return resultados
 
-                # Llamar a DeepSeek para diagnóstico
-                diagnostico = {}
-                if deepseek_client:
-                    logger.info(f"Solicitando diagnóstico a DeepSeek para {data.remitente}")
-                    diagnostico = await deepseek_client.diagnosticar_problema(
-                        sesion.datos['tipo_equipo'],
-                        sesion.datos['falla'],
-                        sesion.historial
-                    )
+    async def _bucle(self):
+        detener = False
+        while not detener:
+            item = await self._cola.get()
+            if item is None:
+                break
+            if self.ventana:
+                await asyncio.sleep(self.ventana)
+            lote = [item]
+            while len(lote) < self.max_lote:
+                try:
+                    item = self._cola.get_nowait()
+                except asyncio.QueueEmpty:
+                    break
+                if item is None:
+                    detener = True
+                    break
+                lote.append(item)
+
+            self.stats["lotes"] += 1
+            self.stats["escrituras"] += len(lote)
+            METRICA_LOTE_ESCRITURA.observar(len(lote))
+            self.stats["lote_max"] = max(self.stats["lote_max"], len(lote))
+            try:
+                resultados = await self.pool.ejecutar(
+                    self._aplicar_lote, [(fn, args) for fn, args, _ in lote]
+                )
+            except Exception as e:
+                # Falló el commit: ninguna escritura del lote quedó aplicada
+                logger.error(f"Error aplicando lote de {len(lote)} escrituras: {str(e)}")
+                for _, _, futuro in lote:
+                    if not futuro.done():
+                        futuro.set_exception(e)
+                continue
+            for (_, _, futuro), (ok, valor) in zip(lote, resultados):
+                if futuro.done():
+                    continue
+                if ok:
+                    futuro.set_result(valor)
                 else:
-                    diagnostico = {
-                        "analisis": "Análisis de IA no disponible",
-                        "sugerencias": "Por favor contacta al soporte técnico",
-                        "requiere_tecnico": True
-                    }
+                    futuro.set_exception(valor)
 
-                sesion.datos['diagnostico'] = diagnostico.get('sugerencias', '')
-                sesion.datos['requiere_tecnico'] = diagnostico.get('requiere_tecnico', True)
+    def estadisticas(self) -> dict:
+        return {**self.stats, "en_cola": self._cola.qsize()}
 
-                # Construir respuesta
-                respuesta = f"📋 *Análisis del problema:*\n\n{diagnostico.get('sugerencias', 'Error en análisis')}\n\n"
 
-                if sesion.datos['requiere_tecnico']:
-                    respuesta += "Se ha creado un ticket. Un técnico te contactará pronto. ✅"
-                    # Crear ticket inmediatamente
-                    ticket_id = guardar_ticket(sesion)
-                    log_filename = guardar_log_conversacion(ticket_id, sesion)
+db_pool = SQLitePool(DB_PATH, DB_POOL_SIZE)
+escritor = GroupCommitWriter(db_pool, ventana=ESCRITURA_VENTANA_MS / 1000, max_lote=ESCRITURA_MAX_LOTE)
 
-                    conn = sqlite3.connect('tickets.db')
-                    cursor = conn.cursor()
-                    cursor.execute('UPDATE tickets SET log_file_path=?, foto_path=? WHERE id=?',
-                                   (log_filename, imagen_guardada, ticket_id))
-                    conn.commit()
-                    conn.close()
 
-                    conversation_manager.end_session(data.remitente)
-                else:
-                    respuesta += "Intenta estos pasos. Si el problema persiste, responde con 'NO' para hablar con un técnico."
-                    sesion.estado = "DIAGNOSTICO"
-
-            elif sesion.estado == "DIAGNOSTICO":
-                # Usuario indica si necesita técnico o no
-                if "no" in data.contenido.lower() or "no funciona" in data.contenido.lower():
-                    # Crear ticket
-                    ticket_id = guardar_ticket(sesion)
-                    log_filename = guardar_log_conversacion(ticket_id, sesion)
-
-                    conn = sqlite3.connect('tickets.db')
-                    cursor = conn.cursor()
-                    cursor.execute('UPDATE tickets SET log_file_path=?, foto_path=? WHERE id=?',
-                                   (log_filename, imagen_guardada, ticket_id))
-                    conn.commit()
-                    conn.close()
-
-                    respuesta = f"✅ Ticket #{ticket_id} creado. Un técnico se pondrá en contacto pronto."
-                    conversation_manager.end_session(data.remitente)
-                else:
-                    respuesta = "Me alegra haber ayudado. Si necesitas más ayuda en el futuro, solo envíame un mensaje. 😊"
-                    conversation_manager.end_session(data.remitente)
+def _crear_esquema(conn: sqlite3.Connection):
+    with transaccion(conn):
+        conn.execute('''
+            CREATE TABLE IF NOT EXISTS tickets (
+                id INTEGER PRIMARY KEY AUTOINCREMENT,
+                cliente TEXT,
+                descripcion TEXT,
+                estado TEXT,
+                categoria TEXT,
+                fecha TEXT,
+                foto_path TEXT,
+                nombre_usuario TEXT,
+                departamento TEXT,
+                tipo_equipo TEXT,
+                numero_activo TEXT,
+                falla_detallada TEXT,
+                diagnostico_ia TEXT,
+                requiere_tecnico INTEGER,
+                estado_conversacion TEXT,
+                historial_conversacion TEXT,
+                log_file_path TEXT,
+                updated_seq INTEGER,
+                entrada_id INTEGER
+            )
+        ''')
 
-            # Actualizar historial
-            sesion.historial.append({
-                'timestamp': datetime.datetime.now().isoformat(),
-                'role': 'user',
-                'content': data.contenido
-            })
-            sesion.historial.append({
-                'timestamp': datetime.datetime.now().isoformat(),
-                'role': 'assistant',
-                'content': respuesta
-            })
-            sesion.ultimo_mensaje = datetime.datetime.now()
+        # Agregar columnas nuevas si no existen (migración para BD existentes)
+        columnas_existentes = [col[1] for col in conn.execute("PRAGMA table_info(tickets)").fetchall()]
 
-            # Enviar respuesta al usuario
-            await enviar_respuesta_whatsapp(data.remitente, respuesta)
+        columnas_nuevas = {
+            'nombre_usuario': 'TEXT',
+            'departamento': 'TEXT',
+            'tipo_equipo': 'TEXT',
+            'numero_activo': 'TEXT',
+            'falla_detallada': 'TEXT',
+            'diagnostico_ia': 'TEXT',
+            'requiere_tecnico': 'INTEGER',
+            'estado_conversacion': 'TEXT',
+            'historial_conversacion': 'TEXT',
+            'log_file_path': 'TEXT',
+            'updated_seq': 'INTEGER',
+            'entrada_id': 'INTEGER'
+        }
 
-        except Exception as e:
-            logger.error(f"Error en procesamiento de conversación: {str(e)}")
-            await enviar_respuesta_whatsapp(
-                data.remitente,
-                "Disculpa, ocurrió un error. Por favor intenta nuevamente."
+        for columna, tipo in columnas_nuevas.items():
+            if columna not in columnas_existentes:
+                try:
+                    conn.execute(f'ALTER TABLE tickets ADD COLUMN {columna} {tipo}')
+                    logger.info(f"Columna {columna} agregada a la tabla tickets")
+                except sqlite3.OperationalError as e:
+                    logger.warning(f"Columna {columna} ya existe: {e}")
+
+        # Índices para filtros + paginación por id (keyset)
+        conn.execute('CREATE INDEX IF NOT EXISTS idx_tickets_estado ON tickets(estado, id)')
+        conn.execute('CREATE INDEX IF NOT EXISTS idx_tickets_categoria ON tickets(categoria, id)')
+        conn.execute('CREATE INDEX IF NOT EXISTS idx_tickets_departamento ON tickets(departamento, id)')
+        conn.execute('CREATE INDEX IF NOT EXISTS idx_tickets_fecha ON tickets(fecha)')
+        # Un ticket por mensaje de origen: reprocesar un mensaje no duplica el ticket
+        conn.execute('CREATE UNIQUE INDEX IF NOT EXISTS idx_tickets_entrada ON tickets(entrada_id) WHERE entrada_id IS NOT NULL')
+
+        # Versión de cambios: cada INSERT/UPDATE en tickets recibe un updated_seq
+        # monótono, lo que permite a los clientes pedir solo lo que cambió (?since=)
+        conn.execute('''
+            CREATE TABLE IF NOT EXISTS secuencia_cambios (
+                id INTEGER PRIMARY KEY CHECK (id = 1),
+                valor INTEGER NOT NULL
             )
+        ''')
+        conn.execute('UPDATE tickets SET updated_seq = id WHERE updated_seq IS NULL')
+        conn.execute('''
+            INSERT OR IGNORE INTO secuencia_cambios (id, valor)
+            SELECT 1, COALESCE(MAX(updated_seq), 0) FROM tickets
+        ''')
+        conn.execute('CREATE INDEX IF NOT EXISTS idx_tickets_updated_seq ON tickets(updated_seq)')
+        conn.execute('''
+            CREATE TRIGGER IF NOT EXISTS trg_tickets_seq_insert AFTER INSERT ON tickets
+            BEGIN
+                UPDATE secuencia_cambios SET valor = valor + 1 WHERE id = 1;
+                UPDATE tickets SET updated_seq = (SELECT valor FROM secuencia_cambios WHERE id = 1)
+                WHERE id = NEW.id;
+            END
+        ''')
+        conn.execute('''
+            CREATE TRIGGER IF NOT EXISTS trg_tickets_seq_update AFTER UPDATE ON tickets
+            WHEN NEW.updated_seq IS OLD.updated_seq
+            BEGIN
+                UPDATE secuencia_cambios SET valor = valor + 1 WHERE id = 1;
+                UPDATE tickets SET updated_seq = (SELECT valor FROM secuencia_cambios WHERE id = 1)
+                WHERE id = NEW.id;
+            END
+        ''')
 
-    bg.add_task(procesar_conversacion)
-    return {"status": "ok", "mensaje": "Mensaje procesado"}
+        # Caché persistente de diagnósticos de IA (ver DiagnosisCache)
+        conn.execute('''
+            CREATE TABLE IF NOT EXISTS cache_diagnosticos (
+                huella TEXT PRIMARY KEY,
+                tipo_equipo TEXT,
+                falla TEXT,
+                resultado TEXT NOT NULL,
+                creado REAL NOT NULL
+            )
+        ''')
+        conn.execute('CREATE INDEX IF NOT EXISTS idx_cache_diagnosticos_creado ON cache_diagnosticos(creado)')
 
-@app.get("/")
-async def home():
-    return FileResponse('index.html')
+        # Cola persistente de mensajes salientes hacia el puente de WhatsApp
+        conn.execute('''
+            CREATE TABLE IF NOT EXISTS mensajes_salientes (
+                id INTEGER PRIMARY KEY AUTOINCREMENT,
+                numero TEXT NOT NULL,
+                texto TEXT NOT NULL,
+                estado TEXT NOT NULL DEFAULT 'pendiente',
+                intentos INTEGER NOT NULL DEFAULT 0,
+                proximo_intento REAL NOT NULL,
+                ultimo_error TEXT,
+                creado TEXT
+            )
+        ''')
+        conn.execute('CREATE INDEX IF NOT EXISTS idx_salientes_pendientes ON mensajes_salientes(estado, proximo_intento)')
+        conn.execute('CREATE INDEX IF NOT EXISTS idx_salientes_numero ON mensajes_salientes(numero, id)')
+
+        # Mensajes de la conversación, uno por fila (append-only)
+        conn.execute('''
+            CREATE TABLE IF NOT EXISTS ticket_messages (
+                id INTEGER PRIMARY KEY AUTOINCREMENT,
+                ticket_id INTEGER NOT NULL REFERENCES tickets(id),
+                seq INTEGER NOT NULL,
+                role TEXT NOT NULL,
+                content TEXT,
+                timestamp TEXT,
+                UNIQUE (ticket_id, seq)
+            )
+        ''')
+        # Bitácora de mensajes entrantes (deduplicación y reproceso tras una caída)
+        conn.execute('''
+            CREATE TABLE IF NOT EXISTS mensajes_entrantes (
+                id INTEGER PRIMARY KEY AUTOINCREMENT,
+                clave TEXT UNIQUE,
+                remitente TEXT NOT NULL,
+                contenido TEXT,
+                imagen TEXT,
+                estado TEXT NOT NULL DEFAULT 'pendiente',
+                reclamado REAL,
+                recibido REAL NOT NULL,
+                procesado REAL
+            )
+        ''')
+        conn.execute('CREATE INDEX IF NOT EXISTS idx_entrantes_estado ON mensajes_entrantes(estado, reclamado)')
 
+        # Sesiones de conversación activas (compartidas entre workers)
+        conn.execute('''
+            CREATE TABLE IF NOT EXISTS sesiones (
+                remitente TEXT PRIMARY KEY,
+                version INTEGER NOT NULL,
+                datos TEXT NOT NULL,
+                ultimo_mensaje REAL NOT NULL
+            )
+        ''')
+        conn.execute('CREATE INDEX IF NOT EXISTS idx_sesiones_ultimo ON sesiones(ultimo_mensaje)')
 
-@app.get("/tickets")
-async def listar():
-    conn = sqlite3.connect('tickets.db')
-    cursor = conn.cursor()
-    cursor.execute('SELECT * FROM tickets ORDER BY id DESC')
-    rows = cursor.fetchall()
-    conn.close()
-    return {"tickets": rows}
+        conn.execute('''
+            CREATE TRIGGER IF NOT EXISTS trg_ticket_messages_seq AFTER INSERT ON ticket_messages
+            BEGIN
+                UPDATE secuencia_cambios SET valor = valor + 1 WHERE id = 1;
+                UPDATE tickets SET updated_seq = (SELECT valor FROM secuencia_cambios WHERE id = 1)
+                WHERE id = NEW.ticket_id;
+            END
+        ''')
 
+        # Búsqueda de texto completo (FTS5 con contenido externo, mantenida por triggers).
+        # De los mensajes solo se indexan los del usuario y el técnico: los textos
+        # fijos del asistente harían coincidir todos los tickets.
+        fts_nueva = conn.execute("SELECT 1 FROM sqlite_master WHERE name = 'tickets_fts'").fetchone() is None
+        conn.execute(f'''
+            CREATE VIRTUAL TABLE IF NOT EXISTS tickets_fts USING fts5(
+                {", ".join(COLUMNAS_BUSQUEDA)},
+                content='tickets', content_rowid='id', tokenize='unicode61 remove_diacritics 2'
+            )
+        ''')
+        conn.execute('''
+            CREATE VIRTUAL TABLE IF NOT EXISTS mensajes_fts USING fts5(
+                content,
+                content='ticket_messages', content_rowid='id', tokenize='unicode61 remove_diacritics 2'
+            )
+        ''')
+        nuevos = ", ".join(f"NEW.{c}" for c in COLUMNAS_BUSQUEDA)
+        viejos = ", ".join(f"OLD.{c}" for c in COLUMNAS_BUSQUEDA)
+        columnas_fts = ", ".join(COLUMNAS_BUSQUEDA)
+        conn.execute(f'''
+            CREATE TRIGGER IF NOT EXISTS trg_tickets_fts_insert AFTER INSERT ON tickets
+            BEGIN
+                INSERT INTO tickets_fts (rowid, {columnas_fts}) VALUES (NEW.id, {nuevos});
+            END
+        ''')
+        conn.execute(f'''
+            CREATE TRIGGER IF NOT EXISTS trg_tickets_fts_update AFTER UPDATE OF {columnas_fts} ON tickets
+            BEGIN
+                INSERT INTO tickets_fts (tickets_fts, rowid, {columnas_fts}) VALUES ('delete', OLD.id, {viejos});
+                INSERT INTO tickets_fts (rowid, {columnas_fts}) VALUES (NEW.id, {nuevos});
+            END
+        ''')
+        conn.execute(f'''
+            CREATE TRIGGER IF NOT EXISTS trg_tickets_fts_delete AFTER DELETE ON tickets
+            BEGIN
+                INSERT INTO tickets_fts (tickets_fts, rowid, {columnas_fts}) VALUES ('delete', OLD.id, {viejos});
+            END
+        ''')
+        conn.execute('''
+            CREATE TRIGGER IF NOT EXISTS trg_mensajes_fts_insert AFTER INSERT ON ticket_messages
+            WHEN NEW.role != 'assistant'
+            BEGIN
+                INSERT INTO mensajes_fts (rowid, content) VALUES (NEW.id, NEW.content);
+            END
+        ''')
+        conn.execute('''
+            CREATE TRIGGER IF NOT EXISTS trg_mensajes_fts_update AFTER UPDATE OF content ON ticket_messages
+            WHEN OLD.role != 'assistant'
+            BEGIN
+                INSERT INTO mensajes_fts (mensajes_fts, rowid, content) VALUES ('delete', OLD.id, OLD.content);
+                INSERT INTO mensajes_fts (rowid, content) VALUES (NEW.id, NEW.content);
+            END
+        ''')
+        conn.execute('''
+            CREATE TRIGGER IF NOT EXISTS trg_mensajes_fts_delete AFTER DELETE ON ticket_messages
+            WHEN OLD.role != 'assistant'
+            BEGIN
+                INSERT INTO mensajes_fts (mensajes_fts, rowid, content) VALUES ('delete', OLD.id, OLD.content);
+            END
+        ''')
+        if fts_nueva:
+            # Indexar lo que ya existía y fijar los pesos: activo y nombre pesan más que la descripción
+            conn.execute("INSERT INTO tickets_fts (tickets_fts) VALUES ('rebuild')")
+            conn.execute(
+                "INSERT INTO mensajes_fts (rowid, content) "
+                "SELECT id, content FROM ticket_messages WHERE role != 'assistant'"
+            )
+            conn.execute("INSERT INTO tickets_fts (tickets_fts, rank) VALUES ('rank', 'bm25(1.0, 2.0, 1.0, 3.0, 5.0)')")
 
-@app.get("/ticket/{ticket_id}/conversacion")
-async def obtener_conversacion(ticket_id: int):
-    """Retorna el historial de conversación de un ticket"""
-    conn = sqlite3.connect('tickets.db')
-    cursor = conn.cursor()
-    cursor.execute('SELECT historial_conversacion FROM tickets WHERE id=?', (ticket_id,))
-    row = cursor.fetchone()
-    conn.close()
-
-    if not row or not row[0]:
-        raise HTTPException(status_code=404, detail="Conversación no encontrada")
+        # Las conversaciones que siguen en el blob legado no aparecerían en la
+        # búsqueda: se copian una sola vez a ticket_messages (el trigger las
+        # indexa) y PRAGMA user_version marca que ya se hizo. El blob queda
+        # intacto, así una versión anterior del servidor sigue leyéndolo;
+        # vaciarlo es aparte (POST /almacenamiento/compactar?migrar_historial=true)
+        if conn.execute("PRAGMA user_version").fetchone()[0] < ESQUEMA_HISTORIAL_COPIADO:
+            legados = conn.execute(
+                "SELECT id FROM tickets t WHERE historial_conversacion IS NOT NULL AND historial_conversacion != '' "
+                "AND NOT EXISTS (SELECT 1 FROM ticket_messages m WHERE m.ticket_id = t.id)"
+            ).fetchall()
+            copiadas = 0
+            for (ticket_id,) in legados:
+                _migrar_historial_legado(conn, ticket_id)
+                copiadas += _tiene_mensajes(conn, ticket_id)
+            if copiadas:
+                logger.info(f"{copiadas} conversaciones legadas copiadas a ticket_messages para la búsqueda")
+            conn.execute(f"PRAGMA user_version = {ESQUEMA_HISTORIAL_COPIADO}")
+
+        # Reglas del categorizador de fallas (ver FaultCategorizer): una fila por palabra clave
+        reglas_nuevas = conn.execute(
+            "SELECT 1 FROM sqlite_master WHERE name = 'reglas_categoria'"
+        ).fetchone() is None
+        conn.execute('''
+            CREATE TABLE IF NOT EXISTS reglas_categoria (
+                id INTEGER PRIMARY KEY AUTOINCREMENT,
+                categoria TEXT NOT NULL,
+                equipos TEXT NOT NULL DEFAULT '*',
+                palabra TEXT NOT NULL,
+                peso REAL NOT NULL DEFAULT 1
+            )
+        ''')
+        if reglas_nuevas:
+            conn.executemany(
+                'INSERT INTO reglas_categoria (categoria, equipos, palabra) VALUES (?,?,?)',
+                [(categoria, equipos, palabra)
+                 for categoria, equipos, palabras in REGLAS_CATEGORIA_DEFECTO
+                 for palabra in palabras]
+            )
+
+        # Contadores precalculados para /stats y /health, mantenidos por triggers.
+        # dia = '*' es el acumulado global; los demás son por día de creación (fecha).
+        estadisticas_nueva = conn.execute(
+            "SELECT 1 FROM sqlite_master WHERE name = 'estadisticas'"
+        ).fetchone() is None
+        conn.execute('''
+            CREATE TABLE IF NOT EXISTS estadisticas (
+                dimension TEXT NOT NULL,
+                valor TEXT NOT NULL,
+                dia TEXT NOT NULL,
+                total INTEGER NOT NULL DEFAULT 0,
+                PRIMARY KEY (dimension, dia, valor)
+            ) WITHOUT ROWID
+        ''')
+
+        def sumar(fila: str, delta: int) -> str:
+            sentencias = []
+            for dimension, expresion in DIMENSIONES_ESTADISTICAS.items():
+                for dia in ("'*'", _DIA_ESTADISTICAS.format(t=fila)):
+                    sentencias.append(
+                        f"INSERT INTO estadisticas (dimension, valor, dia, total) "
+                        f"VALUES ('{dimension}', {expresion.format(t=fila)}, {dia}, {delta}) "
+                        f"ON CONFLICT (dimension, dia, valor) DO UPDATE SET total = total + ({delta});"
+                    )
+            return "\n".join(sentencias)
+
+        columnas_estadisticas = [c for c in DIMENSIONES_ESTADISTICAS if c != 'total'] + ['fecha']
+        conn.execute(f'''
+            CREATE TRIGGER IF NOT EXISTS trg_tickets_stats_insert AFTER INSERT ON tickets
+            BEGIN
+                {sumar("NEW", 1)}
+            END
+        ''')
+        conn.execute(f'''
+            CREATE TRIGGER IF NOT EXISTS trg_tickets_stats_update
+            AFTER UPDATE OF {", ".join(columnas_estadisticas)} ON tickets
+            WHEN {" OR ".join(f"OLD.{c} IS NOT NEW.{c}" for c in columnas_estadisticas)}
+            BEGIN
+                {sumar("OLD", -1)}
+                {sumar("NEW", 1)}
+            END
+        ''')
+        conn.execute(f'''
+            CREATE TRIGGER IF NOT EXISTS trg_tickets_stats_delete AFTER DELETE ON tickets
+            BEGIN
+                {sumar("OLD", -1)}
+            END
+        ''')
+        if estadisticas_nueva:
+            # Calcular los contadores de los tickets existentes
+            for dimension, expresion in DIMENSIONES_ESTADISTICAS.items():
+                valor = expresion.format(t="tickets")
+                dia = _DIA_ESTADISTICAS.format(t="tickets")
+                conn.execute(
+                    f"INSERT INTO estadisticas (dimension, valor, dia, total) "
+                    f"SELECT '{dimension}', {valor}, '*', COUNT(*) FROM tickets GROUP BY 2"
+                )
+                conn.execute(
+                    f"INSERT INTO estadisticas (dimension, valor, dia, total) "
+                    f"SELECT '{dimension}', {valor}, {dia}, COUNT(*) FROM tickets GROUP BY 2, 3"
+                )
+
+
+# Valor de PRAGMA user_version desde el que los historiales legados ya se copiaron
+ESQUEMA_HISTORIAL_COPIADO = 1
+
+
+def init_db():
+    db_pool.ejecutar_sync(_crear_esquema)
+
+
+def json_compacto(obj) -> str:
+    """JSON sin espacios ni indentación (con orjson si está instalado)"""
+    if orjson:
+        return orjson.dumps(obj).decode("utf-8")
+    return json.dumps(obj, ensure_ascii=False, separators=(",", ":"))
+
+
+def comprimir_texto(texto: Optional[str]):
+    """
+    Los textos de más de COMPRESION_MIN_BYTES se guardan como BLOB zlib. SQLite
+    conserva el tipo de cada valor, así que al leer basta con mirar si llegó
+    bytes o str: no hace falta marca ni migración de las filas existentes.
+    """
+    if not texto or COMPRESION_MIN_BYTES <= 0:
+        return texto
+    datos = texto.encode("utf-8")
+    if len(datos) < COMPRESION_MIN_BYTES:
+        return texto
+    comprimido = zlib.compress(datos, 6)
+    # Si casi no se gana, guardarlo legible
+    return comprimido if len(comprimido) < len(datos) * 0.9 else texto
+
+
+def descomprimir_texto(valor):
+    if isinstance(valor, bytes):
+        return zlib.decompress(valor).decode("utf-8")
+    return valor
+
+
+def bytes_guardados(valor) -> int:
+    """Tamaño en disco de un valor de texto, comprimido o no"""
+    if isinstance(valor, bytes):
+        return len(valor)
+    return len(valor.encode("utf-8")) if valor else 0
 
+
+def _contenido_guardado(role: Optional[str], content: Optional[str]):
+    """
+    Solo se comprimen los mensajes del asistente: los del usuario y el técnico
+    los indexa mensajes_fts, que lee el texto de ticket_messages tal cual.
+    """
+    return comprimir_texto(content) if role == 'assistant' else content
+
+
+def _fila_mensaje(ticket_id: int, seq: int, mensaje: dict) -> tuple:
+    role = mensaje.get('role')
+    return (ticket_id, seq, role, _contenido_guardado(role, mensaje.get('content')), mensaje.get('timestamp'))
+
+
+def _mensaje_de_fila(fila) -> dict:
+    return {"seq": fila[0], "role": fila[1], "content": descomprimir_texto(fila[2]), "timestamp": fila[3]}
+
+
+def _tiene_mensajes(conn: sqlite3.Connection, ticket_id: int) -> bool:
+    return conn.execute(
+        'SELECT 1 FROM ticket_messages WHERE ticket_id=? LIMIT 1', (ticket_id,)
+    ).fetchone() is not None
+
+
+def _decodificar_historial(texto: Optional[str]) -> Optional[list]:
+    """
+    Mensajes (dicts) de un historial JSON legado, numerados desde 1.
+    None si el valor no es JSON o no es una lista; los elementos que no son
+    objetos se descartan.
+    """
+    if not texto:
+        return []
     try:
-        historial = json.loads(row[0])
-        return {"historial": historial}
+        historial = json.loads(texto)
     except json.JSONDecodeError:
-        raise HTTPException(status_code=500, detail="Error parseando conversación")
+        return None
+    if not isinstance(historial, list):
+        return None
+    return [
+        {"seq": i, "role": m.get('role'), "content": m.get('content'), "timestamp": m.get('timestamp')}
+        for i, m in enumerate((m for m in historial if isinstance(m, dict)), start=1)
+    ]
 
 
-@app.get("/ticket/{ticket_id}/log")
-async def descargar_log(ticket_id: int):
-    """Descarga el archivo .log de la conversación"""
-    conn = sqlite3.connect('tickets.db')
-    cursor = conn.cursor()
-    cursor.execute('SELECT log_file_path FROM tickets WHERE id=?', (ticket_id,))
-    row = cursor.fetchone()
-    conn.close()
+def _historial_legado(conn: sqlite3.Connection, ticket_id: int) -> list:
+    """Lee el historial JSON de tickets creados antes de ticket_messages"""
+    row = conn.execute('SELECT historial_conversacion FROM tickets WHERE id=?', (ticket_id,)).fetchone()
+    mensajes = _decodificar_historial(row[0] if row else None)
+    if mensajes is None:
+        logger.warning(f"Historial JSON inválido en ticket #{ticket_id}")
+        return []
+    return mensajes
 
-    if not row or not row[0]:
-        raise HTTPException(status_code=404, detail="Log no encontrado")
 
-    log_path = os.path.join(CARPETA_LOGS, row[0])
-    if not os.path.exists(log_path):
-        raise HTTPException(status_code=404, detail="Archivo de log no existe")
+def _migrar_historial_legado(conn: sqlite3.Connection, ticket_id: int):
+    """Copia el blob JSON de un ticket a ticket_messages (ver migrar_historial_mensajes.py)"""
+    mensajes = _historial_legado(conn, ticket_id)
+    conn.executemany(
+        'INSERT OR IGNORE INTO ticket_messages (ticket_id, seq, role, content, timestamp) VALUES (?,?,?,?,?)',
+        [_fila_mensaje(ticket_id, m["seq"], m) for m in mensajes]
+    )
 
-    return FileResponse(log_path, filename=row[0])
 
-@app.post("/ticket/{ticket_id}/enviar-mensaje")
-async def enviar_mensaje_tecnico(ticket_id: int, data: MensajeTecnico):
-    """Envía un mensaje personalizado del técnico al usuario y lo guarda en el historial"""
-    try:
-        conn = sqlite3.connect('tickets.db')
-        cursor = conn.cursor()
-        cursor.execute('SELECT cliente, historial_conversacion, nombre_usuario FROM tickets WHERE id=?', (ticket_id,))
-        row = cursor.fetchone()
-        
-        if not row:
-            conn.close()
-            raise HTTPException(status_code=404, detail="Ticket no encontrado")
-        
-        telefono = row[0]
-        historial_json = row[1]
-        nombre_usuario = row[2] or "Usuario"
-        
-        # Parsear historial existente
-        try:
-            historial = json.loads(historial_json) if historial_json else []
+# Columnas en el orden del esquema; el listado excluye el historial (legado, ver ticket_messages)
+COLUMNAS_TICKET = [
+    'id', 'cliente', 'descripcion', 'estado', 'categoria', 'fecha', 'foto_path',
+    'nombre_usuario', 'departamento', 'tipo_equipo', 'numero_activo', 'falla_detallada',
+    'diagnostico_ia', 'requiere_tecnico', 'estado_conversacion', 'historial_conversacion',
+    'log_file_path', 'updated_seq'
+]
+COLUMNAS_LISTADO = [c for c in COLUMNAS_TICKET if c != 'historial_conversacion']
+# Columnas aceptadas al importar (updated_seq lo asigna el trigger)
+COLUMNAS_IMPORTACION = [c for c in COLUMNAS_TICKET if c != 'updated_seq']
+
+
+def _condiciones_listado(filtros: Optional[dict], desde: Optional[str], hasta: Optional[str]) -> tuple:
+    """Condiciones WHERE y parámetros para los filtros del listado"""
+    condiciones = []
+    params = []
+    for columna, valor in (filtros or {}).items():
+        if valor is not None:
+            condiciones.append(f'{columna} = ?')
+            params.append(valor)
+    if desde:
+        condiciones.append('fecha >= ?')
+        params.append(desde)
+    if hasta:
+        # "fecha" se guarda como "YYYY-MM-DD HH:MM"; una fecha sola incluye todo el día
+        condiciones.append('fecha <= ?')
+        params.append(f"{hasta} 23:59" if len(hasta) == 10 else hasta)
+    return condiciones, params
+
+
+# Campos del ticket indexados para búsqueda (el orden define los pesos de bm25)
+COLUMNAS_BUSQUEDA = ['descripcion', 'falla_detallada', 'diagnostico_ia', 'nombre_usuario', 'numero_activo']
+
+
+# Reglas iniciales del categorizador (se siembran en reglas_categoria al crear la tabla):
+# (categoría, tipos de equipo separados por coma o '*', palabras clave). El orden desempata.
+REGLAS_CATEGORIA_DEFECTO = [
+    ("Hardware - Pantalla", "desktop,laptop", ["pantalla", "roto", "monitor"]),
+    ("Hardware - Energía", "desktop,laptop", ["prende", "bateria", "poder"]),
+    ("Software", "desktop,laptop", ["lenta", "lento", "virus", "malware"]),
+    ("Conectividad", "desktop,laptop", ["internet", "conexion", "wifi"]),
+    ("Hardware - Papel", "impresora", ["papel", "atasco", "atasca"]),
+    ("Hardware - Consumibles", "impresora", ["no imprime", "tinta", "cartucho"]),
+]
+CATEGORIA_POR_DEFECTO = "Soporte General"
+
+
+# Dimensiones de los contadores precalculados: expresión SQL del valor para la fila {t}
+DIMENSIONES_ESTADISTICAS = {
+    'total': "''",
+    'estado': "COALESCE({t}.estado, '')",
+    'categoria': "COALESCE({t}.categoria, '')",
+    'departamento': "COALESCE({t}.departamento, '')",
+    'requiere_tecnico': "COALESCE(CAST({t}.requiere_tecnico AS TEXT), '')",
+}
+# "fecha" se guarda como "YYYY-MM-DD HH:MM"
+_DIA_ESTADISTICAS = "COALESCE(substr({t}.fecha, 1, 10), '')"
+
+
+def consulta_fts(texto: str) -> Optional[str]:
+    """
+    Convierte el texto del usuario en una consulta FTS5 segura: cada palabra entre
+    comillas (sin operadores) y la última como prefijo para buscar mientras se escribe.
+    """
+    palabras = re.findall(r"\w+", texto or "")[:10]
+    if not palabras:
+        return None
+    return " ".join(f'"{p}"' for p in palabras) + "*"
+
+
+def resaltar_fragmento(fragmento: str) -> str:
+    """Escapa el fragmento para HTML y convierte los marcadores de snippet() en <mark>"""
+    return html.escape(fragmento or "").replace("\x02", "<mark>").replace("\x03", "</mark>")
+
+
+class TicketRepository:
+    """Acceso a datos de tickets; las lecturas usan el pool y las escrituras el escritor agrupado"""
+
+    def __init__(self, pool: SQLitePool, escritor: GroupCommitWriter):
+        self.pool = pool
+        self.escritor = escritor
+        self._compactacion = asyncio.Lock()
+
+    async def contar(self) -> int:
+        """Total de tickets desde los contadores precalculados (sin recorrer la tabla)"""
+        row = await self.pool.fetchone(
+            "SELECT total FROM estadisticas WHERE dimension = 'total' AND dia = '*' AND valor = ''"
+        )
+        return row[0] if row else 0
+
+    async def seq_actual(self) -> int:
+        row = await self.pool.fetchone('SELECT valor FROM secuencia_cambios WHERE id = 1')
+        return row[0] if row else 0
+
+    async def seq_ticket(self, ticket_id: int) -> Optional[int]:
+        row = await self.pool.fetchone('SELECT updated_seq FROM tickets WHERE id=?', (ticket_id,))
+        return row[0] if row else None
+
+    async def listar_cambios(self, since: int, limit: int = 100) -> tuple:
+        """
+        Tickets creados o modificados después de la versión `since`, en orden de cambio.
+        Retorna (columnas, filas, hay_mas).
+        """
+        columnas = COLUMNAS_LISTADO
+        filas = await self.pool.fetchall(
+            f"SELECT {', '.join(columnas)} FROM tickets WHERE updated_seq > ? ORDER BY updated_seq LIMIT ?",
+            (since, limit + 1)
+        )
+        hay_mas = len(filas) > limit
+        return columnas, filas[:limit], hay_mas
+
+    async def listar(self, before_id: Optional[int] = None, limit: int = 100,
+                     filtros: Optional[dict] = None, desde: Optional[str] = None,
+                     hasta: Optional[str] = None) -> tuple:
+        """
+        Lista tickets del más reciente al más antiguo con paginación keyset.
+        Retorna (columnas, filas, next_before_id); next_before_id es None en la última página.
+        """
+        columnas = COLUMNAS_LISTADO
+        condiciones, params = _condiciones_listado(filtros, desde, hasta)
+        if before_id is not None:
+            condiciones.append('id < ?')
+            params.append(before_id)
+
+        where = f"WHERE {' AND '.join(condiciones)}" if condiciones else ""
+        sql = f"SELECT {', '.join(columnas)} FROM tickets {where} ORDER BY id DESC LIMIT ?"
+        # Se pide una fila extra para saber si hay otra página
+        filas = await self.pool.fetchall(sql, tuple(params) + (limit + 1,))
+
+        next_before_id = None
+        if len(filas) > limit:
+            filas = filas[:limit]
+            next_before_id = filas[-1][0]
+        return columnas, filas, next_before_id
+
+    async def estadisticas(self, desde_dia: Optional[str] = None) -> dict:
+        """
+        Lee los contadores precalculados: acumulado global por dimensión y,
+        si se indica desde_dia (AAAA-MM-DD), la serie diaria desde ese día.
+        """
+        def _leer(conn):
+            globales = conn.execute(
+                "SELECT dimension, valor, total FROM estadisticas WHERE dia = '*' AND total != 0"
+            ).fetchall()
+            diarias = conn.execute(
+                "SELECT dia, dimension, valor, total FROM estadisticas "
+                "WHERE dia != '*' AND dia >= ? AND total != 0 ORDER BY dia",
+                (desde_dia,)
+            ).fetchall() if desde_dia else []
+            return globales, diarias
+        globales, diarias = await self.pool.ejecutar(_leer)
+
+        resultado = {"total": 0, **{f"por_{d}": {} for d in DIMENSIONES_ESTADISTICAS if d != 'total'}}
+        for dimension, valor, total in globales:
+            if dimension == 'total':
+                resultado["total"] = total
+            else:
+                resultado[f"por_{dimension}"][valor] = total
+
+        por_dia = OrderedDict()
+        for dia, dimension, valor, total in diarias:
+            bucket = por_dia.setdefault(dia, {"dia": dia, "total": 0, "por_estado": {}, "por_categoria": {}})
+            if dimension == 'total':
+                bucket["total"] = total
+            elif f"por_{dimension}" in bucket:
+                bucket[f"por_{dimension}"][valor] = total
+        resultado["por_dia"] = list(por_dia.values())
+        return resultado
+
+    async def buscar(self, consulta: str, limit: int = 20, estado: Optional[str] = None) -> tuple:
+        """
+        Búsqueda de texto completo en los campos del ticket y en sus mensajes.
+        Retorna (columnas, filas, resultados) ordenados por relevancia; cada resultado
+        trae ticket_id, rank (menor es mejor) y fragmentos con <mark>.
+
+        Los puntajes bm25 de tickets_fts y mensajes_fts usan pesos distintos y no
+        son comparables: cada fuente se ordena por separado y se combinan por
+        posición (reciprocal rank fusion), así un ticket que aparece arriba en
+        ambas queda primero.
+        """
+        filtro_estado = " AND t.estado = ?" if estado is not None else ""
+        extra = (estado,) if estado is not None else ()
+
+        def _buscar(conn):
+            puntajes = {}  # ticket_id -> suma de 1 / (60 + posición) en cada fuente
+            fragmentos = {}  # ticket_id -> hasta 3 fragmentos distintos
+
+            def agregar(ticket_id, origen, fragmento):
+                lista = fragmentos.setdefault(ticket_id, [])
+                texto = resaltar_fragmento(fragmento)
+                if len(lista) < 3 and all(f["texto"] != texto for f in lista):
+                    lista.append({"origen": origen, "texto": texto})
+
+            # El filtro por estado va dentro de cada consulta, antes del LIMIT
+            for posicion, (ticket_id, fragmento) in enumerate(conn.execute(
+                "SELECT f.rowid, snippet(tickets_fts, -1, char(2), char(3), '…', 12) "
+                "FROM tickets_fts f JOIN tickets t ON t.id = f.rowid "
+                f"WHERE tickets_fts MATCH ?{filtro_estado} ORDER BY f.rank LIMIT ?",
+                (consulta, *extra, limit * 2)
+            )):
+                puntajes[ticket_id] = puntajes.get(ticket_id, 0.0) + 1.0 / (60 + posicion)
+                agregar(ticket_id, "ticket", fragmento)
+            posiciones = {}  # cada ticket cuenta una vez, en la posición de su mejor mensaje
+            for ticket_id, fragmento, role in conn.execute(
+                "SELECT m.ticket_id, snippet(mensajes_fts, 0, char(2), char(3), '…', 12), m.role "
+                "FROM mensajes_fts f JOIN ticket_messages m ON m.id = f.rowid JOIN tickets t ON t.id = m.ticket_id "
+                f"WHERE mensajes_fts MATCH ?{filtro_estado} ORDER BY f.rank LIMIT ?",
+                (consulta, *extra, limit * 5)
+            ):
+                if ticket_id not in posiciones:
+                    posiciones[ticket_id] = len(posiciones)
+                    puntajes[ticket_id] = puntajes.get(ticket_id, 0.0) + 1.0 / (60 + posiciones[ticket_id])
+                agregar(ticket_id, role, fragmento)
+
+            if not puntajes:
+                return []
+            mejores = sorted(puntajes, key=lambda i: -puntajes[i])[:limit]
+            filas = conn.execute(
+                f"SELECT {', '.join(COLUMNAS_LISTADO)} FROM tickets WHERE id IN ({','.join('?' * len(mejores))})",
+                mejores
+            ).fetchall()
+            por_id = {f[0]: f for f in filas}
+            return [
+                (por_id[i], {"rank": round(-puntajes[i], 6), "fragmentos": fragmentos[i]})
+                for i in mejores if i in por_id
+            ]
+
+        encontrados = await self.pool.ejecutar(_buscar)
+        resultados = [{"ticket_id": f[0], **c} for f, c in encontrados]
+        return COLUMNAS_LISTADO, [f for f, _ in encontrados], resultados
+
+    async def obtener_mensajes(self, ticket_id: int, after_seq: int = 0) -> list:
+        """Mensajes del ticket con seq > after_seq, en orden"""
+        def _obtener(conn):
+            filas = conn.execute(
+                'SELECT seq, role, content, timestamp FROM ticket_messages '
+                'WHERE ticket_id=? AND seq>? ORDER BY seq',
+                (ticket_id, after_seq)
+            ).fetchall()
+            if filas or (after_seq > 0 and _tiene_mensajes(conn, ticket_id)):
+                return [_mensaje_de_fila(f) for f in filas]
+            # Ticket anterior a la migración: servir desde el blob JSON
+            mensajes = _historial_legado(conn, ticket_id)
+            return [m for m in mensajes if m["seq"] > after_seq]
+        return await self.pool.ejecutar(_obtener)
+
+    async def obtener_log_path(self, ticket_id: int) -> Optional[str]:
+        row = await self.pool.fetchone('SELECT log_file_path FROM tickets WHERE id=?', (ticket_id,))
+        return row[0] if row else None
+
+    async def obtener_cliente(self, ticket_id: int) -> Optional[str]:
+        row = await self.pool.fetchone('SELECT cliente FROM tickets WHERE id=?', (ticket_id,))
+        return row[0] if row else None
+
+    async def exportar(self, filtros: Optional[dict] = None, desde: Optional[str] = None,
+                       hasta: Optional[str] = None, mensajes: bool = False, lote: int = 1000):
+        """
+        Recorre los tickets en orden de id por bloques de `lote` (keyset), sin
+        cargar la tabla en memoria. Genera listas de filas con COLUMNAS_LISTADO;
+        con mensajes=True cada fila lleva al final la lista de mensajes del ticket.
+        """
+        condiciones, params = _condiciones_listado(filtros, desde, hasta)
+        ultimo_id = 0
+        while True:
+            where = " AND ".join(['id > ?'] + condiciones)
+            filas = await self.pool.fetchall(
+                f"SELECT {', '.join(COLUMNAS_LISTADO)} FROM tickets WHERE {where} ORDER BY id LIMIT ?",
+                (ultimo_id, *params, lote)
+            )
+            if not filas:
+                return
+            ultimo_id = filas[-1][0]
+            if mensajes:
+                ids = [f[0] for f in filas]
+                por_ticket = {}
+                for fila in await self.pool.fetchall(
+                    f"SELECT ticket_id, seq, role, content, timestamp FROM ticket_messages "
+                    f"WHERE ticket_id IN ({','.join('?' * len(ids))}) ORDER BY ticket_id, seq",
+                    tuple(ids)
+                ):
+                    por_ticket.setdefault(fila[0], []).append(_mensaje_de_fila(fila[1:]))
+                filas = [(*f, por_ticket.get(f[0], [])) for f in filas]
+            yield filas
+            if len(filas) < lote:
+                return
+
+    async def importar(self, tickets: list) -> tuple:
+        """
+        Inserta un bloque de tickets (dicts con columnas de COLUMNAS_IMPORTACION y,
+        opcionalmente, "mensajes") en una sola transacción. Los tickets que traen
+        un id ya existente se omiten, así reimportar el mismo archivo es seguro.
+        Retorna (insertados, omitidos).
+        """
+        def _importar(conn):
+            con_id = [t for t in tickets if t.get('id') is not None]
+            existentes = set()
+            for i in range(0, len(con_id), 500):
+                ids = [t['id'] for t in con_id[i:i + 500]]
+                existentes.update(r[0] for r in conn.execute(
+                    f"SELECT id FROM tickets WHERE id IN ({','.join('?' * len(ids))})", ids
+                ))
+            nuevos = []
+            for t in con_id:
+                if t['id'] not in existentes:
+                    existentes.add(t['id'])
+                    nuevos.append(t)
+
+            columnas = COLUMNAS_IMPORTACION
+            sql = f"INSERT INTO tickets ({', '.join(columnas)}) VALUES ({','.join('?' * len(columnas))})"
+            conn.executemany(sql, [tuple(t.get(c) for c in columnas) for t in nuevos])
+            # Sin id lo asigna SQLite; hace falta lastrowid para enlazar sus mensajes
+            for t in tickets:
+                if t.get('id') is None:
+                    t['id'] = conn.execute(sql, tuple(t.get(c) for c in columnas)).lastrowid
+                    nuevos.append(t)
+
+            conn.executemany(
+                'INSERT INTO ticket_messages (ticket_id, seq, role, content, timestamp) VALUES (?,?,?,?,?)',
+                [
+                    _fila_mensaje(t['id'], i, m)
+                    for t in nuevos
+                    for i, m in enumerate(t.get('mensajes') or [], start=1)
+                ]
+            )
+            return len(nuevos), len(tickets) - len(nuevos)
+        return await self.escritor.ejecutar(_importar)
+
+    async def insertar(self, valores: dict, mensajes: Optional[list] = None) -> int:
+        """Inserta el ticket y sus mensajes iniciales en una sola transacción"""
+        def _insertar(conn):
+            columnas = ", ".join(valores.keys())
+            marcadores = ",".join("?" * len(valores))
+            if valores.get('entrada_id'):
+                existente = conn.execute(
+                    'SELECT id FROM tickets WHERE entrada_id = ?', (valores['entrada_id'],)
+                ).fetchone()
+                if existente:
+                    return existente[0]
+            cursor = conn.execute(
+                f'INSERT INTO tickets ({columnas}) VALUES ({marcadores})',
+                tuple(valores.values())
+            )
+            ticket_id = cursor.lastrowid
+            if mensajes:
+                conn.executemany(
+                    'INSERT INTO ticket_messages (ticket_id, seq, role, content, timestamp) '
+                    'VALUES (?,?,?,?,?)',
+                    [_fila_mensaje(ticket_id, i, m) for i, m in enumerate(mensajes, start=1)]
+                )
+            return ticket_id
+        return await self.escritor.ejecutar(_insertar)
+
+    async def actualizar(self, ticket_id: int, valores: dict):
+        """Actualiza columnas del ticket (solo columnas conocidas del esquema)"""
+        columnas = [c for c in valores if c in COLUMNAS_TICKET and c not in ('id', 'updated_seq')]
+        if not columnas:
+            return
+        def _actualizar(conn):
+            conn.execute(
+                f"UPDATE tickets SET {', '.join(f'{c}=?' for c in columnas)} WHERE id=?",
+                tuple(valores[c] for c in columnas) + (ticket_id,)
+            )
+        await self.escritor.ejecutar(_actualizar)
+
+    async def reubicar_logs(self, movidos: list):
+        """Apunta log_file_path a la nueva ubicación: [(ticket_id, anterior, nueva)]"""
+        def _reubicar(conn):
+            conn.executemany(
+                'UPDATE tickets SET log_file_path=? WHERE id=? AND log_file_path=?',
+                [(nueva, ticket_id, anterior) for ticket_id, anterior, nueva in movidos]
+            )
+        await self.escritor.ejecutar(_reubicar)
+
+    async def agregar_mensaje(self, ticket_id: int, mensaje: dict) -> Optional[str]:
+        """
+        Agrega un mensaje al final de la conversación (O(1), sin reescribir el historial).
+        Retorna el teléfono del cliente o None si el ticket no existe.
+        """
+        return await self.agregar_mensajes(ticket_id, [mensaje])
+
+    async def agregar_mensajes(self, ticket_id: int, mensajes: list) -> Optional[str]:
+        """Agrega varios mensajes en orden dentro de una sola transacción"""
+        def _agregar(conn):
+            row = conn.execute('SELECT cliente FROM tickets WHERE id=?', (ticket_id,)).fetchone()
+            if not row:
+                return None
+            if not _tiene_mensajes(conn, ticket_id):
+                _migrar_historial_legado(conn, ticket_id)
+            for mensaje in mensajes:
+                conn.execute(
+                    'INSERT INTO ticket_messages (ticket_id, seq, role, content, timestamp) '
+                    'SELECT ?, COALESCE(MAX(seq), 0) + 1, ?, ?, ? FROM ticket_messages WHERE ticket_id=?',
+                    (ticket_id, mensaje.get('role'), _contenido_guardado(mensaje.get('role'), mensaje.get('content')),
+                     mensaje.get('timestamp'), ticket_id)
+                )
+            return row[0] or ""
+        return await self.escritor.ejecutar(_agregar)
+
+    @property
+    def compactando(self) -> bool:
+        return self._compactacion.locked()
+
+    async def compactar(self, migrar_historial: bool = False, lote: int = 500) -> dict:
+        """
+        Reescribe las filas guardadas antes de la compresión: comprime los
+        mensajes largos del asistente y compacta los diagnósticos en caché.
+        Con migrar_historial=True además pasa los historiales JSON legados a
+        ticket_messages y deja la columna en NULL; como migrar_historial_mensajes.py
+        --limpiar, no tiene vuelta atrás y marca esos tickets como cambiados.
+        Avanza por bloques de rowid para no retener el escritor. El espacio que
+        se libera queda en la lista libre de SQLite y lo reutilizan las filas
+        nuevas; sólo un VACUUM (fuera de línea) achica el archivo.
+        """
+        async with self._compactacion:
+            inicio = time.perf_counter()
+            tablas = {}
+            if migrar_historial:
+                tablas["historial_legado"] = await self._compactar_historiales(lote)
+            tablas.update({
+                "mensajes": await self._compactar_columna(
+                    "ticket_messages", "content", "role = 'assistant'",
+                    comprimir_texto, COMPRESION_MIN_BYTES, lote
+                ),
+                "cache_diagnosticos": await self._compactar_columna(
+                    "cache_diagnosticos", "resultado", "1",
+                    lambda texto: comprimir_texto(json_compacto(json.loads(texto))), 0, lote
+                ),
+            })
+            libres = await self.pool.fetchone(
+                "SELECT f.freelist_count * p.page_size FROM pragma_freelist_count f, pragma_page_size p"
+            )
+        ahorrados = sum(t["bytes_antes"] - t["bytes_despues"] for t in tablas.values())
+        reporte = {
+            "tablas": tablas,
+            "bytes_ahorrados": ahorrados,
+            "bytes_libres_reutilizables": libres[0] if libres else 0,
+            "segundos": round(time.perf_counter() - inicio, 2)
+        }
+        if ahorrados:
+            logger.info(f"Compactación: {ahorrados / 1e6:.2f} MB ahorrados en {reporte['segundos']}s")
+        return reporte
+
+    async def _compactar_historiales(self, lote: int) -> dict:
+        antes = despues = reescritas = 0
+        ultimo_id = 0
+        while True:
+            filas = await self.pool.fetchall(
+                'SELECT id FROM tickets WHERE id > ? AND historial_conversacion IS NOT NULL ORDER BY id LIMIT ?',
+                (ultimo_id, lote)
+            )
+            if not filas:
+                break
+            ultimo_id = filas[-1][0]
+
+            def _migrar(conn, ids=[f[0] for f in filas]):
+                bytes_antes = bytes_despues = 0
+                limpiar = []
+                for ticket_id, texto in conn.execute(
+                    f"SELECT id, historial_conversacion FROM tickets WHERE id IN ({','.join('?' * len(ids))})", ids
+                ).fetchall():
+                    historial = _decodificar_historial(texto)
+                    if historial is None:
+                        continue  # se deja intacto para revisarlo a mano
+                    if not _tiene_mensajes(conn, ticket_id):
+                        mensajes = [_fila_mensaje(ticket_id, m["seq"], m) for m in historial]
+                        conn.executemany(
+                            'INSERT OR IGNORE INTO ticket_messages (ticket_id, seq, role, content, timestamp) '
+                            'VALUES (?,?,?,?,?)', mensajes
+                        )
+                        bytes_despues += sum(bytes_guardados(m[3]) for m in mensajes)
+                    else:
+                        # Ya copiados antes (al crear el esquema o por el script): el
+                        # contenido sigue ocupando espacio en ticket_messages
+                        bytes_despues += conn.execute(
+                            'SELECT COALESCE(SUM(length(CAST(content AS BLOB))), 0) FROM ticket_messages '
+                            'WHERE ticket_id = ?', (ticket_id,)
+                        ).fetchone()[0]
+                    bytes_antes += bytes_guardados(texto)
+                    limpiar.append((ticket_id,))
+                conn.executemany('UPDATE tickets SET historial_conversacion = NULL WHERE id = ?', limpiar)
+                return bytes_antes, bytes_despues, len(limpiar)
+
+            bytes_antes, bytes_despues, cantidad = await self.escritor.ejecutar(_migrar)
+            antes += bytes_antes
+            despues += bytes_despues
+            reescritas += cantidad
+        return {"filas": reescritas, "bytes_antes": antes, "bytes_despues": despues}
+
+    async def _compactar_columna(self, tabla: str, columna: str, condicion: str,
+                                 transformar: Callable, minimo: int, lote: int) -> dict:
+        """Aplica `transformar` a los valores de texto y guarda los que cambian"""
+        antes = despues = reescritas = 0
+        ultimo = 0
+        while True:
+            filas = await self.pool.fetchall(
+                f"SELECT rowid, {columna} FROM {tabla} WHERE rowid > ? AND {condicion} "
+                f"AND typeof({columna}) = 'text' AND length(CAST({columna} AS BLOB)) >= ? "
+                f"ORDER BY rowid LIMIT ?",
+                (ultimo, minimo, lote)
+            )
+            if not filas:
+                break
+            ultimo = filas[-1][0]
+
+            def _transformar(filas=filas) -> list:
+                cambios = []
+                for rowid, texto in filas:
+                    try:
+                        nuevo = transformar(texto)
+                    except ValueError:
+                        continue
+                    if nuevo != texto:
+                        cambios.append((nuevo, rowid, texto))
+                return cambios
+
+            # Comprimir cuesta CPU: fuera del event loop y del hilo del escritor
+            cambios = await asyncio.to_thread(_transformar)
+            if cambios:
+                # Si la fila cambió mientras tanto, el WHERE no coincide y se deja como está
+                await self.escritor.ejecutar(
+                    lambda conn, cambios=cambios: conn.executemany(
+                        f"UPDATE {tabla} SET {columna} = ? WHERE rowid = ? AND {columna} = ?", cambios
+                    )
+                )
+                reescritas += len(cambios)
+                for nuevo, _, texto in cambios:
+                    antes += bytes_guardados(texto)
+                    despues += bytes_guardados(nuevo)
+        return {"filas": reescritas, "bytes_antes": antes, "bytes_despues": despues}
+
+
+init_db()
+ticket_repo = TicketRepository(db_pool, escritor)
+
+class MensajeWA(BaseModel):
+    remitente: str
+    contenido: str
+    imagen: Optional[str] = None
+    id_mensaje: Optional[str] = None  # id de WhatsApp, para descartar reenvíos
+
+class MensajeTecnico(BaseModel):
+    mensaje: str
+
+class ReglaCategoria(BaseModel):
+    categoria: str
+    equipos: str = '*'  # tipos de equipo separados por coma, '*' = cualquiera
+    palabras: list[str]
+    peso: float = 1.0
+
+# --- CLASES DE CONVERSACIÓN ---
+class ConversationSession:
+    ESTADOS = ["INICIO", "NOMBRE", "DEPTO", "EQUIPO", "ACTIVO", "FALLA", "DIAGNOSTICO", "FINALIZADO"]
+
+    # Sin __dict__ por instancia: menos memoria con muchas sesiones concurrentes
+    __slots__ = ("remitente", "estado", "datos", "historial", "ultimo_mensaje", "ticket_id", "version",
+                 "ultima_entrada")
+
+    def __init__(self, remitente: str):
+        self.remitente = remitente
+        self.estado = "INICIO"
+        self.datos = {}
+        self.historial = []
+        self.ultimo_mensaje = time.time()  # epoch en segundos
+        self.ticket_id = None
+        self.version = 0  # marca de la última escritura en el almacén
+        self.ultima_entrada = 0  # id del último mensaje de la bitácora aplicado
+
+    def esta_expirada(self, timeout_minutes: int = 15, ahora: Optional[float] = None) -> bool:
+        return (ahora or time.time()) - self.ultimo_mensaje > timeout_minutes * 60
+
+    def a_json(self) -> str:
+        return json_compacto({
+            "remitente": self.remitente,
+            "estado": self.estado,
+            "datos": self.datos,
+            "historial": self.historial,
+            "ultimo_mensaje": self.ultimo_mensaje,
+            "ticket_id": self.ticket_id,
+            "ultima_entrada": self.ultima_entrada
+        })
+
+    @classmethod
+    def desde_json(cls, texto: str, version: int) -> "ConversationSession":
+        d = json.loads(texto)
+        sesion = cls(d["remitente"])
+        sesion.estado = d["estado"]
+        sesion.datos = d["datos"]
+        sesion.historial = d["historial"]
+        ultimo = d["ultimo_mensaje"]
+        if isinstance(ultimo, str):
+            # Sesiones guardadas con fecha ISO
+            ultimo = datetime.datetime.fromisoformat(ultimo).timestamp()
+        sesion.ultimo_mensaje = ultimo
+        sesion.ticket_id = d["ticket_id"]
+        sesion.ultima_entrada = d.get("ultima_entrada", 0)
+        sesion.version = version
+        return sesion
+
+
+# --- ALMACENES DE SESIONES ---
+# Todos exponen la misma interfaz asíncrona:
+#   cargar(remitente, version_conocida) -> None si no existe,
+#       (version, None) si coincide con la versión conocida, (version, json) si cambió
+#   guardar(sesion), cerrar()
+#   eliminar(remitente, version=None) -> True si borró (con version, sólo si coincide)
+#   eliminar_expiradas(limite) -> [remitentes], listar_vencimientos() -> [(remitente, ultimo_mensaje)]
+class MemorySessionStore:
+    """Sin persistencia: las sesiones sólo viven en el proceso (un único worker)"""
+    compartido = False
+
+    async def cargar(self, remitente: str, version_conocida: Optional[int] = None):
+        return None
+
+    async def guardar(self, sesion: ConversationSession):
+        pass
+
+    async def eliminar(self, remitente: str, version: Optional[int] = None) -> bool:
+        return True
+
+    async def eliminar_expiradas(self, limite: float) -> list:
+        return []
+
+    async def listar_vencimientos(self) -> list:
+        return []
+
+    async def cerrar(self):
+        pass
+
+
+class SQLiteSessionStore:
+    """Sesiones en la tabla `sesiones` de tickets.db, compartidas entre workers"""
+    compartido = True
+
+    def __init__(self, pool: SQLitePool, escritor: GroupCommitWriter):
+        self.pool = pool
+        self.escritor = escritor
+
+    async def cargar(self, remitente: str, version_conocida: Optional[int] = None):
+        # Si la versión no cambió no se transfiere ni decodifica el JSON
+        row = await self.pool.fetchone(
+            'SELECT version, CASE WHEN version = ? THEN NULL ELSE datos END FROM sesiones WHERE remitente = ?',
+            (version_conocida, remitente)
+        )
+        return (row[0], row[1]) if row else None
+
+    async def guardar(self, sesion: ConversationSession):
+        def _guardar(conn, remitente, version, datos, ultimo):
+            conn.execute(
+                'INSERT INTO sesiones (remitente, version, datos, ultimo_mensaje) VALUES (?,?,?,?) '
+                'ON CONFLICT(remitente) DO UPDATE SET version=excluded.version, datos=excluded.datos, '
+                'ultimo_mensaje=excluded.ultimo_mensaje',
+                (remitente, version, datos, ultimo)
+            )
+        await self.escritor.ejecutar(
+            _guardar, sesion.remitente, sesion.version, sesion.a_json(), sesion.ultimo_mensaje
+        )
+
+    async def eliminar(self, remitente: str, version: Optional[int] = None) -> bool:
+        if version is None:
+            cursor = await self.escritor.ejecutar(
+                lambda conn: conn.execute('DELETE FROM sesiones WHERE remitente = ?', (remitente,))
+            )
+        else:
+            cursor = await self.escritor.ejecutar(lambda conn: conn.execute(
+                'DELETE FROM sesiones WHERE remitente = ? AND version = ?', (remitente, version)
+            ))
+        return cursor.rowcount > 0
+
+    async def eliminar_expiradas(self, limite: float) -> list:
+        filas = await self.escritor.ejecutar(lambda conn: conn.execute(
+            'DELETE FROM sesiones WHERE ultimo_mensaje < ? RETURNING remitente', (limite,)
+        ).fetchall())
+        return [f[0] for f in filas]
+
+    async def listar_vencimientos(self) -> list:
+        return await self.pool.fetchall('SELECT remitente, ultimo_mensaje FROM sesiones')
+
+    async def cerrar(self):
+        pass
+
+
+class RedisSessionStore:
+    """
+    Sesiones en Redis (o un servidor compatible) como hash con TTL;
+    el propio servidor se encarga de expirarlas. El TTL lleva un margen sobre
+    el timeout para que el worker las expire (y avise) antes que el servidor.
+    """
+
+    # Borra la clave sólo si la versión no cambió
+    _ELIMINAR_VERSION = (
+        "if redis.call('HGET', KEYS[1], 'version') == ARGV[1] then "
+        "return redis.call('DEL', KEYS[1]) end return 0"
+    )
+    compartido = True
+
+    def __init__(self, url: str, ttl_segundos: int, prefijo: str = "sesion:"):
+        try:
+            import redis.asyncio as redis_async
+        except ImportError:
+            raise RuntimeError("SESSION_BACKEND=redis requiere el paquete redis (pip install redis)")
+        self._redis = redis_async.from_url(url)
+        self.ttl_segundos = ttl_segundos
+        self.prefijo = prefijo
+
+    async def cargar(self, remitente: str, version_conocida: Optional[int] = None):
+        clave = self.prefijo + remitente
+        version = await self._redis.hget(clave, "version")
+        if version is None:
+            return None
+        version = int(version)
+        if version == version_conocida:
+            return (version, None)
+        datos = await self._redis.hget(clave, "datos")
+        return (version, datos.decode("utf-8")) if datos is not None else None
+
+    async def guardar(self, sesion: ConversationSession):
+        clave = self.prefijo + sesion.remitente
+        async with self._redis.pipeline(transaction=True) as pipe:
+            pipe.hset(clave, mapping={"version": sesion.version, "datos": sesion.a_json()})
+            pipe.expire(clave, self.ttl_segundos)
+            await pipe.execute()
+
+    async def eliminar(self, remitente: str, version: Optional[int] = None) -> bool:
+        if version is None:
+            return bool(await self._redis.delete(self.prefijo + remitente))
+        return bool(await self._redis.eval(self._ELIMINAR_VERSION, 1, self.prefijo + remitente, str(version)))
+
+    async def eliminar_expiradas(self, limite: float) -> list:
+        return []
+
+    async def listar_vencimientos(self) -> list:
+        return []
+
+    async def cerrar(self):
+        await self._redis.close()
+
+
+def crear_session_store(backend: str):
+    backend = backend.lower()
+    if backend == "memoria":
+        return MemorySessionStore()
+    if backend == "redis":
+        return RedisSessionStore(REDIS_URL, SESSION_TIMEOUT_MINUTES * 60 + 300)
+    if backend != "sqlite":
+        logger.warning(f"SESSION_BACKEND desconocido '{backend}', usando sqlite")
+    return SQLiteSessionStore(db_pool, escritor)
+
+
+class ConversationManager:
+    """
+    Caché local de sesiones con escritura directa (write-through) al almacén.
+    Con un almacén compartido cada lectura confirma la versión guardada, así la
+    sesión sobrevive a reinicios y cualquier worker puede continuarla; sólo se
+    vuelve a decodificar cuando otro proceso la modificó.
+
+    Los vencimientos se llevan en un min-heap de (vence, remitente): cada mensaje
+    agrega una entrada y las que quedaron viejas se descartan al salir del heap,
+    así expirar cuesta O(log n) y ocurre cerca del vencimiento real.
+    """
+
+    REVISION_OCUPADA_SEGUNDOS = 5  # reintento de expiración de una sesión con un mensaje en proceso
+
+    def __init__(self, store=None, timeout_minutes: int = 15,
+                 al_expirar: Optional[Callable] = None):
+        self.store = store or MemorySessionStore()
+        self.timeout_minutes = timeout_minutes
+        self.al_expirar = al_expirar  # async fn(sesion) al vencer por inactividad
+        self.sesiones = {}
+        self._vencimientos = []
+        # Vencimiento vigente por remitente, incluidas las sesiones recuperadas del
+        # almacén al arrancar que todavía no están en la caché: el heap se
+        # reconstruye desde aquí para no perder sus avisos de expiración
+        self._plazos = {}
+        self._nuevo_primero = asyncio.Event()
+
+    def _agregar_vencimiento(self, vence: float, remitente: str):
+        self._plazos[remitente] = vence
+        entrada = (vence, remitente)
+        heapq.heappush(self._vencimientos, entrada)
+        if self._vencimientos[0] is entrada:
+            self._nuevo_primero.set()
+
+    def _programar(self, sesion: ConversationSession):
+        self._agregar_vencimiento(sesion.ultimo_mensaje + self.timeout_minutes * 60, sesion.remitente)
+        # Compactar si se acumularon muchas entradas viejas
+        if len(self._vencimientos) > 2 * len(self._plazos) + 64:
+            self._vencimientos = [(vence, r) for r, vence in self._plazos.items()]
+            heapq.heapify(self._vencimientos)
+
+    def _olvidar(self, remitente: str):
+        self.sesiones.pop(remitente, None)
+        self._plazos.pop(remitente, None)
+
+    def proximo_vencimiento(self) -> Optional[float]:
+        return self._vencimientos[0][0] if self._vencimientos else None
+
+    async def esperar_vencimiento(self, maximo: float = 30):
+        """Duerme hasta el próximo vencimiento, o antes si se programa uno más cercano"""
+        proximo = self.proximo_vencimiento()
+        espera = maximo if proximo is None else min(max(proximo - time.time(), 0), maximo)
+        self._nuevo_primero.clear()
+        try:
+            await asyncio.wait_for(self._nuevo_primero.wait(), timeout=espera)
+        except asyncio.TimeoutError:
+            pass
+
+    async def iniciar(self):
+        """Carga los vencimientos de las sesiones que quedaron en el almacén"""
+        try:
+            pendientes = await self.store.listar_vencimientos()
+        except Exception as e:
+            logger.error(f"No se pudieron cargar las sesiones guardadas: {str(e)}")
+            return
+        for remitente, ultimo in pendientes:
+            self._agregar_vencimiento(ultimo + self.timeout_minutes * 60, remitente)
+        if pendientes:
+            logger.info(f"{len(pendientes)} sesiones activas recuperadas del almacén")
+
+    async def _sincronizar(self, remitente: str, sesion: Optional[ConversationSession]):
+        """Confirma la sesión contra el almacén compartido (None si ya no existe)"""
+        try:
+            registro = await self.store.cargar(remitente, sesion.version if sesion else None)
+        except Exception as e:
+            logger.warning(f"Almacén de sesiones no disponible, usando caché local: {str(e)}")
+            return sesion
+        if registro is None:
+            self._olvidar(remitente)
+            return None
+        if registro[1] is not None:
+            sesion = ConversationSession.desde_json(registro[1], registro[0])
+            self.sesiones[remitente] = sesion
+            self._programar(sesion)
+        return sesion
+
+    async def get_session(self, remitente: str) -> Optional[ConversationSession]:
+        sesion = self.sesiones.get(remitente)
+        if self.store.compartido:
+            sesion = await self._sincronizar(remitente, sesion)
+
+        if sesion and sesion.esta_expirada(self.timeout_minutes):
+            # El mensaje llegó antes de que el heap la expirara
+            await self._expirar(sesion)
+            return None
+        return sesion
+
+    def create_session(self, remitente: str) -> ConversationSession:
+        sesion = ConversationSession(remitente)
+        self.sesiones[remitente] = sesion
+        logger.info(f"Nueva sesión creada para {remitente}")
+        return sesion
+
+    async def guardar(self, sesion: ConversationSession):
+        """Persiste la sesión tras procesar un mensaje"""
+        sesion.version = time.time_ns()
+        self.sesiones[sesion.remitente] = sesion
+        self._programar(sesion)
+        try:
+            await self.store.guardar(sesion)
+        except Exception as e:
+            logger.error(f"No se pudo guardar la sesión de {sesion.remitente}: {str(e)}")
+
+    async def end_session(self, remitente: str):
+        self._plazos.pop(remitente, None)
+        if self.sesiones.pop(remitente, None) is not None:
+            logger.info(f"Sesión finalizada para {remitente}")
+        try:
+            await self.store.eliminar(remitente)
+        except Exception as e:
+            logger.error(f"No se pudo eliminar la sesión de {remitente}: {str(e)}")
+
+    async def expirar_vencidas(self, ahora: Optional[float] = None,
+                               ocupado: Optional[Callable] = None) -> int:
+        """
+        Expira las sesiones cuyo vencimiento ya pasó y avisa al usuario.
+        `ocupado(remitente)` indica que hay un mensaje en proceso: esa sesión no se
+        expira porque al terminar se guarda con un nuevo vencimiento.
+        """
+        ahora = ahora or time.time()
+        expiradas = 0
+        while self._vencimientos and self._vencimientos[0][0] <= ahora:
+            vence, remitente = heapq.heappop(self._vencimientos)
+            if ocupado and ocupado(remitente):
+                # Volver a revisarla pronto: si el proceso falla antes de guardar,
+                # nadie más la reprogramaría y nunca se avisaría la expiración
+                if self._plazos.get(remitente) == vence:
+                    self._agregar_vencimiento(ahora + self.REVISION_OCUPADA_SEGUNDOS, remitente)
+                continue
+            sesion = self.sesiones.get(remitente)
+            if self.store.compartido:
+                era_local = sesion is not None
+                sesion = await self._sincronizar(remitente, sesion)
+                if sesion and not era_local and not sesion.esta_expirada(self.timeout_minutes, ahora):
+                    # Recuperada del almacén al arrancar y aún vigente
+                    self.sesiones[remitente] = sesion
+                    self._programar(sesion)
+            if sesion is None:
+                self._plazos.pop(remitente, None)
+                continue  # la sesión ya terminó
+            if not sesion.esta_expirada(self.timeout_minutes, ahora):
+                continue  # entrada vieja: la sesión terminó o recibió mensajes después
+            if await self._expirar(sesion):
+                expiradas += 1
+        return expiradas
+
+    async def _expirar(self, sesion: ConversationSession) -> bool:
+        # Sólo el worker que logra borrar esta versión la da por expirada y avisa
+        remitente = sesion.remitente
+        try:
+            reclamada = await self.store.eliminar(remitente, sesion.version)
+        except Exception as e:
+            logger.error(f"No se pudo expirar la sesión de {remitente}: {str(e)}")
+            return False
+        self._olvidar(remitente)
+        if not reclamada:
+            return False
+
+        logger.warning(f"Sesión expirada: {remitente}")
+        if self.al_expirar:
+            try:
+                await self.al_expirar(sesion)
+            except Exception as e:
+                logger.error(f"Error notificando expiración a {remitente}: {str(e)}")
+        return True
+
+    async def cleanup_expired_sessions(self, timeout_minutes: int = 15):
+        """Barrido de respaldo del almacén para sesiones que ningún worker tiene programadas"""
+        limite = time.time() - timeout_minutes * 60
+        try:
+            for remitente in await self.store.eliminar_expiradas(limite):
+                self._olvidar(remitente)
+                logger.warning(f"Sesión expirada y limpiada: {remitente}")
+        except Exception as e:
+            logger.error(f"Error limpiando sesiones del almacén: {str(e)}")
+
+
+# --- CACHÉ DE DIAGNÓSTICOS ---
+PALABRAS_VACIAS = {"el", "la", "los", "las", "un", "una", "unos", "unas", "mi", "mis", "de", "del", "y", "que", "se", "me", "esta", "está", "es", "muy"}
+
+
+def plegar_texto(texto: str) -> str:
+    """Minúsculas y sin acentos"""
+    texto = unicodedata.normalize("NFKD", (texto or "").lower())
+    return "".join(c for c in texto if not unicodedata.combining(c))
+
+
+def normalizar_texto(texto: str) -> str:
+    """Minúsculas, sin acentos ni puntuación y sin palabras vacías"""
+    palabras = re.findall(r"[a-z0-9ñ]+", plegar_texto(texto))
+    return " ".join(p for p in palabras if p not in PALABRAS_VACIAS)
+
+
+def huella_diagnostico(tipo_equipo: str, falla: str) -> str:
+    """Clave de caché: equipo + falla normalizados"""
+    clave = f"{normalizar_texto(tipo_equipo)}|{normalizar_texto(falla)}"
+    return hashlib.sha1(clave.encode("utf-8")).hexdigest()
+
+
+class DiagnosisCache:
+    """
+    Caché LRU en memoria con TTL para diagnósticos de IA.
+    Si se le pasan pool y escritor, también persiste en la tabla cache_diagnosticos
+    para sobrevivir reinicios (la memoria sigue siendo el primer nivel).
+    """
+
+    def __init__(self, max_entradas: int = 1000, ttl_segundos: float = 86400,
+                 pool: Optional[SQLitePool] = None, escritor: Optional[GroupCommitWriter] = None):
+        self.max_entradas = max_entradas
+        self.ttl_segundos = ttl_segundos
+        self.pool = pool
+        self.escritor = escritor
+        self._entradas = OrderedDict()
+        self.stats = {"aciertos": 0, "aciertos_bd": 0, "fallos": 0, "expirados": 0}
+
+    def estadisticas(self) -> dict:
+        consultas = self.stats["aciertos"] + self.stats["fallos"]
+        return {
+            **self.stats,
+            "entradas": len(self._entradas),
+            "tasa_aciertos": round(self.stats["aciertos"] / consultas, 3) if consultas else 0.0
+        }
+
+    def _guardar_memoria(self, huella: str, resultado: dict, creado: float):
+        self._entradas[huella] = (creado, resultado)
+        self._entradas.move_to_end(huella)
+        while len(self._entradas) > self.max_entradas:
+            self._entradas.popitem(last=False)
+
+    async def obtener(self, tipo_equipo: str, falla: str) -> Optional[dict]:
+        huella = huella_diagnostico(tipo_equipo, falla)
+        ahora = time.time()
+
+        entrada = self._entradas.get(huella)
+        if entrada:
+            creado, resultado = entrada
+            if ahora - creado <= self.ttl_segundos:
+                self._entradas.move_to_end(huella)
+                self.stats["aciertos"] += 1
+                return dict(resultado)
+            del self._entradas[huella]
+            self.stats["expirados"] += 1
+
+        if self.pool:
+            row = await self.pool.fetchone(
+                'SELECT resultado, creado FROM cache_diagnosticos WHERE huella=? AND creado>=?',
+                (huella, ahora - self.ttl_segundos)
+            )
+            if row:
+                resultado = json.loads(descomprimir_texto(row[0]))
+                self._guardar_memoria(huella, resultado, row[1])
+                self.stats["aciertos"] += 1
+                self.stats["aciertos_bd"] += 1
+                return dict(resultado)
+
+        self.stats["fallos"] += 1
+        return None
+
+    async def guardar(self, tipo_equipo: str, falla: str, resultado: dict):
+        huella = huella_diagnostico(tipo_equipo, falla)
+        creado = time.time()
+        self._guardar_memoria(huella, resultado, creado)
+
+        if self.escritor:
+            def _guardar(conn):
+                conn.execute(
+                    'INSERT OR REPLACE INTO cache_diagnosticos (huella, tipo_equipo, falla, resultado, creado) '
+                    'VALUES (?,?,?,?,?)',
+                    (huella, normalizar_texto(tipo_equipo), normalizar_texto(falla),
+                     comprimir_texto(json_compacto(resultado)), creado)
+                )
+                # Purgar entradas vencidas de paso
+                conn.execute('DELETE FROM cache_diagnosticos WHERE creado < ?', (creado - self.ttl_segundos,))
+            try:
+                await self.escritor.ejecutar(_guardar)
+            except sqlite3.Error as e:
+                logger.warning(f"No se pudo persistir el diagnóstico en caché: {e}")
+
+
+# --- CATEGORIZACIÓN DE FALLAS ---
+class FaultCategorizer:
+    """
+    Categoriza fallas con las reglas de la tabla reglas_categoria
+    (categoría, tipos de equipo, palabra clave, peso).
+
+    Por cada tipo de equipo todas sus palabras se compilan en una sola expresión
+    regular que recorre la falla (sin acentos) una vez; cada palabra encontrada
+    suma su peso a su categoría y gana la de mayor puntaje (a igualdad, la regla
+    definida primero). Las reglas se releen cada `revision_segundos`, así un
+    cambio hecho por otro worker también se aplica.
+    """
+
+    def __init__(self, pool: SQLitePool, escritor: GroupCommitWriter, revision_segundos: float = 30):
+        self.pool = pool
+        self.escritor = escritor
+        self.revision_segundos = revision_segundos
+        self._reglas = None
+        self._por_equipo = {}
+        self._revisado = 0.0
+
+    @staticmethod
+    def _equipos(equipos: str) -> list:
+        return [plegar_texto(e).strip() or '*' for e in (equipos or '*').split(',')]
+
+    def _compilar(self, reglas: list):
+        """reglas: [(id, categoria, equipos, palabra, peso)] ordenadas por id"""
+        orden = {}
+        por_equipo = {}
+        for _, categoria, equipos, palabra, peso in reglas:
+            palabra = plegar_texto(palabra).strip()
+            if not palabra:
+                continue
+            orden.setdefault(categoria, len(orden))
+            for equipo in self._equipos(equipos):
+                por_equipo.setdefault(equipo, {}).setdefault(palabra, []).append((categoria, peso))
+
+        # Las reglas comodín aplican a todos los equipos
+        comodin = por_equipo.pop('*', {})
+        compiladas = {}
+        for equipo, palabras in [*por_equipo.items(), ('*', {})]:
+            combinadas = {p: list(v) for p, v in comodin.items()}
+            for palabra, destinos in palabras.items():
+                combinadas.setdefault(palabra, []).extend(destinos)
+            if not combinadas:
+                continue
+            # Las palabras más largas primero: "no imprime" antes que "imprime"
+            patron = re.compile("|".join(
+                re.escape(p) for p in sorted(combinadas, key=len, reverse=True)
+            ))
+            compiladas[equipo] = (patron, combinadas)
+
+        self._reglas = reglas
+        self._orden = orden
+        self._por_equipo = compiladas
+
+    async def recargar(self, forzar: bool = False):
+        """Relee las reglas y recompila solo si cambiaron"""
+        ahora = time.monotonic()
+        if not forzar and self._reglas is not None and ahora - self._revisado < self.revision_segundos:
+            return
+        self._revisado = ahora
+        reglas = await self.pool.fetchall(
+            'SELECT id, categoria, equipos, palabra, peso FROM reglas_categoria ORDER BY id'
+        )
+        if reglas != self._reglas:
+            self._compilar(reglas)
+            logger.info(f"Reglas de categorización cargadas: {len(reglas)} palabras clave")
+
+    def puntuar(self, tipo_equipo: str, falla: str) -> list:
+        """[(categoria, puntaje)] de mayor a menor puntaje"""
+        compilado = self._por_equipo.get(plegar_texto(tipo_equipo).strip()) or self._por_equipo.get('*')
+        if not compilado:
+            return []
+        patron, palabras = compilado
+        puntajes = {}
+        # Cada palabra cuenta una vez aunque se repita en la descripción
+        for palabra in set(patron.findall(plegar_texto(falla))):
+            for categoria, peso in palabras[palabra]:
+                puntajes[categoria] = puntajes.get(categoria, 0) + peso
+        return sorted(
+            ((c, p) for c, p in puntajes.items() if p > 0),
+            key=lambda cp: (-cp[1], self._orden[cp[0]])
+        )
+
+    def categorizar(self, tipo_equipo: str, falla: str) -> str:
+        puntajes = self.puntuar(tipo_equipo, falla or '')
+        return puntajes[0][0] if puntajes else CATEGORIA_POR_DEFECTO
+
+    async def listar_reglas(self) -> list:
+        """Reglas agrupadas como las recibe reemplazar_reglas"""
+        filas = await self.pool.fetchall(
+            'SELECT categoria, equipos, palabra, peso FROM reglas_categoria ORDER BY id'
+        )
+        grupos = OrderedDict()
+        for categoria, equipos, palabra, peso in filas:
+            grupos.setdefault((categoria, equipos, peso), []).append(palabra)
+        return [
+            {"categoria": categoria, "equipos": equipos, "palabras": palabras, "peso": peso}
+            for (categoria, equipos, peso), palabras in grupos.items()
+        ]
+
+    async def reemplazar_reglas(self, reglas: list) -> int:
+        """Sustituye todas las reglas: [{categoria, equipos, palabras, peso}]"""
+        filas = [
+            (r["categoria"], r.get("equipos") or '*', palabra, r.get("peso", 1.0))
+            for r in reglas for palabra in r["palabras"] if palabra.strip()
+        ]
+        def _reemplazar(conn):
+            conn.execute('DELETE FROM reglas_categoria')
+            conn.executemany(
+                'INSERT INTO reglas_categoria (categoria, equipos, palabra, peso) VALUES (?,?,?,?)', filas
+            )
+        await self.escritor.ejecutar(_reemplazar)
+        await self.recargar(forzar=True)
+        return len(filas)
+
+    async def recategorizar_todo(self, lote: int = 5000) -> dict:
+        """
+        Vuelve a categorizar todos los tickets con las reglas actuales.
+        Lee por bloques de id y solo escribe los que cambian de categoría.
+        """
+        await self.recargar(forzar=True)
+        revisados = cambiados = 0
+        ultimo_id = 0
+        while True:
+            filas = await self.pool.fetchall(
+                'SELECT id, tipo_equipo, falla_detallada, categoria FROM tickets '
+                'WHERE id > ? ORDER BY id LIMIT ?',
+                (ultimo_id, lote)
+            )
+            if not filas:
+                break
+            ultimo_id = filas[-1][0]
+            revisados += len(filas)
+            cambios = []
+            for ticket_id, tipo_equipo, falla, categoria in filas:
+                nueva = self.categorizar(tipo_equipo or '', falla or '')
+                if nueva != categoria:
+                    cambios.append((nueva, ticket_id))
+            if cambios:
+                await self.escritor.ejecutar(
+                    lambda conn, cambios=cambios: conn.executemany(
+                        'UPDATE tickets SET categoria=? WHERE id=?', cambios
+                    )
+                )
+                cambiados += len(cambios)
+        return {"revisados": revisados, "cambiados": cambiados}
+
+
+# --- CLIENTE DEEPSEEK ---
+class CircuitBreaker:
+    """
+    Circuit breaker simple: tras `umbral_fallos` fallos consecutivos se abre y
+    rechaza llamadas durante `tiempo_apertura` segundos; luego deja pasar una
+    llamada de prueba (semi-abierto) y se cierra si tiene éxito.
+    """
+
+    def __init__(self, umbral_fallos: int = 5, tiempo_apertura: float = 30):
+        self.umbral_fallos = umbral_fallos
+        self.tiempo_apertura = tiempo_apertura
+        self.fallos_consecutivos = 0
+        self.abierto_desde: Optional[float] = None
+        self._prueba_en_curso = False
+
+    @property
+    def estado(self) -> str:
+        if self.abierto_desde is None:
+            return "cerrado"
+        if time.monotonic() - self.abierto_desde >= self.tiempo_apertura:
+            return "semi_abierto"
+        return "abierto"
+
+    def permitir(self) -> bool:
+        estado = self.estado
+        if estado == "cerrado":
+            return True
+        if estado == "semi_abierto" and not self._prueba_en_curso:
+            self._prueba_en_curso = True
+            return True
+        return False
+
+    def cancelar_prueba(self):
+        """La llamada permitida no llegó a ejecutarse; otra podrá hacer la prueba"""
+        self._prueba_en_curso = False
+
+    def registrar_exito(self):
+        self.fallos_consecutivos = 0
+        self.abierto_desde = None
+        self._prueba_en_curso = False
+
+    def registrar_fallo(self):
+        self.fallos_consecutivos += 1
+        if self._prueba_en_curso or self.fallos_consecutivos >= self.umbral_fallos:
+            if self.abierto_desde is None or self._prueba_en_curso:
+                logger.warning(f"Circuit breaker abierto tras {self.fallos_consecutivos} fallos consecutivos")
+            self.abierto_desde = time.monotonic()
+        self._prueba_en_curso = False
+
+
+class DeepSeekError(Exception):
+    pass
+
+
+def formatear_pasos(pasos: list) -> str:
+    lineas = "\n".join([f"• {paso}" for paso in pasos])
+    return f"Pasos de diagnóstico:\n{lineas}"
+
+
+def extraer_pasos_completos(texto: str) -> Optional[list]:
+    """
+    Busca en una respuesta JSON parcial el arreglo "pasos"; lo retorna solo cuando
+    ya llegó completo (el cierre "]"), o None si aún falta texto.
+    """
+    inicio = texto.find('"pasos"')
+    if inicio < 0:
+        return None
+    corchete = texto.find('[', inicio)
+    if corchete < 0:
+        return None
+    try:
+        pasos, _ = json.JSONDecoder().raw_decode(texto, corchete)
+    except json.JSONDecodeError:
+        return None
+    return pasos if isinstance(pasos, list) else None
+
+
+class DeepSeekClient:
+    def __init__(self, api_key: str, model: str = "deepseek-chat", max_concurrencia: int = 4,
+                 timeout: float = 10, umbral_lento: float = 8,
+                 umbral_fallos: int = 5, tiempo_apertura: float = 30,
+                 cache: Optional[DiagnosisCache] = None,
+                 base_url: str = "https://api.deepseek.com/v1"):
+        self.api_key = api_key
+        self.cache = cache
+        self.model = model
+        self.base_url = base_url.rstrip("/")
+        self.timeout = timeout
+        self.umbral_lento = umbral_lento
+        self.max_concurrencia = max_concurrencia
+        self.circuito = CircuitBreaker(umbral_fallos, tiempo_apertura)
+        self._semaforo = asyncio.Semaphore(max_concurrencia)
+        self._session: Optional[aiohttp.ClientSession] = None
+        self.stats = {
+            "llamadas": 0,
+            "exitos": 0,
+            "errores": 0,
+            "timeouts": 0,
+            "lentas": 0,
+            "rechazadas_circuito": 0,
+            "rechazadas_saturacion": 0,
+            "en_curso": 0,
+            "latencia_total_ms": 0.0,
+            "latencia_max_ms": 0.0
+        }
+
+    async def iniciar(self):
+        """Crea la sesión HTTP compartida (conexiones TLS reutilizadas entre diagnósticos)"""
+        self._session = aiohttp.ClientSession(
+            connector=aiohttp.TCPConnector(limit=self.max_concurrencia, ttl_dns_cache=300, keepalive_timeout=60),
+            timeout=aiohttp.ClientTimeout(total=self.timeout),
+            headers={
+                "Authorization": f"Bearer {self.api_key}",
+                "Content-Type": "application/json"
+            }
+        )
+
+    async def cerrar(self):
+        if self._session:
+            await self._session.close()
+            self._session = None
+
+    def estadisticas(self) -> dict:
+        completadas = self.stats["exitos"] + self.stats["errores"]
+        return {
+            **self.stats,
+            "latencia_promedio_ms": round(self.stats["latencia_total_ms"] / completadas, 1) if completadas else 0.0,
+            "circuito": self.circuito.estado,
+            "cache": self.cache.estadisticas() if self.cache else None
+        }
+
+    async def diagnosticar_problema(self, tipo_equipo: str, falla_desc: str, historial: list,
+                                    al_obtener_pasos: Optional[Callable] = None) -> dict:
+        """
+        Analiza el problema y sugiere soluciones usando DeepSeek.
+        Si se pasa al_obtener_pasos, la respuesta se pide en streaming y el callback
+        (async) recibe la lista de pasos apenas llega completa, antes del final.
+        """
+        if not self.api_key:
+            logger.warning("API Key de DeepSeek no configurada")
+            return {
+                "analisis": "No se pudo realizar análisis (API no configurada)",
+                "sugerencias": "Por favor, contacta al soporte técnico.",
+                "requiere_tecnico": True
+            }
+
+        # Fallas frecuentes ("impresora atascada") ya diagnosticadas se responden al instante
+        if self.cache:
+            en_cache = await self.cache.obtener(tipo_equipo, falla_desc)
+            if en_cache:
+                return en_cache
+
+        # Fallar rápido si la API viene fallando o está lenta
+        if not self.circuito.permitir():
+            self.stats["rechazadas_circuito"] += 1
+            return {
+                "analisis": "Servicio de IA temporalmente no disponible",
+                "sugerencias": "Por favor, contacta al soporte técnico.",
+                "requiere_tecnico": True
+            }
+
+        try:
+            with tracer.tramo("deepseek.espera"):
+                await asyncio.wait_for(self._semaforo.acquire(), timeout=self.timeout)
+        except asyncio.TimeoutError:
+            self.stats["rechazadas_saturacion"] += 1
+            self.circuito.cancelar_prueba()
+            logger.warning("DeepSeek saturado: demasiados diagnósticos simultáneos")
+            return {
+                "analisis": "Servicio de IA saturado",
+                "sugerencias": "Por favor, contacta al soporte técnico.",
+                "requiere_tecnico": True
+            }
+
+        sistema_prompt = f"""Eres un asistente de soporte técnico experto. Un usuario reporta un problema en su equipo.
+
+EQUIPAMIENTO: {tipo_equipo}
+DESCRIPCIÓN DE LA FALLA: {falla_desc}
+
+Analiza el problema y:
+1. Proporciona 2-3 pasos de diagnóstico que el usuario puede seguir
+2. Determina si es probable que requiera intervención técnica presencial
+3. Sé conciso pero profesional
+
+Responde en formato JSON con estructura:
+{{"pasos": ["paso 1", "paso 2", "paso 3"], "requiere_tecnico": true/false, "urgencia": "alta"/"media"/"baja"}}"""
+
+        self.stats["llamadas"] += 1
+        self.stats["en_curso"] += 1
+        inicio = time.monotonic()
+        try:
+            with tracer.tramo("deepseek"):
+                respuesta = await self._consultar(sistema_prompt, al_obtener_pasos)
+            latencia = time.monotonic() - inicio
+            self._registrar_latencia(latencia, "lenta" if latencia > self.umbral_lento else "exito")
+            self.stats["exitos"] += 1
+            if latencia > self.umbral_lento:
+                # Una respuesta lenta cuenta como fallo para el circuito
+                self.stats["lentas"] += 1
+                self.circuito.registrar_fallo()
+            else:
+                self.circuito.registrar_exito()
+        except asyncio.TimeoutError:
+            self._registrar_latencia(time.monotonic() - inicio, "timeout")
+            self.stats["errores"] += 1
+            self.stats["timeouts"] += 1
+            self.circuito.registrar_fallo()
+            logger.error("Timeout en DeepSeek")
+            return {
+                "analisis": "Error: tiempo de espera agotado",
+                "sugerencias": "Por favor, contacta al soporte técnico.",
+                "requiere_tecnico": True
+            }
+        except DeepSeekError as e:
+            self._registrar_latencia(time.monotonic() - inicio, "error_http")
+            self.stats["errores"] += 1
+            self.circuito.registrar_fallo()
+            logger.error(f"Error DeepSeek: {str(e)}")
+            return {
+                "analisis": "Error al conectar con el servicio de IA",
+                "sugerencias": "Por favor, intenta nuevamente",
+                "requiere_tecnico": True
+            }
+        except Exception as e:
+            self._registrar_latencia(time.monotonic() - inicio, "error")
+            self.stats["errores"] += 1
+            self.circuito.registrar_fallo()
+            logger.error(f"Error en DeepSeek: {str(e)}")
+            return {
+                "analisis": f"Error: {str(e)}",
+                "sugerencias": "Por favor, contacta al soporte técnico.",
+                "requiere_tecnico": True
+            }
+        finally:
+            self.stats["en_curso"] -= 1
+            self._semaforo.release()
+
+        try:
+            resultado = json.loads(respuesta)
+            pasos = formatear_pasos(resultado.get("pasos", []))
+            requiere_tecnico = resultado.get("requiere_tecnico", True)
+
+            diagnostico = {
+                "analisis": pasos,
+                "sugerencias": pasos,
+                "requiere_tecnico": requiere_tecnico
+            }
         except json.JSONDecodeError:
-            historial = []
-        
-        # Agregar mensaje del técnico al historial
+            # Si no es JSON válido, parsear la respuesta como texto
+            diagnostico = {
+                "analisis": respuesta,
+                "sugerencias": respuesta,
+                "requiere_tecnico": True
+            }
+
+        # Solo se cachean respuestas reales de la IA, nunca los mensajes de error
+        if self.cache:
+            await self.cache.guardar(tipo_equipo, falla_desc, diagnostico)
+        return diagnostico
+
+    def _registrar_latencia(self, segundos: float, resultado: str):
+        METRICA_DEEPSEEK.observar(segundos, resultado=resultado)
+        ms = segundos * 1000
+        self.stats["latencia_total_ms"] += ms
+        self.stats["latencia_max_ms"] = max(self.stats["latencia_max_ms"], ms)
+
+    async def _consultar(self, sistema_prompt: str, al_obtener_pasos: Optional[Callable] = None) -> str:
+        """Hace la llamada a /chat/completions y retorna el contenido de la respuesta"""
+        if not self._session:
+            await self.iniciar()
+        async with self._session.post(
+            f"{self.base_url}/chat/completions",
+            json={
+                "model": self.model,
+                "messages": [
+                    {"role": "system", "content": sistema_prompt},
+                    {"role": "user", "content": "Analiza el problema"}
+                ],
+                "max_tokens": DEEPSEEK_MAX_TOKENS,
+                "temperature": 0.7,
+                "stream": al_obtener_pasos is not None
+            }
+        ) as resp:
+            if resp.status != 200:
+                raise DeepSeekError(f"HTTP {resp.status}")
+
+            if al_obtener_pasos is None:
+                data = await resp.json()
+                return data['choices'][0]['message']['content']
+
+            # Streaming SSE: líneas "data: {...}" con fragmentos en choices[0].delta.content
+            partes = []
+            pasos_entregados = False
+            async for linea in resp.content:
+                linea = linea.decode("utf-8").strip()
+                if not linea.startswith("data:"):
+                    continue
+                carga = linea[5:].strip()
+                if carga == "[DONE]":
+                    break
+                try:
+                    fragmento = json.loads(carga)['choices'][0]['delta'].get('content') or ""
+                except (json.JSONDecodeError, KeyError, IndexError):
+                    continue
+                partes.append(fragmento)
+
+                if not pasos_entregados and "]" in fragmento:
+                    pasos = extraer_pasos_completos("".join(partes))
+                    if pasos is not None:
+                        pasos_entregados = True
+                        await al_obtener_pasos(pasos)
+
+            return "".join(partes)
+
+
+def etag_de(*partes) -> str:
+    """Construye un ETag débil a partir de versiones de datos"""
+    return 'W/"' + "-".join(str(p) for p in partes) + '"'
+
+
+def huella_parametros(*valores) -> str:
+    """
+    Resumen corto de los parámetros de una consulta para incluirlo en el ETag:
+    la misma versión de datos con otro filtro o página es otro cuerpo. Los
+    valores son texto libre, así que se resumen con un hash en vez de copiarlos.
+    """
+    return hashlib.sha1(json_compacto(valores).encode("utf-8")).hexdigest()[:12]
+
+
+def coincide_etag(request: Request, etag: str) -> bool:
+    """True si el cliente ya tiene esta versión (If-None-Match)"""
+    if_none_match = request.headers.get("if-none-match")
+    if not if_none_match:
+        return False
+    etags = [e.strip() for e in if_none_match.split(",")]
+    return etag in etags or "*" in etags
+
+
+def respuesta_con_etag(request: Request, etag: str, contenido: Optional[dict] = None) -> Response:
+    """
+    304 si el ETag coincide; si no, el JSON con su ETag.
+    "no-cache" obliga al navegador a revalidar en cada poll, que cuesta un 304 vacío.
+    """
+    headers = {"ETag": etag, "Cache-Control": "no-cache"}
+    if contenido is None or coincide_etag(request, etag):
+        return Response(status_code=304, headers=headers)
+    return RespuestaJSON(contenido, headers=headers)
+
+
+def verificar_token(authorization: str = Header(...)):
+    """Middleware para verificar el token de autenticación"""
+    token = authorization.replace("Bearer ", "")
+    if token != API_TOKEN:
+        logger.warning("Intento de acceso no autorizado con token inválido")
+        raise HTTPException(status_code=401, detail="No autorizado")
+    return True
+
+# --- ENVÍO A WHATSAPP ---
+class BridgeError(Exception):
+    """Error al enviar al puente de WhatsApp; reintentable si el puente puede recuperarse"""
+
+    def __init__(self, mensaje: str, status: Optional[int] = None, reintentable: bool = True):
+        super().__init__(mensaje)
+        self.status = status
+        self.reintentable = reintentable
+
+
+class BridgeClient:
+    """Cliente HTTP keep-alive compartido hacia /enviar-mensaje de whatsapp-bridge.js"""
+
+    def __init__(self, base_url: str, token: str, timeout: int = 5, max_conexiones: int = 10):
+        self.base_url = base_url
+        self.token = token
+        self.timeout = timeout
+        self.max_conexiones = max_conexiones
+        self._session: Optional[aiohttp.ClientSession] = None
+
+    async def iniciar(self):
+        self._session = aiohttp.ClientSession(
+            connector=aiohttp.TCPConnector(limit=self.max_conexiones, keepalive_timeout=60),
+            timeout=aiohttp.ClientTimeout(total=self.timeout),
+            headers={"Authorization": f"Bearer {self.token}"}
+        )
+
+    async def cerrar(self):
+        if self._session:
+            await self._session.close()
+            self._session = None
+
+    async def enviar(self, numero: str, texto: str):
+        if not self._session:
+            await self.iniciar()
+        inicio = time.perf_counter()
+        resultado = "error"
+        try:
+            async with self._session.post(
+                f"{self.base_url}/enviar-mensaje",
+                json={"numero": numero, "texto": texto}
+            ) as resp:
+                if resp.status >= 400:
+                    detalle = await resp.text()
+                    # 503 = WhatsApp reconectando; 429/5xx también se pueden reintentar
+                    reintentable = resp.status == 429 or resp.status >= 500
+                    resultado = f"http_{resp.status}"
+                    raise BridgeError(f"HTTP {resp.status}: {detalle}", status=resp.status, reintentable=reintentable)
+                resultado = "ok"
+        except asyncio.TimeoutError:
+            resultado = "timeout"
+            raise BridgeError("WhatsApp no responde (timeout)", status=504)
+        except aiohttp.ClientError as e:
+            resultado = "conexion"
+            raise BridgeError(f"Error de conexión con el puente: {str(e)}", status=503)
+        finally:
+            duracion = time.perf_counter() - inicio
+            METRICA_PUENTE.observar(duracion, resultado=resultado)
+            tracer.registrar("puente.enviar", inicio, duracion)
+
+
+class OutboundQueue:
+    """
+    Cola persistente (tabla mensajes_salientes) para mensajes que el puente no aceptó.
+    Un worker los reintenta con backoff exponencial y concurrencia acotada,
+    respetando el orden por número de teléfono.
+    """
+
+    def __init__(self, pool: SQLitePool, escritor: GroupCommitWriter, cliente: BridgeClient, concurrencia: int = 4,
+                 max_intentos: int = 8, backoff_base: float = 2, backoff_max: float = 300):
+        self.pool = pool
+        self.escritor = escritor
+        self.cliente = cliente
+        self.concurrencia = concurrencia
+        self.max_intentos = max_intentos
+        self.backoff_base = backoff_base
+        self.backoff_max = backoff_max
+        self._numeros_en_cola = set()
+        self._despertar = asyncio.Event()
+        self._tarea: Optional[asyncio.Task] = None
+
+    def estadisticas(self) -> dict:
+        return {"destinatarios_en_cola": len(self._numeros_en_cola)}
+
+    def _backoff(self, intentos: int) -> float:
+        return min(self.backoff_base * (2 ** intentos), self.backoff_max)
+
+    async def iniciar(self):
+        filas = await self.pool.fetchall(
+            "SELECT DISTINCT numero FROM mensajes_salientes WHERE estado = 'pendiente'"
+        )
+        self._numeros_en_cola = {f[0] for f in filas}
+        if self._numeros_en_cola:
+            logger.info(f"{len(self._numeros_en_cola)} destinatarios con mensajes pendientes de envío")
+        self._tarea = asyncio.create_task(self._bucle())
+
+    async def detener(self):
+        if self._tarea:
+            self._tarea.cancel()
+            try:
+                await self._tarea
+            except asyncio.CancelledError:
+                pass
+            self._tarea = None
+
+    async def encolar(self, numero: str, texto: str, error: Optional[str] = None, intentos: int = 0) -> int:
+        def _insertar(conn):
+            cursor = conn.execute(
+                'INSERT INTO mensajes_salientes (numero, texto, intentos, proximo_intento, ultimo_error, creado) '
+                'VALUES (?,?,?,?,?,?)',
+                (numero, texto, intentos, time.time() + (self._backoff(intentos) if intentos else 0), error,
+                 datetime.datetime.now().isoformat())
+            )
+            return cursor.lastrowid
+        mensaje_id = await self.escritor.ejecutar(_insertar)
+        self._numeros_en_cola.add(numero)
+        self._despertar.set()
+        return mensaje_id
+
+    async def enviar_o_encolar(self, numero: str, texto: str) -> bool:
+        """
+        Intenta enviar de inmediato; si el puente no está disponible el mensaje queda en cola.
+        Retorna True si se envió, False si quedó en cola. Los errores no reintentables se propagan.
+        """
+        if numero in self._numeros_en_cola:
+            # Hay mensajes anteriores esperando: encolar para no desordenar la conversación
+            await self.encolar(numero, texto)
+            return False
+        try:
+            await self.cliente.enviar(numero, texto)
+            return True
+        except BridgeError as e:
+            if not e.reintentable:
+                raise
+            logger.warning(f"No se pudo enviar a {numero} ({e}); mensaje en cola para reintento")
+            await self.encolar(numero, texto, error=str(e), intentos=1)
+            return False
+
+    async def _tomar_pendientes(self, limite: int = 50) -> list:
+        """Reserva los mensajes vencidos (lease de 60 s por si el proceso muere a mitad de envío)"""
+        def _tomar(conn):
+            ahora = time.time()
+            # Un mensaje no sale antes que otro más antiguo del mismo número que siga esperando
+            return conn.execute(
+                'UPDATE mensajes_salientes SET proximo_intento = ? '
+                'WHERE id IN (SELECT m.id FROM mensajes_salientes m '
+                "             WHERE m.estado = 'pendiente' AND m.proximo_intento <= ? "
+                '               AND NOT EXISTS (SELECT 1 FROM mensajes_salientes a '
+                '                               WHERE a.numero = m.numero AND a.id < m.id '
+                "                                 AND a.estado = 'pendiente' AND a.proximo_intento > ?) "
+                '             ORDER BY m.id LIMIT ?) '
+                'RETURNING id, numero, texto, intentos',
+                (ahora + 60, ahora, ahora, limite)
+            ).fetchall()
+        filas = await self.escritor.ejecutar(_tomar)
+        return sorted(filas)
+
+    async def _proximo_vencimiento(self) -> Optional[float]:
+        row = await self.pool.fetchone(
+            "SELECT MIN(proximo_intento) FROM mensajes_salientes WHERE estado = 'pendiente'"
+        )
+        return row[0] if row else None
+
+    async def _resultado(self, mensaje_id: int, error: Optional[BridgeError], intentos: int):
+        def _actualizar(conn):
+            if error is None:
+                conn.execute('DELETE FROM mensajes_salientes WHERE id = ?', (mensaje_id,))
+            elif not error.reintentable or intentos >= self.max_intentos:
+                conn.execute(
+                    "UPDATE mensajes_salientes SET estado = 'fallido', intentos = ?, ultimo_error = ? WHERE id = ?",
+                    (intentos, str(error), mensaje_id)
+                )
+            else:
+                conn.execute(
+                    'UPDATE mensajes_salientes SET intentos = ?, proximo_intento = ?, ultimo_error = ? WHERE id = ?',
+                    (intentos, time.time() + self._backoff(intentos), str(error), mensaje_id)
+                )
+        await self.escritor.ejecutar(_actualizar)
+
+    async def _posponer(self, mensaje_ids: list, proximo_intento: float):
+        """Libera mensajes reservados que no se llegaron a intentar"""
+        def _actualizar(conn):
+            conn.execute(
+                f"UPDATE mensajes_salientes SET proximo_intento = ? "
+                f"WHERE id IN ({','.join('?' * len(mensaje_ids))})",
+                (proximo_intento, *mensaje_ids)
+            )
+        await self.escritor.ejecutar(_actualizar)
+
+    async def _enviar_grupo(self, semaforo: asyncio.Semaphore, numero: str, mensajes: list):
+        """Envía en orden los mensajes de un número; si uno falla, los siguientes esperan"""
+        async with semaforo:
+            for posicion, (mensaje_id, _, texto, intentos) in enumerate(mensajes):
+                try:
+                    await self.cliente.enviar(numero, texto)
+                    await self._resultado(mensaje_id, None, intentos + 1)
+                    logger.info(f"Mensaje en cola #{mensaje_id} enviado a {numero}")
+                except BridgeError as e:
+                    await self._resultado(mensaje_id, e, intentos + 1)
+                    logger.warning(f"Reintento {intentos + 1} fallido para mensaje #{mensaje_id} a {numero}: {e}")
+                    # Los siguientes no se intentaron: solo esperan al mismo reintento,
+                    # sin sumar intentos ni error
+                    restantes = [m[0] for m in mensajes[posicion + 1:]]
+                    if restantes:
+                        await self._posponer(restantes, time.time() + self._backoff(intentos + 1))
+                    return
+
+        row = await self.pool.fetchone(
+            "SELECT 1 FROM mensajes_salientes WHERE numero = ? AND estado = 'pendiente' LIMIT 1", (numero,)
+        )
+        if not row:
+            self._numeros_en_cola.discard(numero)
+
+    async def _bucle(self):
+        semaforo = asyncio.Semaphore(self.concurrencia)
+        while True:
+            try:
+                self._despertar.clear()
+                pendientes = await self._tomar_pendientes()
+                if pendientes:
+                    grupos = {}
+                    for fila in pendientes:
+                        grupos.setdefault(fila[1], []).append(fila)
+                    await asyncio.gather(*(
+                        self._enviar_grupo(semaforo, numero, mensajes) for numero, mensajes in grupos.items()
+                    ))
+                    continue
+
+                vencimiento = await self._proximo_vencimiento()
+                espera = 30 if vencimiento is None else max(0.0, min(30, vencimiento - time.time()))
+                try:
+                    await asyncio.wait_for(self._despertar.wait(), timeout=espera)
+                except asyncio.TimeoutError:
+                    pass
+            except asyncio.CancelledError:
+                raise
+            except Exception as e:
+                logger.error(f"Error en la cola de mensajes salientes: {str(e)}")
+                await asyncio.sleep(5)
+
+
+# --- PROCESAMIENTO DE MENSAJES ENTRANTES ---
+class InboundDispatcher:
+    """
+    Procesa los mensajes entrantes en orden por remitente: cada remitente tiene su
+    propia cola y a lo sumo una tarea activa, así dos mensajes seguidos nunca avanzan
+    la misma sesión a la vez. Un semáforo acota cuántas conversaciones se procesan
+    en paralelo y, si hay demasiados mensajes pendientes, se rechazan (HTTP 429)
+    para que el puente los reintente.
+    """
+
+    def __init__(self, procesar: Callable, max_concurrencia: int = 16,
+                 max_pendientes: int = 1000, max_por_remitente: int = 20):
+        self.procesar = procesar
+        self.max_concurrencia = max_concurrencia
+        self.max_pendientes = max_pendientes
+        self.max_por_remitente = max_por_remitente
+        self._semaforo = asyncio.Semaphore(max_concurrencia)
+        self._colas = {}  # remitente -> deque de argumentos pendientes
+        self._tareas = set()
+        self._pendientes = 0
+        self._en_proceso = 0
+        self.stats = {"procesados": 0, "errores": 0, "rechazados": 0}
+
+    def activo(self, remitente: str) -> bool:
+        return remitente in self._colas
+
+    def saturado(self, remitente: str) -> bool:
+        cola = self._colas.get(remitente)
+        return self._pendientes >= self.max_pendientes or (
+            cola is not None and len(cola) >= self.max_por_remitente
+        )
+
+    def encolar(self, remitente: str, *args, forzar: bool = False) -> bool:
+        """Agrega el mensaje a la cola del remitente; False si no hay capacidad"""
+        if not forzar and self.saturado(remitente):
+            self.stats["rechazados"] += 1
+            return False
+        cola = self._colas.get(remitente)
+        if cola is None:
+            cola = self._colas[remitente] = deque()
+            tarea = asyncio.create_task(self._atender(remitente, cola))
+            self._tareas.add(tarea)
+            tarea.add_done_callback(self._tareas.discard)
+        cola.append(args)
+        self._pendientes += 1
+        return True
+
+    async def _atender(self, remitente: str, cola: deque):
+        try:
+            while cola:
+                args = cola.popleft()
+                try:
+                    async with self._semaforo:
+                        self._en_proceso += 1
+                        try:
+                            await self.procesar(*args)
+                        finally:
+                            self._en_proceso -= 1
+                    self.stats["procesados"] += 1
+                except Exception as e:
+                    self.stats["errores"] += 1
+                    logger.error(f"Error procesando mensaje de {remitente}: {str(e)}")
+                finally:
+                    self._pendientes -= 1
+        finally:
+            # Sin await entre el último `while cola` y aquí: no se pierde ningún mensaje
+            del self._colas[remitente]
+
+    async def detener(self, timeout: float = 10):
+        """Espera a que terminen los mensajes en curso antes de apagar"""
+        if self._tareas:
+            await asyncio.wait(set(self._tareas), timeout=timeout)
+
+    def estadisticas(self) -> dict:
+        return {
+            **self.stats,
+            "pendientes": self._pendientes,
+            "en_proceso": self._en_proceso,
+            "remitentes_activos": len(self._colas)
+        }
+
+
+class InboundJournal:
+    """
+    Bitácora durable (tabla mensajes_entrantes) de los mensajes recibidos.
+    Cada mensaje se registra antes de responder al puente; un mensaje que el
+    puente reenvía con el mismo id_mensaje se ignora. Si el proceso muere antes
+    de procesarlo, otro worker (o este mismo al reiniciar) lo reclama cuando
+    vence su reserva y lo vuelve a procesar.
+    """
+
+    def __init__(self, pool: SQLitePool, escritor: GroupCommitWriter,
+                 reserva_segundos: float = 60, retencion_horas: float = 72):
+        self.pool = pool
+        self.escritor = escritor
+        self.reserva_segundos = reserva_segundos
+        self.retencion_horas = retencion_horas
+        self.en_memoria = set()  # ids encolados en este proceso y aún sin completar
+        self.stats = {"registrados": 0, "duplicados": 0, "reanudados": 0}
+
+    async def registrar(self, data: MensajeWA, imagen: Optional[str] = None) -> Optional[int]:
+        """Registra el mensaje; retorna su id o None si ya se había recibido"""
+        clave = f"{data.remitente}:{data.id_mensaje}" if data.id_mensaje else None
+        def _registrar(conn):
+            ahora = time.time()
+            cursor = conn.execute(
+                'INSERT OR IGNORE INTO mensajes_entrantes (clave, remitente, contenido, imagen, reclamado, recibido) '
+                'VALUES (?,?,?,?,?,?)',
+                (clave, data.remitente, data.contenido, imagen, ahora, ahora)
+            )
+            return cursor.lastrowid if cursor.rowcount else None
+        entrada_id = await self.escritor.ejecutar(_registrar)
+        if entrada_id is None:
+            self.stats["duplicados"] += 1
+        else:
+            self.stats["registrados"] += 1
+            self.en_memoria.add(entrada_id)
+        return entrada_id
+
+    async def completar(self, entrada_id: int):
+        self.en_memoria.discard(entrada_id)
+        await self.escritor.ejecutar(lambda conn: conn.execute(
+            "UPDATE mensajes_entrantes SET estado = 'procesado', procesado = ? WHERE id = ?",
+            (time.time(), entrada_id)
+        ))
+
+    async def reclamar_vencidas(self) -> list:
+        """
+        Renueva la reserva de los mensajes que este proceso tiene en memoria y
+        reclama los pendientes cuya reserva venció. Retorna [(id, MensajeWA, imagen)].
+        """
+        propias = list(self.en_memoria)
+        def _reclamar(conn):
+            ahora = time.time()
+            for i in range(0, len(propias), 500):
+                lote = propias[i:i + 500]
+                conn.execute(
+                    f'UPDATE mensajes_entrantes SET reclamado = ? WHERE id IN ({",".join("?" * len(lote))})',
+                    (ahora, *lote)
+                )
+            return conn.execute(
+                "UPDATE mensajes_entrantes SET reclamado = ? WHERE estado = 'pendiente' AND reclamado < ? "
+                "RETURNING id, remitente, contenido, imagen",
+                (ahora, ahora - self.reserva_segundos)
+            ).fetchall()
+        filas = sorted(await self.escritor.ejecutar(_reclamar))
+        self.stats["reanudados"] += len(filas)
+        for fila in filas:
+            self.en_memoria.add(fila[0])
+        return [(f[0], MensajeWA(remitente=f[1], contenido=f[2] or ""), f[3]) for f in filas]
+
+    async def purgar(self) -> int:
+        """Elimina los mensajes procesados fuera de la ventana de deduplicación"""
+        limite = time.time() - self.retencion_horas * 3600
+        cursor = await self.escritor.ejecutar(lambda conn: conn.execute(
+            "DELETE FROM mensajes_entrantes WHERE estado = 'procesado' AND procesado < ?", (limite,)
+        ))
+        return cursor.rowcount
+
+    def estadisticas(self) -> dict:
+        return {**self.stats, "en_memoria": len(self.en_memoria)}
+
+
+# --- EVENTOS EN VIVO ---
+class EventBus:
+    """
+    Fan-out en memoria de eventos hacia los dashboards conectados por SSE.
+    Cada suscriptor tiene una cola acotada; si un cliente lento la llena se
+    descartan sus eventos pendientes y recibe "resync" para recargar por ?since=.
+    """
+
+    def __init__(self, max_pendientes: int = 100):
+        self.max_pendientes = max_pendientes
+        self.suscriptores = set()
+        self._ultimo_id = 0
+
+    def publicar(self, tipo: str, datos: dict):
+        self._ultimo_id += 1
+        evento = {"id": self._ultimo_id, "tipo": tipo, "datos": datos}
+        for cola in list(self.suscriptores):
+            try:
+                cola.put_nowait(evento)
+            except asyncio.QueueFull:
+                while not cola.empty():
+                    cola.get_nowait()
+                cola.put_nowait({"id": self._ultimo_id, "tipo": "resync", "datos": {}})
+
+    @asynccontextmanager
+    async def suscribir(self):
+        cola = asyncio.Queue(maxsize=self.max_pendientes)
+        self.suscriptores.add(cola)
+        try:
+            yield cola
+        finally:
+            self.suscriptores.discard(cola)
+
+
+# --- LOGS DE CONVERSACIÓN ---
+class ConversationLogWriter:
+    """
+    Escribe los logs de conversación desde un hilo propio, fuera del event loop.
+
+    Modo "archivos": un archivo por ticket en subdirectorios AAAA/MM/DD.
+    Modo "segmentos": cada log se agrega como un miembro gzip al segmento diario
+    segmentos/AAAA-MM-DD.log.gz y el ticket guarda "seg:<segmento>:<offset>:<largo>",
+    así /ticket/{id}/log lo lee con un seek. Un índice .idx junto al segmento
+    registra ticket, offset y largo de cada miembro.
+
+    La compactación pasa los archivos sueltos con más de `compactar_dias` a
+    segmentos y la retención borra lo que tenga más de `retencion_dias` (0 = nunca).
+    """
+
+    PREFIJO_SEGMENTO = "seg:"
+    _NOMBRE_LOG = re.compile(r"ticket_(\d+)_(\d{8})_\d{6}\.log$")
+
+    def __init__(self, carpeta: str, modo: str = "archivos",
+                 retencion_dias: int = 0, compactar_dias: int = 0):
+        self.carpeta = carpeta
+        self.modo = modo
+        self.retencion_dias = retencion_dias
+        self.compactar_dias = compactar_dias
+        self.carpeta_segmentos = os.path.join(carpeta, "segmentos")
+        self._executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix="logs")
+        self._segmento = None  # (nombre, archivo, índice) abiertos para agregar
+        self._pendientes = 0
+
+    async def _en_hilo(self, fn: Callable, *args):
+        self._pendientes += 1
+        try:
+            return await asyncio.get_running_loop().run_in_executor(self._executor, functools.partial(fn, *args))
+        finally:
+            self._pendientes -= 1
+
+    def estadisticas(self) -> dict:
+        return {"pendientes": self._pendientes}
+
+    @staticmethod
+    def formatear(historial: list) -> str:
+        lineas = []
+        for msg in historial:
+            role = "USUARIO" if msg['role'] == 'user' else "SISTEMA"
+            timestamp = msg.get('timestamp', datetime.datetime.now().isoformat())
+            lineas.append(f"[{timestamp}] {role}: {msg['content']}\n")
+        return "".join(lineas)
+
+    async def escribir(self, ticket_id: int, historial: list) -> str:
+        """Escribe el log del ticket y retorna la referencia a guardar en log_file_path"""
+        return await self._en_hilo(self._escribir, ticket_id, list(historial), datetime.datetime.now())
+
+    def _escribir(self, ticket_id: int, historial: list, ahora: datetime.datetime) -> str:
+        datos = self.formatear(historial).encode("utf-8")
+        if self.modo == "segmentos":
+            return self._agregar_a_segmento(ahora.strftime("%Y-%m-%d"), ticket_id, datos)
+
+        relativo = "/".join([
+            ahora.strftime("%Y"), ahora.strftime("%m"), ahora.strftime("%d"),
+            f"ticket_{ticket_id:03d}_{ahora.strftime('%Y%m%d_%H%M%S')}.log"
+        ])
+        ruta = self.ruta_archivo(relativo)
+        os.makedirs(os.path.dirname(ruta), exist_ok=True)
+        with open(ruta, "wb") as f:
+            f.write(datos)
+        logger.info(f"Log guardado: {ruta}")
+        return relativo
+
+    def _agregar_a_segmento(self, dia: str, ticket_id: int, datos: bytes) -> str:
+        nombre = f"{dia}.log.gz"
+        if self._segmento is None or self._segmento[0] != nombre:
+            self._cerrar_segmento()
+            os.makedirs(self.carpeta_segmentos, exist_ok=True)
+            ruta = os.path.join(self.carpeta_segmentos, nombre)
+            self._segmento = (nombre, open(ruta, "ab"), open(ruta[:-len(".log.gz")] + ".idx", "a"))
+        _, archivo, indice = self._segmento
+        miembro = gzip.compress(datos)
+        # Otros workers agregan al mismo segmento: el offset, el miembro y su
+        # línea del índice se escriben juntos bajo un lock exclusivo del archivo
+        if fcntl:
+            fcntl.flock(archivo.fileno(), fcntl.LOCK_EX)
+        try:
+            offset = archivo.seek(0, os.SEEK_END)
+            archivo.write(miembro)
+            archivo.flush()
+            indice.write(f"{ticket_id}\t{offset}\t{len(miembro)}\n")
+            indice.flush()
+        finally:
+            if fcntl:
+                fcntl.flock(archivo.fileno(), fcntl.LOCK_UN)
+        return f"{self.PREFIJO_SEGMENTO}{nombre}:{offset}:{len(miembro)}"
+
+    def _cerrar_segmento(self):
+        if self._segmento:
+            self._segmento[1].close()
+            self._segmento[2].close()
+            self._segmento = None
+
+    def es_segmento(self, referencia: str) -> bool:
+        return referencia.startswith(self.PREFIJO_SEGMENTO)
+
+    def ruta_archivo(self, referencia: str) -> str:
+        # Los logs antiguos guardan solo el nombre (carpeta plana)
+        return os.path.join(self.carpeta, *referencia.split("/"))
+
+    async def leer_segmento(self, referencia: str) -> Optional[bytes]:
+        return await self._en_hilo(self._leer_segmento, referencia)
+
+    def _leer_segmento(self, referencia: str) -> Optional[bytes]:
+        nombre, offset, largo = referencia[len(self.PREFIJO_SEGMENTO):].rsplit(":", 2)
+        ruta = os.path.join(self.carpeta_segmentos, os.path.basename(nombre))
+        if not os.path.exists(ruta):
+            return None
+        with open(ruta, "rb") as f:
+            f.seek(int(offset))
+            return gzip.decompress(f.read(int(largo)))
+
+    @contextmanager
+    def mantenimiento_exclusivo(self):
+        """
+        Lock de archivo no bloqueante para compactar y purgar: con varios workers
+        sólo el que lo obtiene hace el mantenimiento, los demás lo saltean (False).
+        """
+        os.makedirs(self.carpeta, exist_ok=True)
+        with open(os.path.join(self.carpeta, ".mantenimiento.lock"), "a") as f:
+            if fcntl:
+                try:
+                    fcntl.flock(f.fileno(), fcntl.LOCK_EX | fcntl.LOCK_NB)
+                except BlockingIOError:
+                    yield False
+                    return
+            try:
+                yield True
+            finally:
+                if fcntl:
+                    fcntl.flock(f.fileno(), fcntl.LOCK_UN)
+
+    async def compactar(self) -> list:
+        """
+        Pasa a segmentos los archivos sueltos con más de `compactar_dias`.
+        Retorna [(ticket_id, referencia_anterior, referencia_nueva)]; los archivos
+        originales se borran con `borrar_compactados` después de actualizar la BD.
+        """
+        if not self.compactar_dias:
+            return []
+        limite = (datetime.date.today() - datetime.timedelta(days=self.compactar_dias)).strftime("%Y%m%d")
+        return await self._en_hilo(self._compactar, limite)
+
+    def _logs_sueltos(self):
+        """Genera (referencia, ticket_id, AAAAMMDD) de los archivos de log por ticket"""
+        for raiz, directorios, archivos in os.walk(self.carpeta):
+            if os.path.abspath(raiz) == os.path.abspath(self.carpeta_segmentos):
+                directorios[:] = []
+                continue
+            for nombre in archivos:
+                m = self._NOMBRE_LOG.match(nombre)
+                if m:
+                    relativo = os.path.relpath(os.path.join(raiz, nombre), self.carpeta)
+                    yield relativo.replace(os.sep, "/"), int(m.group(1)), m.group(2)
+
+    def _compactar(self, limite: str) -> list:
+        movidos = []
+        for relativo, ticket_id, dia in sorted(self._logs_sueltos(), key=lambda x: (x[2], x[0])):
+            if dia >= limite:
+                continue
+            with open(self.ruta_archivo(relativo), "rb") as f:
+                datos = f.read()
+            fecha = f"{dia[:4]}-{dia[4:6]}-{dia[6:]}"
+            movidos.append((ticket_id, relativo, self._agregar_a_segmento(fecha, ticket_id, datos)))
+        if self._segmento:
+            os.fsync(self._segmento[1].fileno())
+            self._cerrar_segmento()
+        return movidos
+
+    async def borrar_compactados(self, movidos: list):
+        await self._en_hilo(self._borrar_archivos, [relativo for _, relativo, _ in movidos])
+
+    def _borrar_archivos(self, relativos: list):
+        directorios = set()
+        for relativo in relativos:
+            ruta = self.ruta_archivo(relativo)
+            try:
+                os.remove(ruta)
+            except FileNotFoundError:
+                pass
+            directorios.add(os.path.dirname(ruta))
+        # Quitar los directorios de día/mes/año que quedaron vacíos
+        for directorio in sorted(directorios, key=len, reverse=True):
+            while os.path.abspath(directorio) != os.path.abspath(self.carpeta):
+                try:
+                    os.rmdir(directorio)
+                except OSError:
+                    break
+                directorio = os.path.dirname(directorio)
+
+    async def purgar(self) -> int:
+        """Borra segmentos y archivos con más de `retencion_dias`"""
+        if not self.retencion_dias:
+            return 0
+        limite = (datetime.date.today() - datetime.timedelta(days=self.retencion_dias)).strftime("%Y%m%d")
+        return await self._en_hilo(self._purgar, limite)
+
+    def _purgar(self, limite: str) -> int:
+        viejos = [relativo for relativo, _, dia in self._logs_sueltos() if dia < limite]
+        self._borrar_archivos(viejos)
+        borrados = len(viejos)
+        if os.path.isdir(self.carpeta_segmentos):
+            for nombre in os.listdir(self.carpeta_segmentos):
+                if nombre[:10].replace("-", "") < limite:
+                    if self._segmento and nombre.startswith(self._segmento[0][:10]):
+                        continue
+                    os.remove(os.path.join(self.carpeta_segmentos, nombre))
+                    borrados += 1
+        return borrados
+
+    def cerrar(self):
+        self._executor.submit(self._cerrar_segmento)
+        self._executor.shutdown(wait=True)
+
+
+# --- PERFILADOR ---
+class SamplingProfiler:
+    """
+    Perfilador por muestreo para una instancia en ejecución: un hilo lee la pila
+    del event loop (o de todos los hilos) cada `intervalo` segundos con
+    sys._current_frames() y acumula pilas colapsadas ("a;b;c N"), el formato
+    que leen flamegraph.pl y speedscope. No instrumenta el código, así que el
+    costo es proporcional a la frecuencia de muestreo y solo existe mientras corre.
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.hilo_loop: Optional[int] = None
+
+    def registrar_loop(self):
+        """Llamar desde el event loop para saber qué hilo muestrear"""
+        self.hilo_loop = threading.get_ident()
+
+    @staticmethod
+    def _pila(frame) -> str:
+        partes = []
+        while frame is not None:
+            codigo = frame.f_code
+            partes.append(f"{codigo.co_name} ({os.path.basename(codigo.co_filename)}:{frame.f_lineno})")
+            frame = frame.f_back
+        return ";".join(reversed(partes))
+
+    def _muestrear(self, segundos: float, intervalo: float, todos_los_hilos: bool) -> tuple:
+        pilas = {}
+        muestras = 0
+        propio = threading.get_ident()
+        nombres = {}
+        fin = time.monotonic() + segundos
+        while time.monotonic() < fin:
+            if todos_los_hilos:
+                nombres = {h.ident: h.name for h in threading.enumerate()}
+            for ident, frame in sys._current_frames().items():
+                if ident == propio or (not todos_los_hilos and ident != self.hilo_loop):
+                    continue
+                pila = self._pila(frame)
+                if todos_los_hilos:
+                    pila = f"{nombres.get(ident, ident)};{pila}"
+                pilas[pila] = pilas.get(pila, 0) + 1
+            muestras += 1
+            time.sleep(intervalo)
+        return pilas, muestras
+
+    async def perfilar(self, segundos: float, intervalo: float = 0.005, todos_los_hilos: bool = False) -> Optional[tuple]:
+        """(pilas colapsadas, muestras) o None si ya hay un perfil en curso"""
+        if not self._lock.acquire(blocking=False):
+            return None
+        try:
+            return await asyncio.to_thread(self._muestrear, segundos, intervalo, todos_los_hilos)
+        finally:
+            self._lock.release()
+
+
+# --- VARIANTES DE FOTOS ---
+class ImageVariantStore:
+    """
+    Miniaturas y versiones medianas de las fotos recibidas, para que el panel no
+    descargue originales de varios MB sólo para mostrar una vista previa.
+
+    Las variantes se generan en un pool de hilos propio (Pillow libera el GIL al
+    decodificar) apenas se guarda la foto, o bajo demanda si faltan. Como los
+    originales se nombran por el hash de su contenido, cada variante es inmutable
+    y se guarda en `variantes/<tamaño>/`. El espacio que ocupan está acotado por
+    `max_bytes`: al superarlo se borran las usadas menos recientemente (los
+    originales nunca se tocan). Sin Pillow instalado se sirven los originales.
+    """
+
+    TAMANOS = {"mini": 256, "medio": 1024}
+    CALIDAD = 80
+
+    def __init__(self, carpeta_fotos: str, max_bytes: int, hilos: int = 2):
+        self.carpeta_fotos = carpeta_fotos
+        self.carpeta = os.path.join(carpeta_fotos, "variantes")
+        self.max_bytes = max_bytes
+        try:
+            from PIL import Image, ImageOps, features
+            self._pil = (Image, ImageOps)
+            # WebP pesa bastante menos que JPEG a igual calidad; JPEG si libwebp no está
+            self.formato = "webp" if features.check("webp") else "jpeg"
+        except ImportError:
+            self._pil = None
+            self.formato = None
+        self._executor = ThreadPoolExecutor(max_workers=hilos, thread_name_prefix="miniaturas")
+        # Sólo se modifican desde el event loop: no necesitan lock
+        self._archivos: OrderedDict = OrderedDict()  # ruta -> bytes, de la menos a la más usada
+        self._total = 0
+        self._en_curso: dict = {}  # ruta -> Future de la generación en curso
+        self._tareas: set = set()
+        self.generadas = 0
+        self.aciertos = 0
+        self.expulsadas = 0
+        self.errores = 0
+
+    @property
+    def disponible(self) -> bool:
+        return self._pil is not None
+
+    async def iniciar(self):
+        """Reconstruye el índice LRU desde disco (por fecha de modificación)"""
+        if not self.disponible:
+            logger.warning("Pillow no está instalado: /fotos servirá sólo los originales (pip install Pillow)")
+            return
+        archivos = await asyncio.get_running_loop().run_in_executor(self._executor, self._escanear)
+        for ruta, tamano in archivos:
+            self._archivos[ruta] = tamano
+            self._total += tamano
+        logger.info(f"Variantes de fotos: {len(archivos)} archivos, {self._total / 1e6:.1f} MB")
+        self._expulsar()
+
+    def cerrar(self):
+        self._executor.shutdown(wait=False, cancel_futures=True)
+
+    def _escanear(self) -> list:
+        archivos = []
+        for tamano in self.TAMANOS:
+            carpeta = os.path.join(self.carpeta, tamano)
+            os.makedirs(carpeta, exist_ok=True)
+            with os.scandir(carpeta) as entradas:
+                for entrada in entradas:
+                    if not entrada.is_file():
+                        continue
+                    if entrada.name.endswith(".tmp"):
+                        # Restos de una generación interrumpida
+                        os.remove(entrada.path)
+                        continue
+                    estado = entrada.stat()
+                    archivos.append((estado.st_mtime, entrada.path, estado.st_size))
+        archivos.sort()
+        return [(ruta, tamano) for _, ruta, tamano in archivos]
+
+    def ruta(self, nombre: str, tamano: str) -> str:
+        extension = "webp" if self.formato == "webp" else "jpg"
+        return os.path.join(self.carpeta, tamano, f"{os.path.splitext(nombre)[0]}.{extension}")
+
+    def _generar(self, nombre: str, tamano: str, destino: str) -> int:
+        """Bloqueante; corre en el pool de miniaturas"""
+        Image, ImageOps = self._pil
+        lado = self.TAMANOS[tamano]
+        with METRICA_IMAGEN.medir(etapa=f"variante_{tamano}"):
+            with Image.open(os.path.join(self.carpeta_fotos, nombre)) as imagen:
+                # En JPEG decodifica directo a una escala reducida: mucho menos CPU y memoria
+                imagen.draft("RGB", (lado * 2, lado * 2))
+                imagen = ImageOps.exif_transpose(imagen)
+                imagen.thumbnail((lado, lado), Image.LANCZOS)
+                if imagen.mode not in ("RGB", "L"):
+                    imagen = imagen.convert("RGBA")
+                    fondo = Image.new("RGB", imagen.size, (255, 255, 255))
+                    fondo.paste(imagen, mask=imagen.getchannel("A"))
+                    imagen = fondo
+                temporal = f"{destino}.{threading.get_ident()}.tmp"
+                imagen.save(temporal, self.formato, quality=self.CALIDAD, optimize=True)
+            os.replace(temporal, destino)
+            return os.path.getsize(destino)
+
+    async def obtener(self, nombre: str, tamano: str) -> Optional[str]:
+        """
+        Ruta de la variante, generándola si hace falta. None si no se puede
+        generar (sin Pillow, archivo que no es imagen...): servir el original.
+        """
+        if not self.disponible:
+            return None
+        destino = self.ruta(nombre, tamano)
+        if destino in self._archivos:
+            self._archivos.move_to_end(destino)
+            self.aciertos += 1
+            return destino
+        futuro = self._en_curso.get(destino)
+        if futuro is None:
+            loop = asyncio.get_running_loop()
+            futuro = loop.run_in_executor(self._executor, self._generar, nombre, tamano, destino)
+            self._en_curso[destino] = futuro
+            futuro.add_done_callback(lambda f: self._generada(destino, f))
+        try:
+            # shield: si el cliente corta la petición la generación sigue para el próximo
+            await asyncio.shield(futuro)
+        except Exception:
+            return None
+        return destino
+
+    def _generada(self, destino: str, futuro: asyncio.Future):
+        self._en_curso.pop(destino, None)
+        if futuro.cancelled():
+            return
+        error = futuro.exception()
+        if error is not None:
+            self.errores += 1
+            logger.warning(f"No se pudo generar {os.path.relpath(destino, self.carpeta)}: {error}")
+            return
+        tamano = futuro.result()
+        self._total += tamano - self._archivos.pop(destino, 0)
+        self._archivos[destino] = tamano
+        self.generadas += 1
+        self._expulsar()
+
+    def _expulsar(self):
+        """
+        Borra las variantes menos usadas hasta volver bajo el límite. El borrado
+        es síncrono (unlink es barato) para no competir con una regeneración de
+        la misma ruta; la más reciente se conserva porque se está por servir.
+        """
+        while self._total > self.max_bytes and len(self._archivos) > 1:
+            ruta, tamano = self._archivos.popitem(last=False)
+            self._total -= tamano
+            self.expulsadas += 1
+            try:
+                os.remove(ruta)
+            except FileNotFoundError:
+                pass
+
+    def generar_en_segundo_plano(self, nombre: str):
+        """Prepara todas las variantes de una foto recién guardada sin esperar"""
+        if not self.disponible:
+            return
+        for tamano in self.TAMANOS:
+            tarea = asyncio.create_task(self.obtener(nombre, tamano))
+            self._tareas.add(tarea)
+            tarea.add_done_callback(self._tareas.discard)
+
+    def estadisticas(self) -> dict:
+        return {
+            "disponible": self.disponible,
+            "formato": self.formato,
+            "archivos": len(self._archivos),
+            "bytes": self._total,
+            "max_bytes": self.max_bytes,
+            "en_curso": len(self._en_curso),
+            "generadas": self.generadas,
+            "aciertos": self.aciertos,
+            "expulsadas": self.expulsadas,
+            "errores": self.errores
+        }
+
+
+# --- MONITOR DEL EVENT LOOP ---
+class EventLoopMonitor:
+    """
+    Mide cuánto se atrasa el event loop: duerme `intervalo` segundos y registra
+    el exceso sobre lo esperado. Un retraso alto indica trabajo bloqueante en el
+    loop (CPU o E/S síncrona) que demora a todas las conversaciones.
+    """
+
+    def __init__(self, intervalo: float = 0.25, muestras: int = 240):
+        self.intervalo = intervalo
+        self._retrasos = deque(maxlen=muestras)
+        self._maximo = 0.0
+        self._tarea: Optional[asyncio.Task] = None
+
+    async def iniciar(self):
+        self._tarea = asyncio.create_task(self._medir())
+
+    async def detener(self):
+        if self._tarea:
+            self._tarea.cancel()
+            try:
+                await self._tarea
+            except asyncio.CancelledError:
+                pass
+            self._tarea = None
+
+    async def _medir(self):
+        while True:
+            esperado = time.monotonic() + self.intervalo
+            await asyncio.sleep(self.intervalo)
+            retraso = max(0.0, time.monotonic() - esperado)
+            self._retrasos.append(retraso)
+            self._maximo = max(self._maximo, retraso)
+
+    def estadisticas(self) -> dict:
+        """Percentiles de las últimas muestras (ms) y máximo desde el arranque"""
+        ordenados = sorted(self._retrasos)
+        def percentil(p: float) -> float:
+            if not ordenados:
+                return 0.0
+            return round(ordenados[min(len(ordenados) - 1, int(p * len(ordenados)))] * 1000, 2)
+        return {
+            "retraso_ms_p50": percentil(0.50),
+            "retraso_ms_p99": percentil(0.99),
+            "retraso_ms_max": round(self._maximo * 1000, 2),
+            "muestras": len(ordenados)
+        }
+
+
+# --- INSTANCIAS GLOBALES ---
+conversation_manager = ConversationManager(
+    crear_session_store(SESSION_BACKEND),
+    timeout_minutes=SESSION_TIMEOUT_MINUTES
+)
+deepseek_client = DeepSeekClient(
+    DEEPSEEK_API_KEY,
+    DEEPSEEK_MODEL,
+    base_url=DEEPSEEK_BASE_URL,
+    max_concurrencia=DEEPSEEK_MAX_CONCURRENCIA,
+    timeout=DEEPSEEK_TIMEOUT_SECONDS,
+    umbral_lento=DEEPSEEK_LENTO_SECONDS,
+    umbral_fallos=DEEPSEEK_CIRCUITO_FALLOS,
+    tiempo_apertura=DEEPSEEK_CIRCUITO_APERTURA_SECONDS,
+    cache=DiagnosisCache(
+        max_entradas=DIAGNOSTICO_CACHE_MAX,
+        ttl_segundos=DIAGNOSTICO_CACHE_TTL_SECONDS,
+        pool=db_pool if DIAGNOSTICO_CACHE_PERSISTENTE else None,
+        escritor=escritor if DIAGNOSTICO_CACHE_PERSISTENTE else None
+    ) if DIAGNOSTICO_CACHE_MAX > 0 else None
+) if DEEPSEEK_API_KEY else None
+event_bus = EventBus()
+loop_monitor = EventLoopMonitor()
+image_variants = ImageVariantStore(CARPETA_FOTOS, int(MINIATURAS_MAX_MB * 1024 * 1024), hilos=MINIATURAS_HILOS)
+perfilador = SamplingProfiler()
+fault_categorizer = FaultCategorizer(db_pool, escritor)
+bridge_client = BridgeClient(
+    f"http://{IP_LAPTOP}:{PUERTO_LAPTOP}", API_TOKEN,
+    timeout=BRIDGE_TIMEOUT_SECONDS, max_conexiones=BRIDGE_MAX_CONEXIONES
+)
+outbound_queue = OutboundQueue(
+    db_pool, escritor, bridge_client,
+    concurrencia=SALIENTES_CONCURRENCIA,
+    max_intentos=SALIENTES_MAX_INTENTOS,
+    backoff_base=SALIENTES_BACKOFF_BASE,
+    backoff_max=SALIENTES_BACKOFF_MAX
+)
+log_writer = ConversationLogWriter(
+    CARPETA_LOGS,
+    modo=LOGS_MODO,
+    retencion_dias=LOGS_RETENCION_DIAS,
+    compactar_dias=LOGS_COMPACTAR_DIAS
+)
+
+# --- FUNCIONES AUXILIARES ---
+async def guardar_log_conversacion(ticket_id: int, sesion: ConversationSession) -> str:
+    """Guarda el historial de conversación como log (en el hilo del escritor de logs)"""
+    return await log_writer.escribir(ticket_id, sesion.historial)
+
+
+async def guardar_ticket(sesion: ConversationSession, estado: str = 'Pendiente',
+                         entrada_id: Optional[int] = None) -> int:
+    """Guarda el ticket completo en la BD; el historial va a ticket_messages"""
+    return await ticket_repo.insertar({
+        'cliente': limpiar_numero_telefono(sesion.remitente),
+        'nombre_usuario': sesion.datos.get('nombre', ''),
+        'departamento': sesion.datos.get('departamento', ''),
+        'tipo_equipo': sesion.datos.get('tipo_equipo', ''),
+        'numero_activo': sesion.datos.get('numero_activo', ''),
+        'descripcion': sesion.datos.get('falla', '')[:500],  # Resumen en descripcion
+        'falla_detallada': sesion.datos.get('falla', ''),
+        'estado': estado,
+        'categoria': sesion.datos.get('categoria', 'Soporte General'),
+        'fecha': datetime.datetime.now().strftime("%Y-%m-%d %H:%M"),
+        'estado_conversacion': 'completo',
+        'diagnostico_ia': sesion.datos.get('diagnostico', ''),
+        'requiere_tecnico': 1 if sesion.datos.get('requiere_tecnico', False) else 0,
+        'entrada_id': entrada_id
+    }, mensajes=sesion.historial)
+
+
+async def categorizar_falla(tipo_equipo: str, falla: str) -> str:
+    """Categoriza la falla según tipo de equipo y descripción (reglas en reglas_categoria)"""
+    await fault_categorizer.recargar()
+    return fault_categorizer.categorizar(tipo_equipo, falla)
+
+
+async def enviar_respuesta_whatsapp(numero: str, texto: str):
+    """Envía una respuesta al usuario vía WhatsApp (queda en cola si el puente no está disponible)"""
+    try:
+        if await outbound_queue.enviar_o_encolar(numero, texto):
+            logger.info(f"Respuesta enviada a {numero}")
+    except BridgeError as e:
+        logger.error(f"Error HTTP enviando respuesta a {numero}: {str(e)}")
+    except Exception as e:
+        logger.error(f"Error enviando respuesta a {numero}: {str(e)}")
+
+
+def tamano_base64(imagen_b64: str) -> int:
+    """Tamaño decodificado a partir de la longitud del base64, sin decodificar"""
+    relleno = 2 if imagen_b64.endswith("==") else 1 if imagen_b64.endswith("=") else 0
+    return len(imagen_b64) * 3 // 4 - relleno
+
+
+def _extension_imagen(cabecera: bytes) -> str:
+    if cabecera.startswith(b"\x89PNG"):
+        return "png"
+    if cabecera[:4] == b"RIFF" and cabecera[8:12] == b"WEBP":
+        return "webp"
+    return "jpg"
+
+
+def guardar_imagen_bytes(contenido: bytes) -> str:
+    """
+    Guarda la imagen nombrándola por el hash de su contenido: no hay colisiones
+    entre mensajes del mismo segundo y la misma foto reenviada se guarda una sola vez.
+    Bloqueante; llamar desde un hilo.
+    """
+    with METRICA_IMAGEN.medir(etapa="escribir"):
+        huella = hashlib.sha256(contenido).hexdigest()[:32]
+        nombre = f"img_{huella}.{_extension_imagen(contenido[:12])}"
+        path_final = os.path.join(CARPETA_FOTOS, nombre)
+        if not os.path.exists(path_final):
+            # Escritura atómica: nunca se sirve un archivo a medio escribir
+            temporal = f"{path_final}.{os.getpid()}.{threading.get_ident()}.tmp"
+            with open(temporal, "wb") as f:
+                f.write(contenido)
+            os.replace(temporal, path_final)
+    return nombre
+
+
+def guardar_imagen_base64(imagen_b64: str) -> str:
+    with METRICA_IMAGEN.medir(etapa="decodificar"):
+        contenido = base64.b64decode(imagen_b64, validate=True)
+    return guardar_imagen_bytes(contenido)
+
+
+def autenticar_webhook(authorization: Optional[str]):
+    if not authorization:
+        logger.warning("Intento de acceso sin token")
+        raise HTTPException(status_code=401, detail="No autorizado - Token faltante")
+
+    try:
+        verificar_token(authorization)
+    except HTTPException:
+        raise
+    except Exception as e:
+        logger.error(f"Error validando token: {str(e)}")
+        raise HTTPException(status_code=401, detail="No autorizado")
+
+
+async def notificar_sesion_expirada(sesion: ConversationSession):
+    """Avisa al usuario que su sesión venció; un ticket en diagnóstico pasa a Pendiente"""
+    texto = "⏱️ Tu sesión se cerró por inactividad."
+    if sesion.ticket_id:
+        await ticket_repo.actualizar(sesion.ticket_id, {'estado': 'Pendiente'})
+        event_bus.publicar("ticket_actualizado", {"ticket_id": sesion.ticket_id})
+        texto += f" Tu ticket #{sesion.ticket_id} queda pendiente para revisión de un técnico."
+    if SESSION_AVISO_EXPIRACION and sesion.estado != "INICIO":
+        await enviar_respuesta_whatsapp(sesion.remitente, texto + " Si necesitas más ayuda, envíame un mensaje.")
+
+
+conversation_manager.al_expirar = notificar_sesion_expirada
+
+
+# Expiración de sesiones
+async def limpiar_sesiones_expiradas():
+    """Despierta en el próximo vencimiento del heap; el almacén se barre cada 5 minutos"""
+    ultimo_barrido = time.time()
+    while True:
+        await conversation_manager.esperar_vencimiento()
+        try:
+            await conversation_manager.expirar_vencidas(ocupado=inbound_dispatcher.activo)
+            if time.time() - ultimo_barrido >= 300:
+                ultimo_barrido = time.time()
+                # Margen para no adelantarse al aviso del worker que la tiene programada
+                await conversation_manager.cleanup_expired_sessions(SESSION_TIMEOUT_MINUTES + 2)
+        except Exception as e:
+            logger.error(f"Error expirando sesiones: {str(e)}")
+
+
+@app.on_event("startup")
+async def startup_event():
+    perfilador.registrar_loop()
+    await loop_monitor.iniciar()
+    await escritor.iniciar()
+    await conversation_manager.iniciar()
+    await fault_categorizer.recargar(forzar=True)
+    await image_variants.iniciar()
+    asyncio.create_task(limpiar_sesiones_expiradas())
+    asyncio.create_task(reanudar_entrantes())
+    if LOGS_COMPACTAR_DIAS or LOGS_RETENCION_DIAS:
+        asyncio.create_task(mantener_logs())
+    if COMPACTACION_AL_INICIAR:
+        asyncio.create_task(compactar_almacenamiento_inicial())
+    await bridge_client.iniciar()
+    await outbound_queue.iniciar()
+    if deepseek_client:
+        await deepseek_client.iniciar()
+
+
+@app.on_event("shutdown")
+async def shutdown_event():
+    await inbound_dispatcher.detener()
+    await outbound_queue.detener()
+    await bridge_client.cerrar()
+    if deepseek_client:
+        await deepseek_client.cerrar()
+    await conversation_manager.store.cerrar()
+    await escritor.detener()
+    log_writer.cerrar()
+    db_pool.cerrar()
+    image_variants.cerrar()
+    await loop_monitor.detener()
+
+@app.middleware("http")
+async def medir_peticiones(request: Request, call_next):
+    inicio = time.perf_counter()
+    codigo = 500
+    try:
+        respuesta = await call_next(request)
+        codigo = respuesta.status_code
+        return respuesta
+    finally:
+        # La plantilla de la ruta (/ticket/{ticket_id}/log) mantiene acotadas las etiquetas
+        ruta = request.scope.get("route")
+        METRICA_HTTP.observar(
+            time.perf_counter() - inicio,
+            metodo=request.method,
+            ruta=getattr(ruta, "path", "sin_ruta"),
+            codigo=codigo
+        )
+
+
+@metricas.recolector
+def recolectar_componentes() -> list:
+    """Estado actual de sesiones, colas y clientes, leído al exponer /metrics"""
+    por_estado = {}
+    for sesion in list(conversation_manager.sesiones.values()):
+        por_estado[sesion.estado] = por_estado.get(sesion.estado, 0) + 1
+    entrantes = inbound_dispatcher.estadisticas()
+    escritura = escritor.estadisticas()
+    bucle = loop_monitor.estadisticas()
+    familias = [
+        ("tickets_sesiones_activas", "gauge", "Sesiones en la caché de este worker por estado",
+         [({"estado": estado}, total) for estado, total in sorted(por_estado.items())]),
+        ("tickets_entrantes_pendientes", "gauge", "Mensajes entrantes encolados sin procesar",
+         [({}, entrantes["pendientes"])]),
+        ("tickets_entrantes_en_proceso", "gauge", "Conversaciones procesándose ahora",
+         [({}, entrantes["en_proceso"])]),
+        ("tickets_entrantes_total", "counter", "Mensajes entrantes por resultado",
+         [({"resultado": r}, entrantes[r]) for r in ("procesados", "errores", "rechazados")]),
+        ("tickets_escritor_en_cola", "gauge", "Escrituras esperando el próximo commit agrupado",
+         [({}, escritura["en_cola"])]),
+        ("tickets_salientes_destinatarios", "gauge", "Destinatarios con mensajes en la cola de reintentos",
+         [({}, outbound_queue.estadisticas()["destinatarios_en_cola"])]),
+        ("tickets_logs_pendientes", "gauge", "Logs de conversación esperando ser escritos",
+         [({}, log_writer.estadisticas()["pendientes"])]),
+        ("tickets_sse_suscriptores", "gauge", "Dashboards conectados por SSE",
+         [({}, len(event_bus.suscriptores))]),
+        ("tickets_event_loop_lag_seconds", "gauge", "Retraso del event loop (últimas muestras)",
+         [({"cuantil": "0.5"}, bucle["retraso_ms_p50"] / 1000),
+          ({"cuantil": "0.99"}, bucle["retraso_ms_p99"] / 1000),
+          ({"cuantil": "max"}, bucle["retraso_ms_max"] / 1000)]),
+    ]
+    if deepseek_client:
+        ia = deepseek_client.stats
+        familias += [
+            ("tickets_deepseek_total", "counter", "Diagnósticos pedidos a DeepSeek por resultado",
+             [({"resultado": r}, ia[r]) for r in (
+                 "exitos", "errores", "timeouts", "lentas", "rechazadas_circuito", "rechazadas_saturacion")]),
+            ("tickets_deepseek_en_curso", "gauge", "Llamadas a DeepSeek en curso", [({}, ia["en_curso"])]),
+            ("tickets_deepseek_circuito", "gauge", "Estado del circuit breaker de DeepSeek (1 = actual)",
+             [({"estado": e}, int(e == deepseek_client.circuito.estado))
+              for e in ("cerrado", "semi_abierto", "abierto")]),
+        ]
+        if deepseek_client.cache:
+            cache = deepseek_client.cache.stats
+            familias.append(("tickets_diagnosticos_cache_total", "counter", "Consultas a la caché de diagnósticos",
+                             [({"resultado": r}, cache[r]) for r in ("aciertos", "fallos", "expirados")]))
+    return familias
+
+
+@app.get("/metrics")
+async def exponer_metricas():
+    """Métricas en formato de texto de Prometheus (por worker)"""
+    return Response(metricas.exponer(), media_type="text/plain; version=0.0.4")
+
+
+@app.get("/debug/trazas")
+async def consultar_trazas(
+    remitente: Optional[str] = None,
+    lentas: bool = False,
+    limite: int = Query(50, ge=1, le=500),
+    authorization: str = Header(None)
+):
+    """
+    Trazas recientes de mensajes entrantes (más nuevas primero) con el tiempo de
+    cada tramo: sesión, SQLite, DeepSeek, puente, logs. Con ?lentas=true solo las
+    que superaron TRAZAS_LENTA_MS.
+    """
+    autenticar_webhook(authorization)
+    return {"umbral_ms": TRAZAS_LENTA_MS, "trazas": tracer.buscar(remitente, lentas, limite)}
+
+
+@app.get("/debug/perfil")
+async def perfil_muestreo(
+    segundos: float = Query(10, gt=0, le=120),
+    intervalo_ms: float = Query(5, ge=1, le=100),
+    hilos: str = Query("loop", pattern="^(loop|todos)$"),
+    authorization: str = Header(None)
+):
+    """
+    Perfil por muestreo del proceso en vivo (requiere PERFILADOR_HABILITADO=true).
+    Retorna pilas colapsadas para flamegraph.pl o speedscope:
+
+        curl -H "Authorization: Bearer $API_TOKEN" \
+             "http://servidor:8523/debug/perfil?segundos=30" > perfil.txt
+    """
+    if not PERFILADOR_HABILITADO:
+        raise HTTPException(status_code=404, detail="Perfilador deshabilitado")
+    autenticar_webhook(authorization)
+    resultado = await perfilador.perfilar(segundos, intervalo_ms / 1000, todos_los_hilos=hilos == "todos")
+    if resultado is None:
+        raise HTTPException(status_code=409, detail="Ya hay un perfil en curso")
+    pilas, muestras = resultado
+    logger.info(f"Perfil de {segundos}s capturado: {muestras} muestras, {len(pilas)} pilas distintas")
+    lineas = [f"{pila} {total}" for pila, total in sorted(pilas.items(), key=lambda p: -p[1])]
+    return Response("\n".join(lineas) + "\n", media_type="text/plain")
+
+
+# Nombres generados por guardar_imagen_bytes: el hash garantiza que el contenido no cambia
+_FOTO_INMUTABLE = re.compile(r"^img_[0-9a-f]{32}\.[a-z0-9]+$")
+
+
+@app.get("/fotos/{nombre}")
+async def servir_foto(nombre: str, size: str = Query("original", pattern="^(mini|medio|original)$")):
+    """
+    Foto de un ticket. `size=mini` (256 px) para listados, `size=medio` (1024 px)
+    para verla en detalle; `original` sirve el archivo tal como llegó.
+    """
+    if nombre != os.path.basename(nombre) or nombre.startswith("."):
+        raise HTTPException(status_code=404, detail="Foto no encontrada")
+    original = os.path.join(CARPETA_FOTOS, nombre)
+    if not os.path.isfile(original):
+        raise HTTPException(status_code=404, detail="Foto no encontrada")
+
+    ruta = original
+    if size != "original":
+        ruta = await image_variants.obtener(nombre, size) or original
+
+    if _FOTO_INMUTABLE.match(nombre):
+        cache = "public, max-age=31536000, immutable"
+    else:
+        # Fotos anteriores al nombrado por hash: podrían reemplazarse
+        cache = "public, max-age=86400"
+    return FileResponse(ruta, headers={"Cache-Control": cache})
+
+
+@app.get("/health")
+async def health():
+    """Endpoint de health check para monitoreo"""
+    try:
+        total_tickets = await ticket_repo.contar()
+
+        return RespuestaJSON({
+            "status": "ok",
+            "total_tickets": total_tickets,
+            "laptop_url": f"http://{IP_LAPTOP}:{PUERTO_LAPTOP}",
+            "deepseek": deepseek_client.estadisticas() if deepseek_client else None,
+            "escritor": escritor.estadisticas(),
+            "event_loop": loop_monitor.estadisticas(),
+            "miniaturas": image_variants.estadisticas(),
+            "entrantes": {**inbound_dispatcher.estadisticas(), "bitacora": inbound_journal.estadisticas()},
+            "timestamp": datetime.datetime.now().isoformat()
+        })
+    except Exception as e:
+        logger.error(f"Error en health check: {str(e)}")
+        return RespuestaJSON(
+            status_code=503,
+            content={"status": "error", "message": str(e)}
+        )
+
+async def procesar_conversacion(data: MensajeWA, imagen_guardada: Optional[str] = None,
+                                entrada_id: Optional[int] = None):
+    """Maneja la lógica de conversación interactiva"""
+    try:
+        # Verificar si existe sesión activa
+        with tracer.tramo("sesion.cargar"):
+            sesion = await conversation_manager.get_session(data.remitente)
+
+        if sesion and entrada_id and entrada_id <= sesion.ultima_entrada:
+            # Reproceso de un mensaje que ya avanzó la sesión antes de una caída
+            logger.info(f"Mensaje #{entrada_id} de {data.remitente} ya aplicado, se omite")
+            return
+
+        respuesta = ""
+        mensajes_previos = []      # respuestas enviadas antes de la final (acuse, diagnóstico)
+        estado_final_ticket = None  # si se asigna, el ticket se cierra con este estado
+
+        async def enviar_parcial(texto: str):
+            mensajes_previos.append({
+                'timestamp': datetime.datetime.now().isoformat(),
+                'role': 'assistant',
+                'content': texto
+            })
+            with tracer.tramo("respuesta.parcial"):
+                await enviar_respuesta_whatsapp(data.remitente, texto)
+
+        if not sesion:
+            # NUEVA SESIÓN - INICIO
+            sesion = conversation_manager.create_session(data.remitente)
+            respuesta = "¡Hola! 👋 Soy el asistente de soporte técnico.\n\n¿Cuál es tu nombre completo por favor?"
+            sesion.estado = "NOMBRE"
+
+        elif sesion.estado == "NOMBRE":
+            # Guardar nombre y pedir departamento
+            sesion.datos['nombre'] = data.contenido.strip()
+            respuesta = f"Gracias {sesion.datos['nombre']}. ¿A qué departamento perteneces?"
+            sesion.estado = "DEPTO"
+
+        elif sesion.estado == "DEPTO":
+            # Guardar departamento y pedir tipo de equipo
+            sesion.datos['departamento'] = data.contenido.strip()
+            respuesta = "¿Qué tipo de equipo tiene el problema?\n(Desktop / Laptop / Impresora / Otro)"
+            sesion.estado = "EQUIPO"
+
+        elif sesion.estado == "EQUIPO":
+            # Guardar tipo de equipo y pedir activo
+            sesion.datos['tipo_equipo'] = data.contenido.strip()
+            respuesta = "¿Cuál es el número de activo del equipo? (Suele estar en una etiqueta)"
+            sesion.estado = "ACTIVO"
+
+        elif sesion.estado == "ACTIVO":
+            # Guardar activo y pedir descripción de falla
+            sesion.datos['numero_activo'] = data.contenido.strip()
+            respuesta = "Perfecto. Ahora, describe detalladamente el problema que estás experimentando."
+            sesion.estado = "FALLA"
+
+        elif sesion.estado == "FALLA":
+            # Guardar falla, crear ticket y diagnosticar con IA
+            sesion.datos['falla'] = data.contenido.strip()
+            sesion.datos['categoria'] = await categorizar_falla(
+                sesion.datos.get('tipo_equipo', ''),
+                sesion.datos['falla']
+            )
+
+            pasos_enviados = False
+
+            async def al_obtener_pasos(pasos: list):
+                # Entregar los pasos en cuanto llegan, sin esperar el resto de la respuesta
+                nonlocal pasos_enviados
+                pasos_enviados = True
+                await enviar_parcial(f"📋 *Análisis del problema:*\n\n{formatear_pasos(pasos)}")
+
+            # Llamar a DeepSeek en paralelo: una IA lenta no retrasa el registro del ticket
+            if deepseek_client:
+                logger.info(f"Solicitando diagnóstico a DeepSeek para {data.remitente}")
+                tarea_diagnostico = asyncio.create_task(deepseek_client.diagnosticar_problema(
+                    sesion.datos['tipo_equipo'],
+                    sesion.datos['falla'],
+                    sesion.historial,
+                    al_obtener_pasos=al_obtener_pasos
+                ))
+            else:
+                tarea_diagnostico = None
+
+            try:
+                ticket_id = await guardar_ticket(sesion, estado='En Diagnóstico', entrada_id=entrada_id)
+            except Exception:
+                if tarea_diagnostico:
+                    tarea_diagnostico.cancel()
+                raise
+            sesion.ticket_id = ticket_id
+            event_bus.publicar("ticket_creado", {"ticket_id": ticket_id})
+
+            if tarea_diagnostico:
+                inicio_espera = time.perf_counter()
+                try:
+                    diagnostico = await asyncio.wait_for(
+                        asyncio.shield(tarea_diagnostico), timeout=DIAGNOSTICO_ACUSE_SECONDS
+                    )
+                except asyncio.TimeoutError:
+                    # Acuse inmediato para que el usuario no quede esperando a la IA
+                    if not pasos_enviados:
+                        await enviar_parcial("🔎 Gracias. Estoy analizando tu problema, dame unos segundos...")
+                    diagnostico = await tarea_diagnostico
+                tracer.registrar("diagnostico.espera", inicio_espera, time.perf_counter() - inicio_espera)
+            else:
+                diagnostico = {
+                    "analisis": "Análisis de IA no disponible",
+                    "sugerencias": "Por favor contacta al soporte técnico",
+                    "requiere_tecnico": True
+                }
+
+            sesion.datos['diagnostico'] = diagnostico.get('sugerencias', '')
+            sesion.datos['requiere_tecnico'] = diagnostico.get('requiere_tecnico', True)
+
+            # Construir respuesta (el análisis ya se envió si llegó en streaming)
+            if pasos_enviados:
+                respuesta = ""
+            else:
+                respuesta = f"📋 *Análisis del problema:*\n\n{diagnostico.get('sugerencias', 'Error en análisis')}\n\n"
+
+            if sesion.datos['requiere_tecnico']:
+                respuesta += f"Se ha creado el ticket #{ticket_id}. Un técnico te contactará pronto. ✅"
+                estado_final_ticket = 'Pendiente'
+            else:
+                respuesta += "Intenta estos pasos. Si el problema persiste, responde con 'NO' para hablar con un técnico."
+                sesion.estado = "DIAGNOSTICO"
+                await ticket_repo.actualizar(ticket_id, {
+                    'diagnostico_ia': sesion.datos['diagnostico'],
+                    'requiere_tecnico': 0
+                })
+
+        elif sesion.estado == "DIAGNOSTICO":
+            # Usuario indica si necesita técnico o no
+            if "no" in data.contenido.lower() or "no funciona" in data.contenido.lower():
+                sesion.datos['requiere_tecnico'] = True
+                respuesta = f"✅ Ticket #{sesion.ticket_id} creado. Un técnico se pondrá en contacto pronto."
+                estado_final_ticket = 'Pendiente'
+            else:
+                respuesta = "Me alegra haber ayudado. Si necesitas más ayuda en el futuro, solo envíame un mensaje. 😊"
+                estado_final_ticket = 'Resuelto'
+
+        # La foto más reciente de la conversación se asocia al ticket
+        if imagen_guardada:
+            sesion.datos['foto'] = imagen_guardada
+            image_variants.generar_en_segundo_plano(imagen_guardada)
+
+        # Actualizar historial
+        nuevos_mensajes = [{
+            'timestamp': datetime.datetime.now().isoformat(),
+            'role': 'user',
+            'content': data.contenido
+        }] + mensajes_previos + [{
+            'timestamp': datetime.datetime.now().isoformat(),
+            'role': 'assistant',
+            'content': respuesta
+        }]
+        sesion.historial.extend(nuevos_mensajes)
+        sesion.ultimo_mensaje = time.time()
+        if entrada_id:
+            sesion.ultima_entrada = entrada_id
+
+        # Enviar respuesta al usuario
+        with tracer.tramo("respuesta.enviar"):
+            await enviar_respuesta_whatsapp(data.remitente, respuesta)
+
+        # Las escrituras del mensaje se encolan juntas: el escritor las aplica en un solo commit
+        escrituras = []
+        if sesion.ticket_id:
+            # El ticket ya existe: el intercambio se agrega a su conversación
+            escrituras.append(ticket_repo.agregar_mensajes(sesion.ticket_id, nuevos_mensajes))
+
+        if estado_final_ticket:
+            with tracer.tramo("log.escribir"):
+                log_filename = await guardar_log_conversacion(sesion.ticket_id, sesion)
+            escrituras.append(ticket_repo.actualizar(sesion.ticket_id, {
+                'estado': estado_final_ticket,
+                'diagnostico_ia': sesion.datos.get('diagnostico', ''),
+                'requiere_tecnico': 1 if sesion.datos.get('requiere_tecnico', False) else 0,
+                'log_file_path': log_filename,
+                'foto_path': sesion.datos.get('foto')
+            }))
+            escrituras.append(conversation_manager.end_session(data.remitente))
+        else:
+            escrituras.append(conversation_manager.guardar(sesion))
+        with tracer.tramo("escrituras"):
+            await asyncio.gather(*escrituras)
+
+        # Avisar cuando ya está todo escrito, incluido el intercambio recién agregado:
+        # "mensaje" refresca el chat abierto del ticket y "ticket_actualizado" la tabla
+        if sesion.ticket_id:
+            event_bus.publicar("mensaje", {"ticket_id": sesion.ticket_id, "role": "user"})
+            event_bus.publicar("ticket_actualizado", {"ticket_id": sesion.ticket_id})
+
+    except Exception as e:
+        logger.error(f"Error en procesamiento de conversación: {str(e)}")
+        await enviar_respuesta_whatsapp(
+            data.remitente,
+            "Disculpa, ocurrió un error. Por favor intenta nuevamente."
+        )
+
+
+async def procesar_entrada(entrada_id: int, data: MensajeWA, imagen_guardada: Optional[str] = None,
+                           traza: Optional[Traza] = None):
+    """Procesa un mensaje de la bitácora y lo marca como procesado"""
+    # Los mensajes reprocesados tras una caída no traen traza del webhook
+    traza = traza or Traza(data.remitente)
+    with tracer.continuar(traza):
+        if traza.encolado is not None:
+            tracer.registrar("cola.espera", traza.encolado, time.perf_counter() - traza.encolado)
+        await procesar_conversacion(data, imagen_guardada, entrada_id)
+        await inbound_journal.completar(entrada_id)
+    tracer.finalizar(traza)
+
+
+async def compactar_almacenamiento_inicial():
+    """Comprime en segundo plano las filas guardadas con el formato anterior"""
+    try:
+        await ticket_repo.compactar()
+    except Exception as e:
+        logger.error(f"Error compactando el almacenamiento: {str(e)}")
+
+
+async def mantener_logs():
+    """Compactación y retención de logs de conversación, una vez por hora"""
+    while True:
+        try:
+            with log_writer.mantenimiento_exclusivo() as lider:
+                if lider:
+                    movidos = await log_writer.compactar()
+                    if movidos:
+                        await ticket_repo.reubicar_logs(movidos)
+                        await log_writer.borrar_compactados(movidos)
+                        logger.info(f"{len(movidos)} logs compactados en segmentos")
+                    borrados = await log_writer.purgar()
+                    if borrados:
+                        logger.info(f"{borrados} logs eliminados por retención")
+        except Exception as e:
+            logger.error(f"Error en mantenimiento de logs: {str(e)}")
+        await asyncio.sleep(3600)
+
+
+async def reanudar_entrantes():
+    """Reprocesa los mensajes registrados cuyo worker no los completó (caída o reinicio)"""
+    ultima_purga = 0.0
+    while True:
+        try:
+            for entrada_id, data, imagen in await inbound_journal.reclamar_vencidas():
+                logger.warning(f"Reprocesando mensaje #{entrada_id} de {data.remitente}")
+                inbound_dispatcher.encolar(data.remitente, entrada_id, data, imagen, forzar=True)
+            if time.time() - ultima_purga >= 3600:
+                ultima_purga = time.time()
+                await inbound_journal.purgar()
+        except Exception as e:
+            logger.error(f"Error reanudando mensajes entrantes: {str(e)}")
+        await asyncio.sleep(inbound_journal.reserva_segundos / 3)
+
+
+inbound_journal = InboundJournal(
+    db_pool,
+    escritor,
+    reserva_segundos=ENTRANTES_RESERVA_SECONDS,
+    retencion_horas=ENTRANTES_RETENCION_HORAS
+)
+inbound_dispatcher = InboundDispatcher(
+    procesar_entrada,
+    max_concurrencia=ENTRANTES_CONCURRENCIA,
+    max_pendientes=ENTRANTES_MAX_PENDIENTES,
+    max_por_remitente=ENTRANTES_MAX_POR_REMITENTE
+)
+
+
+def rechazar_saturado():
+    logger.warning("Cola de mensajes entrantes saturada, se rechaza el mensaje")
+    raise HTTPException(status_code=429, detail="Servidor ocupado, reintenta más tarde",
+                        headers={"Retry-After": "5"})
+
+
+async def aceptar_mensaje(data: MensajeWA, imagen_guardada: Optional[str] = None) -> dict:
+    """Registra el mensaje en la bitácora y lo encola; desde aquí ya no se pierde"""
+    entrada_id = await inbound_journal.registrar(data, imagen_guardada)
+    if entrada_id is None:
+        logger.info(f"Mensaje duplicado de {data.remitente} ({data.id_mensaje}), se ignora")
+        return {"status": "ok", "mensaje": "Mensaje duplicado"}
+    # Se procesa en orden detrás de los mensajes previos del mismo remitente
+    traza = tracer.actual()
+    if traza:
+        traza.encolado = time.perf_counter()
+    inbound_dispatcher.encolar(data.remitente, entrada_id, data, imagen_guardada, traza, forzar=True)
+    return {"status": "ok", "mensaje": "Mensaje procesado", "traza": traza.id if traza else None}
+
+
+@app.post("/webhook")
+async def recibir(data: MensajeWA, authorization: str = Header(None)):
+    # Verificar autenticación
+    autenticar_webhook(authorization)
+
+    # Validar tamaño de imagen (estimado por la longitud del base64, sin decodificar)
+    if data.imagen:
+        if len(data.imagen) % 4 != 0:
+            logger.error("Imagen base64 con longitud inválida")
+            raise HTTPException(status_code=400, detail="Imagen inválida")
+        img_size = tamano_base64(data.imagen)
+        if img_size > MAX_IMAGE_SIZE:
+            logger.warning(f"Imagen muy grande recibida: {img_size} bytes")
+            raise HTTPException(status_code=413, detail=f"Imagen muy grande. Máximo {MAX_IMAGE_SIZE/1_000_000}MB")
+
+    if inbound_dispatcher.saturado(data.remitente):
+        rechazar_saturado()
+    tracer.iniciar(data.remitente)
+
+    # La imagen debe estar en disco antes de registrar el mensaje en la bitácora
+    imagen_guardada = None
+    if data.imagen:
+        try:
+            with tracer.tramo("imagen.guardar"):
+                imagen_guardada = await asyncio.to_thread(guardar_imagen_base64, data.imagen)
+        except ValueError:
+            logger.error("Imagen base64 inválida")
+            raise HTTPException(status_code=400, detail="Imagen inválida")
+        except OSError as e:
+            logger.error(f"Error guardando imagen: {str(e)}")
+            raise HTTPException(status_code=500, detail="No se pudo guardar la imagen")
+        logger.info(f"Imagen guardada: {imagen_guardada}")
+        data.imagen = None
+
+    return await aceptar_mensaje(data, imagen_guardada)
+
+
+@app.post("/webhook/imagen")
+async def recibir_imagen(
+    request: Request,
+    authorization: str = Header(None),
+    x_remitente: str = Header(...),
+    x_contenido: str = Header(""),
+    x_id_mensaje: Optional[str] = Header(None)
+):
+    """
+    Variante del webhook para imágenes: el cuerpo es el binario de la imagen
+    (sin base64) y el remitente/texto van en los headers X-Remitente y
+    X-Contenido (URL-encoded); X-Id-Mensaje es opcional.
+    """
+    autenticar_webhook(authorization)
+    if inbound_dispatcher.saturado(x_remitente):
+        rechazar_saturado()
+    tracer.iniciar(x_remitente)
+
+    longitud = request.headers.get("content-length")
+    if longitud:
+        try:
+            longitud = int(longitud)
+        except ValueError:
+            logger.error(f"Content-Length inválido: {longitud!r}")
+            raise HTTPException(status_code=400, detail="Content-Length inválido")
+    if longitud and longitud > MAX_IMAGE_SIZE:
+        logger.warning(f"Imagen muy grande recibida: {longitud} bytes")
+        raise HTTPException(status_code=413, detail=f"Imagen muy grande. Máximo {MAX_IMAGE_SIZE/1_000_000}MB")
+
+    partes = []
+    recibido = 0
+    async for parte in request.stream():
+        recibido += len(parte)
+        if recibido > MAX_IMAGE_SIZE:
+            logger.warning(f"Imagen muy grande recibida: más de {MAX_IMAGE_SIZE} bytes")
+            raise HTTPException(status_code=413, detail=f"Imagen muy grande. Máximo {MAX_IMAGE_SIZE/1_000_000}MB")
+        partes.append(parte)
+
+    if not recibido:
+        raise HTTPException(status_code=400, detail="Imagen vacía")
+
+    try:
+        with tracer.tramo("imagen.guardar"):
+            nombre = await asyncio.to_thread(guardar_imagen_bytes, b"".join(partes))
+    except OSError as e:
+        logger.error(f"Error guardando imagen: {str(e)}")
+        raise HTTPException(status_code=500, detail="No se pudo guardar la imagen")
+    logger.info(f"Imagen guardada: {nombre}")
+
+    data = MensajeWA(remitente=x_remitente, contenido=unquote(x_contenido), id_mensaje=x_id_mensaje)
+    return await aceptar_mensaje(data, nombre)
+
+@app.get("/events")
+async def eventos(request: Request):
+    """
+    Canal Server-Sent Events para el dashboard.
+    Eventos: ticket_creado, ticket_actualizado, mensaje y resync.
+    """
+    async def stream():
+        async with event_bus.suscribir() as cola:
+            yield "retry: 3000\n\n"
+            while True:
+                try:
+                    evento = await asyncio.wait_for(cola.get(), timeout=SSE_HEARTBEAT_SECONDS)
+                except asyncio.TimeoutError:
+                    if await request.is_disconnected():
+                        break
+                    # Comentario SSE para mantener viva la conexión a través de proxies
+                    yield ": ping\n\n"
+                    continue
+
+                datos = json_compacto(evento["datos"])
+                yield f"id: {evento['id']}\nevent: {evento['tipo']}\ndata: {datos}\n\n"
+
+    return StreamingResponse(
+        stream(),
+        media_type="text/event-stream",
+        headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"}
+    )
+
+
+@app.get("/")
+async def home():
+    return FileResponse('index.html')
+
+
+@app.get("/tickets")
+async def listar(
+    request: Request,
+    before_id: Optional[int] = None,
+    since: Optional[int] = None,
+    limit: int = Query(100, ge=1, le=TICKETS_MAX_LIMIT),
+    estado: Optional[str] = None,
+    categoria: Optional[str] = None,
+    departamento: Optional[str] = None,
+    desde: Optional[str] = None,
+    hasta: Optional[str] = None
+):
+    """
+    Lista tickets paginados (keyset por id descendente).
+    Para la siguiente página enviar ?before_id=<next_before_id>.
+    Con ?since=<seq> retorna solo los tickets cambiados desde esa versión;
+    el cliente guarda el "seq" de la respuesta para el siguiente poll.
+    """
+    # Leer la versión antes de consultar: si algo cambia entre ambas lecturas,
+    # el cliente lo recibirá de nuevo en el siguiente poll (nunca se pierde)
+    seq = await ticket_repo.seq_actual()
+    etag = etag_de("t", seq, huella_parametros(
+        before_id, since, limit, estado, categoria, departamento, desde, hasta
+    ))
+    if coincide_etag(request, etag):
+        return respuesta_con_etag(request, etag)
+
+    if since is not None:
+        columnas, rows, hay_mas = await ticket_repo.listar_cambios(since, limit=limit)
+        # Si hay más cambios pendientes, continuar desde el último entregado
+        siguiente_seq = rows[-1][columnas.index('updated_seq')] if hay_mas else seq
+        return respuesta_con_etag(request, etag, {
+            "columnas": columnas, "tickets": rows, "seq": siguiente_seq, "hay_mas": hay_mas
+        })
+
+    columnas, rows, next_before_id = await ticket_repo.listar(
+        before_id=before_id,
+        limit=limit,
+        filtros={"estado": estado, "categoria": categoria, "departamento": departamento},
+        desde=desde,
+        hasta=hasta
+    )
+    return respuesta_con_etag(request, etag, {
+        "columnas": columnas, "tickets": rows, "next_before_id": next_before_id, "seq": seq
+    })
+
+
+@app.get("/stats")
+async def estadisticas(request: Request, dias: int = Query(30, ge=0, le=366)):
+    """
+    Resumen para el dashboard desde contadores precalculados: total, por estado,
+    categoría, departamento y requiere_tecnico, más la serie de los últimos `dias`
+    días (por fecha de creación). 304 si ningún ticket cambió.
+    """
+    seq = await ticket_repo.seq_actual()
+    etag = etag_de("s", seq, dias, datetime.date.today().isoformat())
+    if coincide_etag(request, etag):
+        return respuesta_con_etag(request, etag)
+
+    desde_dia = (datetime.date.today() - datetime.timedelta(days=dias - 1)).isoformat() if dias else None
+    resumen = await ticket_repo.estadisticas(desde_dia)
+    return respuesta_con_etag(request, etag, {**resumen, "seq": seq})
+
+
+def _nombre_exportacion(extension: str) -> dict:
+    nombre = f"tickets_{datetime.datetime.now().strftime('%Y%m%d_%H%M')}.{extension}"
+    return {"Content-Disposition": f'attachment; filename="{nombre}"'}
+
+
+@app.get("/export.csv")
+async def exportar_csv(
+    estado: Optional[str] = None,
+    categoria: Optional[str] = None,
+    departamento: Optional[str] = None,
+    desde: Optional[str] = None,
+    hasta: Optional[str] = None
+):
+    """Exporta los tickets filtrados como CSV, generado por bloques mientras se descarga"""
+    filtros = {"estado": estado, "categoria": categoria, "departamento": departamento}
+
+    async def stream():
+        buffer = io.StringIO()
+        escritor_csv = csv.writer(buffer)
+        # BOM para que Excel reconozca UTF-8 (acentos)
+        buffer.write("\ufeff")
+        escritor_csv.writerow(COLUMNAS_LISTADO)
+        async for filas in ticket_repo.exportar(filtros, desde, hasta):
+            escritor_csv.writerows(filas)
+            yield buffer.getvalue()
+            buffer.seek(0)
+            buffer.truncate()
+        if buffer.tell():
+            yield buffer.getvalue()
+
+    return StreamingResponse(stream(), media_type="text/csv; charset=utf-8",
+                             headers=_nombre_exportacion("csv"))
+
+
+@app.get("/export.jsonl")
+async def exportar_jsonl(
+    estado: Optional[str] = None,
+    categoria: Optional[str] = None,
+    departamento: Optional[str] = None,
+    desde: Optional[str] = None,
+    hasta: Optional[str] = None,
+    mensajes: bool = False
+):
+    """
+    Exporta los tickets filtrados como JSON Lines (un ticket por línea).
+    Con ?mensajes=true cada ticket incluye su conversación; el resultado se
+    puede volver a cargar con POST /import.
+    """
+    filtros = {"estado": estado, "categoria": categoria, "departamento": departamento}
+
+    async def stream():
+        async for filas in ticket_repo.exportar(filtros, desde, hasta, mensajes=mensajes):
+            lineas = []
+            for fila in filas:
+                ticket = dict(zip(COLUMNAS_LISTADO, fila))
+                if mensajes:
+                    ticket["mensajes"] = fila[-1]
+                lineas.append(json_compacto(ticket))
+            yield "\n".join(lineas) + "\n"
+
+    return StreamingResponse(stream(), media_type="application/x-ndjson",
+                             headers=_nombre_exportacion("jsonl"))
+
+
+def _valor_importado(columna: str, valor):
+    """Normaliza un valor leído de CSV/JSON para la columna destino"""
+    if valor == '' or valor is None:
+        return None
+    if columna in ('id', 'requiere_tecnico'):
+        return int(valor)
+    return valor
+
+
+async def _lineas_cuerpo(request: Request):
+    """Líneas del cuerpo de la petición a medida que llegan (con su salto de línea)"""
+    # Decodificador incremental: un carácter puede quedar partido entre dos trozos
+    decodificador = codecs.getincrementaldecoder("utf-8-sig")(errors="replace")
+    pendiente = ""
+    async for trozo in request.stream():
+        pendiente += decodificador.decode(trozo)
+        *completas, pendiente = pendiente.split("\n")
+        for linea in completas:
+            yield linea + "\n"
+    pendiente += decodificador.decode(b"", final=True)
+    if pendiente:
+        yield pendiente
+
+
+async def _registros_jsonl(request: Request):
+    numero = 0
+    async for linea in _lineas_cuerpo(request):
+        numero += 1
+        if not linea.strip():
+            continue
+        try:
+            registro = json.loads(linea)
+        except json.JSONDecodeError as e:
+            raise ValueError(f"Línea {numero}: JSON inválido ({e.msg})")
+        if not isinstance(registro, dict):
+            raise ValueError(f"Línea {numero}: se esperaba un objeto")
+        yield numero, registro
+
+
+async def _registros_csv(request: Request):
+    """
+    Registros CSV con encabezado. Un campo entre comillas puede contener saltos
+    de línea, así que las líneas se acumulan hasta que las comillas quedan parejas.
+    """
+    encabezado = None
+    numero = 0
+    registro = ""
+    async for linea in _lineas_cuerpo(request):
+        numero += 1
+        registro += linea
+        if registro.count('"') % 2:
+            continue
+        texto, registro = registro, ""
+        if not texto.strip():
+            continue
+        try:
+            campos = next(csv.reader([texto]))
+        except csv.Error as e:
+            raise ValueError(f"Línea {numero}: CSV inválido ({e})")
+        if encabezado is None:
+            encabezado = campos
+            continue
+        yield numero, dict(zip(encabezado, campos))
+    if registro.strip():
+        raise ValueError(f"Línea {numero}: comillas sin cerrar")
+
+
+def _mensajes_importados(numero: int, mensajes) -> list:
+    """Valida los mensajes de un ticket importado: objetos con role y content de texto"""
+    if not isinstance(mensajes, list):
+        raise ValueError(f"Línea {numero}: mensajes debe ser una lista")
+    for posicion, m in enumerate(mensajes, start=1):
+        if not isinstance(m, dict) or not isinstance(m.get("role"), str) or not isinstance(m.get("content"), str):
+            raise ValueError(f"Línea {numero}: el mensaje {posicion} debe tener role y content de texto")
+        if not isinstance(m.get("timestamp"), (str, type(None))):
+            raise ValueError(f"Línea {numero}: el mensaje {posicion} tiene un timestamp inválido")
+    return mensajes
+
+
+@app.post("/import")
+async def importar_tickets(request: Request, formato: Optional[str] = Query(None, pattern="^(csv|jsonl)$"),
+                           authorization: str = Header(None)):
+    """
+    Importa tickets desde JSON Lines (formato de /export.jsonl, con o sin
+    "mensajes") o CSV con encabezado (formato de /export.csv). El cuerpo se lee
+    a medida que llega y se inserta en bloques de IMPORTACION_LOTE tickets por
+    transacción; los ids ya existentes se omiten.
+
+        curl -X POST -H "Authorization: Bearer $API_TOKEN" \\
+             --data-binary @tickets.jsonl http://servidor:8523/import
+    """
+    autenticar_webhook(authorization)
+    if formato is None:
+        formato = "csv" if "csv" in request.headers.get("content-type", "") else "jsonl"
+    registros = _registros_csv(request) if formato == "csv" else _registros_jsonl(request)
+
+    insertados = omitidos = 0
+    lote = []
+
+    async def volcar():
+        nonlocal insertados, omitidos, lote
+        nuevos, repetidos = await ticket_repo.importar(lote)
+        insertados += nuevos
+        omitidos += repetidos
+        lote = []
+
+    try:
+        async for numero, registro in registros:
+            try:
+                ticket = {
+                    c: _valor_importado(c, registro[c]) for c in COLUMNAS_IMPORTACION if c in registro
+                }
+            except (TypeError, ValueError):
+                raise ValueError(f"Línea {numero}: id o requiere_tecnico no es un número")
+            if registro.get("mensajes") is not None:
+                ticket["mensajes"] = _mensajes_importados(numero, registro["mensajes"])
+            lote.append(ticket)
+            if len(lote) >= IMPORTACION_LOTE:
+                await volcar()
+        if lote:
+            await volcar()
+    except ValueError as e:
+        raise HTTPException(status_code=400, detail=f"{e}; {insertados} tickets ya importados")
+    finally:
+        if insertados:
+            event_bus.publicar("resync", {"importados": insertados})
+
+    logger.info(f"Importación {formato}: {insertados} tickets nuevos, {omitidos} omitidos")
+    return {"importados": insertados, "omitidos": omitidos}
+
+
+@app.get("/categorias/reglas")
+async def listar_reglas_categoria():
+    """Reglas actuales del categorizador de fallas"""
+    return {"reglas": await fault_categorizer.listar_reglas()}
+
+
+@app.put("/categorias/reglas")
+async def reemplazar_reglas_categoria(reglas: list[ReglaCategoria], recategorizar: bool = False,
+                                      authorization: str = Header(None)):
+    """
+    Sustituye las reglas del categorizador (sin reiniciar el servidor).
+    Con ?recategorizar=true también recalcula la categoría de todos los tickets.
+    """
+    autenticar_webhook(authorization)
+    total = await fault_categorizer.reemplazar_reglas([r.model_dump() for r in reglas])
+    resultado = {"palabras": total}
+    if recategorizar:
+        resultado.update(await fault_categorizer.recategorizar_todo())
+        if resultado["cambiados"]:
+            event_bus.publicar("ticket_actualizado", {"recategorizados": resultado["cambiados"]})
+    return resultado
+
+
+@app.post("/categorias/recategorizar")
+async def recategorizar_tickets(authorization: str = Header(None)):
+    """Recalcula la categoría de todos los tickets con las reglas actuales"""
+    autenticar_webhook(authorization)
+    resultado = await fault_categorizer.recategorizar_todo()
+    if resultado["cambiados"]:
+        event_bus.publicar("ticket_actualizado", {"recategorizados": resultado["cambiados"]})
+    return resultado
+
+
+@app.post("/almacenamiento/compactar")
+async def compactar_almacenamiento(migrar_historial: bool = False, authorization: str = Header(None)):
+    """
+    Comprime los textos largos guardados con el formato anterior y, con
+    ?migrar_historial=true, migra y vacía los historiales JSON legados.
+    Retorna los bytes antes y después por tabla.
+    """
+    autenticar_webhook(authorization)
+    if ticket_repo.compactando:
+        raise HTTPException(status_code=409, detail="Ya hay una compactación en curso")
+    return await ticket_repo.compactar(migrar_historial=migrar_historial)
+
+
+@app.get("/tickets/search")
+async def buscar_tickets(
+    q: str = Query(..., min_length=1, max_length=200),
+    limit: int = Query(20, ge=1, le=100),
+    estado: Optional[str] = None
+):
+    """
+    Búsqueda de texto completo en tickets y conversaciones, ordenada por relevancia.
+    Los fragmentos vienen escapados, con las coincidencias entre <mark></mark>.
+    """
+    consulta = consulta_fts(q)
+    if not consulta:
+        raise HTTPException(status_code=400, detail="Consulta vacía")
+    try:
+        columnas, rows, resultados = await ticket_repo.buscar(consulta, limit=limit, estado=estado)
+    except sqlite3.OperationalError as e:
+        logger.error(f"Error en búsqueda '{q}': {str(e)}")
+        raise HTTPException(status_code=400, detail="Consulta de búsqueda inválida")
+    return {"q": q, "columnas": columnas, "tickets": rows, "resultados": resultados}
+
+
+@app.get("/ticket/{ticket_id}/conversacion")
+async def obtener_conversacion(ticket_id: int, request: Request, after_seq: int = Query(0, ge=0)):
+    """
+    Retorna el historial de conversación de un ticket (304 si no cambió).
+    Con ?after_seq=<n> retorna solo los mensajes posteriores a n.
+    """
+    seq = await ticket_repo.seq_ticket(ticket_id)
+    if seq is None:
+        raise HTTPException(status_code=404, detail="Conversación no encontrada")
+
+    etag = etag_de("c", ticket_id, seq, after_seq)
+    if coincide_etag(request, etag):
+        return respuesta_con_etag(request, etag)
+
+    historial = await ticket_repo.obtener_mensajes(ticket_id, after_seq)
+
+    if not historial and after_seq == 0:
+        raise HTTPException(status_code=404, detail="Conversación no encontrada")
+
+    ultimo_seq = historial[-1]["seq"] if historial else after_seq
+    return respuesta_con_etag(request, etag, {"historial": historial, "seq": seq, "ultimo_seq": ultimo_seq})
+
+
+@app.get("/ticket/{ticket_id}/log")
+async def descargar_log(ticket_id: int):
+    """Descarga el archivo .log de la conversación"""
+    log_file = await ticket_repo.obtener_log_path(ticket_id)
+
+    if not log_file:
+        raise HTTPException(status_code=404, detail="Log no encontrado")
+
+    if log_writer.es_segmento(log_file):
+        contenido = await log_writer.leer_segmento(log_file)
+        if contenido is None:
+            raise HTTPException(status_code=404, detail="Archivo de log no existe")
+        return Response(
+            contenido,
+            media_type="text/plain; charset=utf-8",
+            headers={"Content-Disposition": f'attachment; filename="ticket_{ticket_id:03d}.log"'}
+        )
+
+    log_path = log_writer.ruta_archivo(log_file)
+    if not os.path.exists(log_path):
+        raise HTTPException(status_code=404, detail="Archivo de log no existe")
+
+    return FileResponse(log_path, filename=os.path.basename(log_path))
+
+@app.post("/ticket/{ticket_id}/enviar-mensaje")
+async def enviar_mensaje_tecnico(ticket_id: int, data: MensajeTecnico):
+    """Envía un mensaje personalizado del técnico al usuario y lo guarda en el historial"""
+    try:
+        # Agregar mensaje del técnico al historial (lectura + escritura en una transacción)
         nuevo_mensaje = {
             "role": "tecnico",
             "content": data.mensaje,
             "timestamp": datetime.datetime.now().isoformat()
         }
-        historial.append(nuevo_mensaje)
-        
-        # Actualizar historial en BD
-        cursor.execute(
-            'UPDATE tickets SET historial_conversacion = ? WHERE id = ?',
-            (json.dumps(historial, ensure_ascii=False, indent=2), ticket_id)
-        )
-        conn.commit()
-        conn.close()
+        telefono = await ticket_repo.agregar_mensaje(ticket_id, nuevo_mensaje)
+
+        if telefono is None:
+            raise HTTPException(status_code=404, detail="Ticket no encontrado")
+
+        event_bus.publicar("mensaje", {"ticket_id": ticket_id, "role": "tecnico"})
         
         # Enviar mensaje por WhatsApp
         logger.info(f"Enviando mensaje del técnico al ticket #{ticket_id} ({telefono})")
         
         try:
-            response = requests.post(
-                f"http://{IP_LAPTOP}:{PUERTO_LAPTOP}/enviar-mensaje",
-                json={"numero": telefono, "texto": data.mensaje},
-                headers={"Authorization": f"Bearer {API_TOKEN}"},
-                timeout=5
-            )
-            response.raise_for_status()
-            logger.info(f"Mensaje enviado exitosamente a {telefono}")
-            return {
-                "status": "enviado", 
+            if await outbound_queue.enviar_o_encolar(telefono, data.mensaje):
+                logger.info(f"Mensaje enviado exitosamente a {telefono}")
+                return {
+                    "status": "enviado",
+                    "ticket_id": ticket_id,
+                    "telefono": telefono,
+                    "mensaje": "Mensaje enviado correctamente"
+                }
+            logger.warning(f"WhatsApp no disponible, mensaje del ticket #{ticket_id} en cola")
+            return RespuestaJSON(status_code=202, content={
+                "status": "en_cola",
                 "ticket_id": ticket_id,
                 "telefono": telefono,
-                "mensaje": "Mensaje enviado correctamente"
-            }
-        except requests.exceptions.Timeout:
-            logger.error(f"Timeout al enviar mensaje para ticket #{ticket_id}")
-            raise HTTPException(status_code=504, detail="WhatsApp no responde (timeout)")
-        except requests.exceptions.ConnectionError:
-            logger.error(f"Error de conexión con WhatsApp para ticket #{ticket_id}")
-            raise HTTPException(status_code=503, detail="WhatsApp desconectado. El mensaje se guardó pero no se pudo enviar.")
-        except requests.exceptions.HTTPError as e:
-            if e.response.status_code == 503:
-                logger.warning(f"WhatsApp desconectado, mensaje guardado pero no enviado")
-                raise HTTPException(
-                    status_code=503, 
-                    detail="WhatsApp desconectado. El mensaje se guardó en el historial pero no se pudo enviar. Reconecta WhatsApp."
-                )
-            else:
-                logger.error(f"Error HTTP enviando mensaje: {e.response.status_code}")
-                raise HTTPException(status_code=500, detail=f"Error enviando mensaje: {e.response.text}")
-        except Exception as e:
-            logger.error(f"Error inesperado enviando mensaje: {str(e)}")
-            raise HTTPException(status_code=500, detail=f"Error inesperado: {str(e)}")
-            
+                "mensaje": "WhatsApp no está disponible. El mensaje se guardó y se enviará automáticamente al reconectar."
+            })
+        except BridgeError as e:
+            logger.error(f"Error HTTP enviando mensaje: {str(e)}")
+            raise HTTPException(status_code=500, detail=f"Error enviando mensaje: {str(e)}")
+
     except HTTPException:
         raise
     except Exception as e:
@@ -734,37 +4815,23 @@ async def enviar_mensaje_tecnico(ticket_id: int, data: MensajeTecnico):
 @app.post("/responder/{t_id}")
 async def responder(t_id: int):
     try:
-        conn = sqlite3.connect('tickets.db')
-        cursor = conn.cursor()
-        cursor.execute('SELECT cliente FROM tickets WHERE id=?', (t_id,))
-        row = cursor.fetchone()
-        conn.close()
-        
-        if not row:
+        cliente = await ticket_repo.obtener_cliente(t_id)
+
+        if cliente is None:
             raise HTTPException(status_code=404, detail="Ticket no encontrado")
         
         msg = "Hola, recibimos tu equipo. Estamos trabajando en el diagnóstico. Te avisaremos pronto."
         
         try:
-            response = requests.post(
-                f"http://{IP_LAPTOP}:{PUERTO_LAPTOP}/enviar-mensaje",
-                json={"numero": row[0], "texto": msg},
-                headers={"Authorization": f"Bearer {API_TOKEN}"},
-                timeout=5
-            )
-            response.raise_for_status()
-            logger.info(f"Mensaje enviado para ticket #{t_id}")
-            return {"status": "Enviado", "ticket_id": t_id}
-        except requests.exceptions.Timeout:
-            logger.error(f"Timeout al enviar mensaje para ticket #{t_id}")
-            raise HTTPException(status_code=504, detail="Laptop no responde (timeout)")
-        except requests.exceptions.ConnectionError:
-            logger.error(f"Laptop desconectada para ticket #{t_id}")
-            raise HTTPException(status_code=503, detail="Laptop desconectada")
-        except Exception as e:
+            if await outbound_queue.enviar_o_encolar(cliente, msg):
+                logger.info(f"Mensaje enviado para ticket #{t_id}")
+                return {"status": "Enviado", "ticket_id": t_id}
+            logger.warning(f"Laptop no disponible, mensaje del ticket #{t_id} en cola")
+            return RespuestaJSON(status_code=202, content={"status": "En cola (se enviará al reconectar)", "ticket_id": t_id})
+        except BridgeError as e:
             logger.error(f"Error enviando mensaje: {str(e)}")
             raise HTTPException(status_code=500, detail=f"Error: {str(e)}")
-            
+
     except HTTPException:
         raise
     except Exception as e:
@@ -0,0 +1,98 @@
+"""
+Script para migrar el historial de conversación (columna JSON historial_conversacion)
+a la tabla ticket_messages, un mensaje por fila.
+Ejecuta este script UNA VEZ después de actualizar el código.
+
+Es seguro ejecutarlo varias veces: los mensajes ya migrados se ignoran.
+Con --limpiar se vacía historial_conversacion de los tickets migrados para liberar espacio.
+
+La base se toma de DB_PATH (igual que main.py, también desde .env).
+
+Uso:
+    python migrar_historial_mensajes.py [--limpiar]
+"""
+
+import json
+import os
+import sqlite3
+import sys
+from dotenv import load_dotenv
+
+load_dotenv()
+DB_PATH = os.getenv("DB_PATH", "tickets.db")
+
+def crear_tabla(cursor):
+    """Crea ticket_messages si el servidor aún no la creó"""
+    cursor.execute('''
+        CREATE TABLE IF NOT EXISTS ticket_messages (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            ticket_id INTEGER NOT NULL REFERENCES tickets(id),
+            seq INTEGER NOT NULL,
+            role TEXT NOT NULL,
+            content TEXT,
+            timestamp TEXT,
+            UNIQUE (ticket_id, seq)
+        )
+    ''')
+
+def decodificar_historial(historial_json):
+    """
+    Mensajes (dicts) del historial, con las mismas reglas que main.py:
+    None si no es JSON o no es una lista; los elementos que no son objetos se descartan.
+    """
+    try:
+        historial = json.loads(historial_json)
+    except json.JSONDecodeError:
+        return None
+    if not isinstance(historial, list):
+        return None
+    return [msg for msg in historial if isinstance(msg, dict)]
+
+def migrar_historiales(limpiar: bool = False):
+    """Copia cada historial JSON a ticket_messages"""
+    conn = sqlite3.connect(DB_PATH)
+    cursor = conn.cursor()
+    crear_tabla(cursor)
+
+    # Obtener los tickets que aún tienen historial en JSON
+    cursor.execute("SELECT id, historial_conversacion FROM tickets WHERE historial_conversacion IS NOT NULL AND historial_conversacion != ''")
+    tickets = cursor.fetchall()
+
+    migrados = 0
+    mensajes_totales = 0
+    for ticket_id, historial_json in tickets:
+        # Si el ticket ya tiene mensajes en la tabla (creado o migrado después), no tocarlo
+        cursor.execute('SELECT COUNT(*) FROM ticket_messages WHERE ticket_id = ?', (ticket_id,))
+        if cursor.fetchone()[0] > 0:
+            if limpiar:
+                cursor.execute('UPDATE tickets SET historial_conversacion = NULL WHERE id = ?', (ticket_id,))
+            continue
+
+        historial = decodificar_historial(historial_json)
+        if historial is None:
+            print(f"⚠️ Ticket #{ticket_id}: historial JSON inválido, se omite")
+            continue
+
+        cursor.executemany(
+            'INSERT OR IGNORE INTO ticket_messages (ticket_id, seq, role, content, timestamp) VALUES (?,?,?,?,?)',
+            [
+                (ticket_id, seq, msg.get('role'), msg.get('content'), msg.get('timestamp'))
+                for seq, msg in enumerate(historial, start=1)
+            ]
+        )
+        if limpiar:
+            cursor.execute('UPDATE tickets SET historial_conversacion = NULL WHERE id = ?', (ticket_id,))
+
+        print(f"✅ Ticket #{ticket_id}: {len(historial)} mensajes migrados")
+        migrados += 1
+        mensajes_totales += len(historial)
+
+    conn.commit()
+    conn.close()
+
+    print(f"\n✨ Migración completada: {migrados} tickets, {mensajes_totales} mensajes")
+
+if __name__ == "__main__":
+    print("🔧 Iniciando migración del historial de conversaciones...\n")
+    migrar_historiales(limpiar='--limpiar' in sys.argv)
+    print("\n✅ ¡Listo! Las conversaciones ahora se leen desde ticket_messages.")
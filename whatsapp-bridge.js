@@ -12,6 +12,8 @@ const API_TOKEN = process.env.API_TOKEN || 'cambiar-en-produccion';
 const PUERTO_LOCAL = process.env.PUERTO_LOCAL || 9000;
 const MAX_REINTENTOS = 3;
 const CARPETA_COLA = 'cola_mensajes';
+// Enviar imágenes como binario a /webhook/imagen (evita inflar 33% con base64)
+const ENVIO_IMAGEN_BINARIO = (process.env.ENVIO_IMAGEN_BINARIO || 'true') !== 'false';
 
 if (!fs.existsSync(CARPETA_COLA)) {
     fs.mkdirSync(CARPETA_COLA, { recursive: true });
@@ -64,16 +66,55 @@ async function enviarConReintentos(datos, intento = 1) {
             await new Promise(resolve => setTimeout(resolve, espera));
             return enviarConReintentos(datos, intento + 1);
         } else {
-            // Guardar en cola local
-            const nombreArchivo = `msg_${Date.now()}.json`;
-            const rutaArchivo = path.join(CARPETA_COLA, nombreArchivo);
-            fs.writeFileSync(rutaArchivo, JSON.stringify(datos));
-            log(`Mensaje guardado en cola local: ${nombreArchivo}`, 'WARNING');
+            guardarEnCola(datos);
             return false;
         }
     }
 }
 
+function guardarEnCola(datos) {
+    const nombreArchivo = `msg_${Date.now()}.json`;
+    const rutaArchivo = path.join(CARPETA_COLA, nombreArchivo);
+    fs.writeFileSync(rutaArchivo, JSON.stringify(datos));
+    log(`Mensaje guardado en cola local: ${nombreArchivo}`, 'WARNING');
+}
+
+async function enviarImagenConReintentos(remitente, texto, buffer, idMensaje, intento = 1) {
+    try {
+        await axios.post(`${SERVER_URL}/webhook/imagen`, buffer, {
+            headers: {
+                'Authorization': `Bearer ${API_TOKEN}`,
+                'Content-Type': 'application/octet-stream',
+                'X-Remitente': remitente,
+                'X-Contenido': encodeURIComponent(texto),
+                'X-Id-Mensaje': idMensaje
+            },
+            timeout: 15000,
+            maxBodyLength: Infinity
+        });
+        log(`Imagen enviada al servidor (intento ${intento})`, 'SUCCESS');
+        return true;
+    } catch (error) {
+        log(`Error enviando imagen en intento ${intento}: ${error.message}`, 'ERROR');
+
+        // Servidor sin /webhook/imagen: usar el webhook JSON con base64
+        if (error.response && error.response.status === 404) {
+            return enviarConReintentos({ remitente, contenido: texto, imagen: buffer.toString('base64'), id_mensaje: idMensaje });
+        }
+
+        if (intento < MAX_REINTENTOS) {
+            const espera = Math.pow(2, intento) * 1000; // Backoff exponencial
+            log(`Reintentando en ${espera/1000}s...`, 'WARNING');
+            await new Promise(resolve => setTimeout(resolve, espera));
+            return enviarImagenConReintentos(remitente, texto, buffer, idMensaje, intento + 1);
+        }
+
+        // La cola local usa el formato JSON del webhook
+        guardarEnCola({ remitente, contenido: texto, imagen: buffer.toString('base64'), id_mensaje: idMensaje });
+        return false;
+    }
+}
+
 async function procesarCola() {
     const archivos = fs.readdirSync(CARPETA_COLA);
     if (archivos.length === 0) return;
@@ -142,37 +183,43 @@ async function iniciar() {
 
         const tipo = Object.keys(m.message)[0];
         let texto = m.message.conversation || m.message.extendedTextMessage?.text || "";
-        let imgB64 = null;
+        let imgBuffer = null;
 
         if (tipo === 'imageMessage') {
             texto = m.message.imageMessage.caption || "Imagen enviada";
             try {
                 const stream = await downloadContentFromMessage(m.message.imageMessage, 'image');
-                let buffer = Buffer.from([]);
-                for await (const chunk of stream) { buffer = Buffer.concat([buffer, chunk]); }
+                const chunks = [];
+                for await (const chunk of stream) { chunks.push(chunk); }
+                const buffer = Buffer.concat(chunks);
                 
                 // Validar tamaño (máx 16MB)
                 if (buffer.length > 16_000_000) {
                     log('Imagen muy grande, descartando', 'WARNING');
-                    imgB64 = null;
                     texto += " [Imagen muy grande, no procesada]";
                 } else {
-                    imgB64 = buffer.toString('base64');
+                    imgBuffer = buffer;
                 }
             } catch (error) {
                 log(`Error descargando imagen: ${error.message}`, 'ERROR');
             }
         }
 
-        if (texto || imgB64) {
+        if (texto || imgBuffer) {
             const numeroLimpio = extraerNumeroTelefonico(m.key.remoteJid);
             log(`Mensaje recibido de: ${numeroLimpio} (JID original: ${m.key.remoteJid})`, 'INFO');
             
-            await enviarConReintentos({
-                remitente: numeroLimpio,
-                contenido: texto,
-                imagen: imgB64
-            });
+            if (imgBuffer && ENVIO_IMAGEN_BINARIO) {
+                await enviarImagenConReintentos(numeroLimpio, texto, imgBuffer, m.key.id);
+            } else {
+                await enviarConReintentos({
+                    remitente: numeroLimpio,
+                    contenido: texto,
+                    imagen: imgBuffer ? imgBuffer.toString('base64') : null,
+                    // id de WhatsApp: el servidor descarta los reenvíos del mismo mensaje
+                    id_mensaje: m.key.id
+                });
+            }
         }
     });
 